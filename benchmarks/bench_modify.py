@@ -0,0 +1,85 @@
+"""
+Benchmark of the rewrite engine on long command lines.
+
+Compares compiled rules against applying the rules one after another, the way
+Configuration.modify() used to do it. Run it from the repository root:
+
+    python benchmarks/bench_modify.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from interceptor.rules import compile_rules  # noqa: E402
+
+CONFIGURATION = {
+    'args_to_disable': ['-quiet', '-Werror', '-g3', '-pipe'],
+    'args_to_replace': [['-march=native', '-mcpu=native'], ['-O3', '-O2'], ['-O2', '-Os']],
+    'args_to_append': ['-DDEBUG', '-fno-omit-frame-pointer'],
+    'args_to_prepend': ['-v', '-fdiagnostics-color'],
+    'deduplication': True,
+}
+
+
+def rule_by_rule(cfg: dict, arguments: list) -> list:
+    arguments = list(arguments)
+    for arg in cfg['args_to_disable']:
+        while arg in arguments:
+            del arguments[arguments.index(arg)]
+    for source, target in cfg['args_to_replace']:
+        while source in arguments:
+            arguments[arguments.index(source)] = target
+    for arg in cfg['args_to_append']:
+        if arg not in arguments:
+            arguments.append(arg)
+    for arg in reversed(cfg['args_to_prepend']):
+        if arg not in arguments:
+            arguments = [arg] + arguments
+    if cfg['deduplication']:
+        new_arguments = []
+        added_args = set()
+        for arg in arguments:
+            if arg not in added_args:
+                new_arguments.append(arg)
+                added_args.add(arg)
+        arguments = new_arguments
+    return arguments
+
+
+def make_command_line(size: int) -> list:
+    arguments = ['-c', '-O3', '-march=native', '-pipe', '-o', 'out']
+    for i in range(size - len(arguments)):
+        # linker lines repeat flags between groups of objects
+        arguments.append('-O3' if i % 10 == 0 else 'obj/file_%s.o' % (i,))
+    return arguments
+
+
+def best_of(function, rounds: int = 5) -> float:
+    times = []
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started_at)
+    return min(times)
+
+
+def main():
+    rules = compile_rules(CONFIGURATION)
+    print('%10s %14s %14s %10s' % ('arguments', 'rule by rule', 'compiled', 'speed-up'))
+    for size in (100, 1000, 10000):
+        arguments = make_command_line(size)
+        assert rules.apply(arguments) == rule_by_rule(CONFIGURATION, arguments)
+        naive = best_of(lambda: rule_by_rule(CONFIGURATION, arguments), rounds=3)
+        compiled = best_of(lambda: rules.apply(arguments))
+        print('%10s %11.3f ms %11.3f ms %9.1fx' % (size, naive * 1000, compiled * 1000,
+                                                   naive / compiled))
+    # rule by rule takes minutes here
+    arguments = make_command_line(100000)
+    compiled = best_of(lambda: rules.apply(arguments))
+    print('%10s %14s %11.3f ms' % (100000, '-', compiled * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Benchmarks of everything that every intercepted call goes through, compared against
+a stored baseline.
+
+Measures:
+
+* modify - Configuration.modify() across command line lengths and rule counts
+* apply - applying rules that are already compiled, as the wrappers do with the snapshot
+* load - loading a configuration: load_config_for(), and load_configuration() as the
+  wrappers do it, from the snapshot or from the JSON files
+* wrapper - a call of a no-op tool through it's wrapper, minus a call of the no-op directly
+
+Everything runs in a temporary root: every location in interceptor.paths is moved under it
+before anything else of interceptor is imported, and so it is in the wrappers that the suite
+generates. So /etc/interceptor.d is never touched and nothing has to be installed. Run it from the
+repository root:
+
+    python benchmarks/suite.py              # compare against benchmarks/baseline.json
+    python benchmarks/suite.py --save       # record the baseline anew
+    python benchmarks/suite.py -k wrapper   # run only the benchmarks of the wrapper
+
+Timings are scaled by a calibration loop before comparing, so that a baseline recorded on
+one machine stays meaningful on another. A benchmark that got slower than the baseline by
+more than the threshold is a regression, and the exit code is 1.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+ROOT = tempfile.mkdtemp(prefix='interceptor-bench-')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import interceptor.paths  # noqa: E402
+
+# must be done before the rest of interceptor imports the locations
+RELOCATED_PATHS = {name: os.path.join(ROOT, value.lstrip('/'))
+                   for name, value in vars(interceptor.paths).items()
+                   if name.isupper() and isinstance(value, str) and value.startswith('/')}
+vars(interceptor.paths).update(RELOCATED_PATHS)
+
+from interceptor.config import Configuration, load_config_for, rebuild_snapshot  # noqa: E402
+from interceptor.paths import CONFIG_DIR  # noqa: E402
+from interceptor.rules import compile_rules  # noqa: E402
+from interceptor.runtime import load_configuration  # noqa: E402
+from interceptor.wrappers import INTERCEPTED, render_wrapper, write_wrapper  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DEFAULT_THRESHOLD = 0.5
+COMMAND_LINE_SIZES = (10, 1000, 10000)
+RULE_COUNTS = (10, 100, 1000)
+WRAPPER_CALLS = 40
+ROUNDS = 5
+
+
+def make_configuration(name: str, rule_count: int, patterns: bool = True) -> Configuration:
+    """
+    Return a configuration with about rule_count rules, of every kind.
+
+    :param patterns: whether to include pattern rules, which the sh backend can't express
+    """
+    share = max(rule_count // 8, 1)
+    cfg = Configuration(args_to_disable=['-Wno-%s' % (i,) for i in range(share * 2)],
+                        args_to_replace=[['-O%s' % (i,), '-O2'] for i in range(share * 2)],
+                        args_to_append=['-DAPPENDED_%s' % (i,) for i in range(share)],
+                        args_to_prepend=['-DPREPENDED_%s' % (i,) for i in range(share)],
+                        args_to_disable_matching=['prefix:-fsanitize%s=' % (i,)
+                                                  for i in range(share)],
+                        args_to_replace_matching=[['glob:-march=*%s' % (i,), '-march=x86-64']
+                                                  for i in range(share)],
+                        deduplication=True,
+                        app_name=name)
+    if not patterns:
+        cfg.args_to_disable_matching, cfg.args_to_replace_matching = [], []
+    return cfg
+
+
+def make_command_line(size: int) -> list:
+    arguments = ['cc', '-c', '-O3', '-march=native', '-Wno-1', '-o', 'out']
+    for i in range(size - len(arguments)):
+        arguments.append('-O3' if i % 10 == 0 else 'obj/file_%s.o' % (i,))
+    return arguments[:size]
+
+
+def measure(function) -> float:
+    """
+    Return the time of a single call of function, in seconds, the best of a few rounds.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=ROUNDS, number=number)) / number
+
+
+def calibrate() -> float:
+    def work():
+        dct = {}
+        for i in range(1000):
+            dct['key%s' % (i,)] = [i] * 3
+        sorted(dct.items(), key=lambda item: item[1][0], reverse=True)
+    return measure(work)
+
+
+def bench_modify() -> dict:
+    results = {}
+    for rule_count in RULE_COUNTS:
+        cfg = make_configuration('bench', rule_count)
+        rules = compile_rules(cfg.effective_config())
+        for size in COMMAND_LINE_SIZES:
+            args = make_command_line(size)
+            suffix = '[argv=%s,rules=%s]' % (size, rule_count)
+            results['modify' + suffix] = measure(lambda: cfg.modify(args))
+            results['apply' + suffix] = measure(lambda: rules.apply(args[1:]))
+    return results
+
+
+def bench_load() -> dict:
+    make_configuration('profile', 100).save()
+    tool = make_configuration('tool', 100)
+    tool.extends = ['profile']
+    tool.save()
+    results = {'load[load_config_for]': measure(lambda: load_config_for('tool', None)),
+               'load[snapshot]': measure(lambda: load_configuration('tool'))}
+    os.unlink(os.path.join(CONFIG_DIR, '.snapshot'))
+    results['load[json]'] = measure(lambda: load_configuration('tool'))
+    rebuild_snapshot()
+    return results
+
+
+def _median_call_time(args: list) -> float:
+    times = []
+    for _ in range(WRAPPER_CALLS):
+        started_at = time.perf_counter()
+        subprocess.run(args, check=True)
+        times.append(time.perf_counter() - started_at)
+    return statistics.median(times)
+
+
+def relocate_wrapper(content: str) -> str:
+    """
+    Make a Python wrapper move the locations under ROOT before it imports the runtime.
+    The sh wrapper has them all in it already.
+    """
+    return content.replace('from interceptor.runtime import',
+                           'import interceptor.paths\nvars(interceptor.paths).update(%r)\n'
+                           'from interceptor.runtime import' % (RELOCATED_PATHS,), 1)
+
+
+def bench_wrapper() -> dict:
+    bin_dir = os.path.join(ROOT, 'bin')
+    os.makedirs(bin_dir)
+    original = os.path.join(bin_dir, 'noop' + INTERCEPTED)
+    shutil.copy2(shutil.which('true'), original)
+
+    results = {}
+    for backend in ('python', 'sh'):
+        name = 'noop-%s' % (backend,)
+        cfg = make_configuration(name, 10, patterns=False)
+        cfg.wrapper_backend = backend
+        cfg.save()
+        wrapper = os.path.join(bin_dir, name)
+        write_wrapper(wrapper, relocate_wrapper(render_wrapper(name, original,
+                                                               cfg.effective_config())), 0o755)
+        args = make_command_line(100)[1:]
+        # the first calls warm up the page cache
+        _median_call_time([wrapper] + args)
+        direct = _median_call_time([original] + args)
+        results['wrapper[%s]' % (backend,)] = _median_call_time([wrapper] + args) - direct
+    return results
+
+
+BENCHMARKS = (bench_modify, bench_load, bench_wrapper)
+
+
+def compare(results: dict, calibration: float, baseline: dict, threshold: float) -> list:
+    """
+    Print the results next to the baseline and return names of the benchmarks that regressed.
+    """
+    scale = calibration / baseline['calibration']
+    regressions = []
+    print('%-32s %12s %12s %8s' % ('benchmark', 'time', 'baseline', 'change'))
+    for name, value in results.items():
+        if name not in baseline['results']:
+            print('%-32s %9.1f us %12s' % (name, value * 1000000, '-'))
+            continue
+        expected = baseline['results'][name] * scale
+        change = value / expected - 1 if expected > 0 else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('%-32s %9.1f us %9.1f us %+7.1f%%%s' % (name, value * 1000000, expected * 1000000,
+                                                     change * 100, ' REGRESSION' if regressed
+                                                     else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark interceptor against a baseline')
+    parser.add_argument('--save', action='store_true', help='record the results as the baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path to the baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='slowdown, as a fraction, past which a benchmark has regressed')
+    parser.add_argument('-k', dest='keyword', help='run only the benchmarks of this group')
+    options = parser.parse_args()
+
+    os.makedirs(CONFIG_DIR)
+    try:
+        calibration = calibrate()
+        results = {}
+        for benchmark in BENCHMARKS:
+            if options.keyword is None or options.keyword in benchmark.__name__:
+                results.update(benchmark())
+    finally:
+        shutil.rmtree(ROOT)
+
+    if options.save:
+        with open(options.baseline, 'w', encoding='utf-8') as f_out:
+            json.dump({'calibration': calibration, 'results': results}, f_out, indent=4,
+                      sort_keys=True)
+            f_out.write('\n')
+        print('Baseline of %s benchmarks saved to %s' % (len(results), options.baseline))
+        return
+
+    try:
+        with open(options.baseline, 'r', encoding='utf-8') as f_in:
+            baseline = json.load(f_in)
+    except FileNotFoundError:
+        baseline = {'calibration': calibration, 'results': {}}
+    regressions = compare(results, calibration, baseline, options.threshold)
+    if regressions:
+        print('%s benchmarks regressed by more than %.0f%%: %s' % (
+            len(regressions), options.threshold * 100, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
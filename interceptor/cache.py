@@ -0,0 +1,379 @@
+"""
+The compile cache, serving object files of compilations that were done before.
+
+With compile_cache on, the wrapper looks at the rewritten command line of every call. If it's
+a single -c compilation of a C, C++ or Objective-C source, it runs the preprocessor and
+hashes its output together with the command line, the working directory and the identity of
+the compiler binary. If the cache has an entry for the hash, the object file, the dependency
+file (for -MD and -MMD) and the compiler's stderr are served from it and the compiler is not
+run at all. Otherwise the compiler is run as a child process and, if it succeeds, its
+outputs are stored.
+
+Anything the cache does not understand (linking, -E, -S, -M and -MM, profiling and coverage,
+split debug info, options passed to the preprocessor with -Wp, or -Xpreprocessor, response
+files, more than one source, missing sources...) is left alone, and the wrapper execs the
+compiler as usual.
+
+Every user gets a directory of their own in the cache directory, created as 0700. If it's not
+owned by the user or is writable by anybody else, eg. another user created it first, the cache
+is not used at all, so that users can't poison each other's caches. Entries are directories
+named by the hash, and the least recently used ones are evicted once the directory grows past
+compile_cache_size bytes.
+
+This module is imported by the wrapper only for tools with compile_cache on.
+"""
+import hashlib
+import marshal
+import os
+import shutil
+import subprocess
+import sys
+import typing as tp
+
+from interceptor.paths import COMPILE_CACHE_DIR, user_directory
+
+# bump whenever what goes into the hash changes
+HASH_VERSION = b'interceptor-compile-cache-1'
+DEFAULT_MAX_SIZE = 5 * 1024 * 1024 * 1024
+# how much of the maximum size is left after evicting, so that it's not done on every store
+EVICT_TO = 0.9
+
+SOURCE_EXTENSIONS = frozenset(['.c', '.cc', '.cp', '.cpp', '.cxx', '.c++', '.C', '.CPP', '.m',
+                               '.mm', '.M', '.i', '.ii', '.mi', '.mii'])
+# options that take the next argument as their value
+OPTIONS_WITH_ARGUMENT = frozenset([
+    '-I', '-D', '-U', '-include', '-imacros', '-isystem', '-iquote', '-idirafter', '-iprefix',
+    '-iwithprefix', '-iwithprefixbefore', '-isysroot', '-imultilib', '--sysroot', '-x', '-arch',
+    '-target', '--target', '-Xclang', '--param', '-aux-info', '-G'])
+UNCACHEABLE_PREFIXES = ('-E', '-S', '-M', '-fprofile', '-ftest-coverage', '--coverage',
+                        '-save-temps', '-gsplit-dwarf', '-fdump', '-Xassembler', '-Wa,',
+                        '-Xlinker', '-Wl,', '-fsyntax-only', '-fsave-optimization-record',
+                        '-ftime-trace', '-frecord-gcc-switches', '-specs', '-B', '-fplugin',
+                        '--save-temps', '-emit-', '-###',
+                        # eg. -Wp,-MMD,x.d of Kbuild, dependencies the cache would not store
+                        '-Wp,', '-Xpreprocessor')
+DEPENDENCY_FLAGS = frozenset(['-MD', '-MMD', '-MP'])
+DEPENDENCY_OPTIONS = ('-MF', '-MT', '-MQ')
+# environment variables that may change what the compiler outputs
+ENVIRONMENT = ('LANG', 'LC_ALL', 'LC_CTYPE', 'LC_MESSAGES', 'SOURCE_DATE_EPOCH',
+               'COMPILER_PATH', 'GCC_EXEC_PREFIX', 'CPATH', 'C_INCLUDE_PATH',
+               'CPLUS_INCLUDE_PATH', 'OBJC_INCLUDE_PATH')
+
+OBJECT = 'o'
+DEPENDENCIES = 'd'
+STDERR = 'stderr'
+STATS = '.stats'
+COUNTERS = ('hits', 'misses', 'uncacheable', 'failed', 'evicted')
+
+
+class Compilation:
+    """
+    A compilation that the cache understands.
+
+    :ivar source: path to the source file
+    :ivar output: path to the object file
+    :ivar dependency_file: path to the dependency file, or None if none is generated
+    :ivar preprocess_arguments: arguments that make the compiler preprocess the source to
+        stdout instead, without argv[0]
+    """
+    __slots__ = ('source', 'output', 'dependency_file', 'preprocess_arguments')
+
+    def __init__(self, source: str, output: str, dependency_file: tp.Optional[str],
+                 preprocess_arguments: tp.List[str]):
+        self.source = source
+        self.output = output
+        self.dependency_file = dependency_file
+        self.preprocess_arguments = preprocess_arguments
+
+
+def analyze(arguments: tp.List[str]) -> tp.Optional[Compilation]:
+    """
+    Return the compilation that given arguments (without argv[0]) ask for, or None if
+    the cache can't handle it.
+    """
+    compile_only = generates_dependencies = language_given = False
+    sources = []
+    output = dependency_file = None
+    preprocess = []
+    i = 0
+    while i < len(arguments):
+        arg = arguments[i]
+        i += 1
+        if arg == '-c':
+            compile_only = True
+        elif arg in DEPENDENCY_FLAGS:
+            generates_dependencies = generates_dependencies or arg != '-MP'
+        elif arg[:3] in DEPENDENCY_OPTIONS:
+            if len(arg) > 3:
+                value = arg[3:]
+            elif i < len(arguments):
+                value = arguments[i]
+                i += 1
+            else:
+                return None
+            if arg[:3] == '-MF':
+                dependency_file = value
+        elif arg.startswith('-o'):
+            if len(arg) > 2:
+                output = arg[2:]
+            elif i < len(arguments):
+                output = arguments[i]
+                i += 1
+            else:
+                return None
+        elif arg == '-' or arg.startswith('@') or arg.startswith(UNCACHEABLE_PREFIXES):
+            return None
+        elif arg in OPTIONS_WITH_ARGUMENT:
+            if i == len(arguments):
+                return None
+            language_given = language_given or arg == '-x'
+            preprocess.extend((arg, arguments[i]))
+            i += 1
+        elif arg.startswith('-'):
+            language_given = language_given or arg.startswith('-x')
+            preprocess.append(arg)
+        else:
+            sources.append(arg)
+            preprocess.append(arg)
+
+    if not compile_only or len(sources) != 1:
+        return None
+    source = sources[0]
+    if not language_given and os.path.splitext(source)[1] not in SOURCE_EXTENSIONS:
+        return None
+    if not os.path.isfile(source):
+        return None
+    if output is None:
+        output = os.path.splitext(os.path.basename(source))[0] + '.o'
+    if not generates_dependencies:
+        dependency_file = None
+    elif dependency_file is None:
+        dependency_file = os.path.splitext(output)[0] + '.d'
+    return Compilation(source, output, dependency_file, preprocess + ['-E'])
+
+
+def cache_directory(configured: tp.Optional[str] = None) -> tp.Optional[str]:
+    """
+    Return the cache directory of the current user, or None if it can't be trusted.
+    """
+    return user_directory(configured or COMPILE_CACHE_DIR)
+
+
+def _encode(value: str) -> bytes:
+    return value.encode('utf-8', 'surrogateescape') + b'\0'
+
+
+def compute_key(location: str, args: tp.List[str], preprocessed: bytes) -> str:
+    """
+    Return the hash of a compilation.
+
+    :param location: path to the compiler binary
+    :param args: the rewritten command line, including argv[0]
+    :param preprocessed: output of the preprocessor
+    """
+    st = os.stat(location)
+    digest = hashlib.sha256(HASH_VERSION)
+    # argv[0] matters, eg. clang and clang++ are the same binary
+    for value in (os.path.realpath(location), str(st.st_size), str(st.st_mtime_ns),
+                  os.path.basename(args[0]), os.getcwd()):
+        digest.update(_encode(value))
+    digest.update(_encode(str(len(args))))
+    for arg in args[1:]:
+        digest.update(_encode(arg))
+    for name in ENVIRONMENT:
+        digest.update(_encode('%s=%s' % (name, os.environ.get(name))))
+    digest.update(preprocessed)
+    return digest.hexdigest()
+
+
+def _entry_path(directory: str, key: str) -> str:
+    return os.path.join(directory, key[:2], key[2:])
+
+
+def _copy_into_place(source: str, target: str) -> None:
+    tmp_path = '%s.%s.tmp' % (target, os.getpid())
+    shutil.copyfile(source, tmp_path)
+    os.rename(tmp_path, target)
+
+
+def _serve(entry: str, compilation: Compilation) -> bool:
+    """
+    Write the outputs stored in an entry. Return whether it was complete.
+    """
+    try:
+        _copy_into_place(os.path.join(entry, OBJECT), compilation.output)
+        if compilation.dependency_file is not None:
+            _copy_into_place(os.path.join(entry, DEPENDENCIES), compilation.dependency_file)
+        with open(os.path.join(entry, STDERR), 'rb') as f_in:
+            stderr = f_in.read()
+    except OSError:
+        # eg. a damaged entry, which counts as a miss
+        return False
+    sys.stderr.buffer.write(stderr)
+    sys.stderr.flush()
+    # the modification time of an entry is when it was last used
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+    return True
+
+
+def _entry_size(entry: str) -> int:
+    return sum(os.stat(os.path.join(entry, name)).st_size for name in os.listdir(entry))
+
+
+def _store(directory: str, key: str, compilation: Compilation, stderr: bytes) -> int:
+    """
+    Store the outputs of a compilation. Return the amount of bytes stored.
+    """
+    entry = _entry_path(directory, key)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp_entry = '%s.%s.tmp' % (entry, os.getpid())
+    os.mkdir(tmp_entry)
+    try:
+        shutil.copyfile(compilation.output, os.path.join(tmp_entry, OBJECT))
+        if compilation.dependency_file is not None:
+            shutil.copyfile(compilation.dependency_file, os.path.join(tmp_entry, DEPENDENCIES))
+        with open(os.path.join(tmp_entry, STDERR), 'wb') as f_out:
+            f_out.write(stderr)
+        size = _entry_size(tmp_entry)
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # eg. a concurrent compilation of the same thing stored it first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        return 0
+    return size
+
+
+def _update_stats(directory: str, max_size: int, size_delta: int = 0, **counters) -> None:
+    """
+    Add to the counters and the total size of a cache directory, evicting the least recently
+    used entries if it grew past max_size.
+    """
+    import fcntl
+    with open(os.path.join(directory, STATS), 'a+b') as f_stats:
+        fcntl.flock(f_stats, fcntl.LOCK_EX)
+        f_stats.seek(0)
+        stats = load_stats(f_stats.read())
+        for name, value in counters.items():
+            stats[name] += value
+        stats['size'] = max(0, stats['size'] + size_delta)
+        if stats['size'] > max_size:
+            evicted, stats['size'] = evict(directory, int(max_size * EVICT_TO))
+            stats['evicted'] += evicted
+        f_stats.seek(0)
+        f_stats.truncate()
+        f_stats.write(marshal.dumps(stats))
+
+
+def load_stats(data: bytes) -> dict:
+    stats = dict.fromkeys(COUNTERS, 0)
+    stats['size'] = 0
+    try:
+        stats.update(marshal.loads(data))
+    except (EOFError, ValueError, TypeError):
+        pass
+    return stats
+
+
+def evict(directory: str, target_size: int) -> tp.Tuple[int, int]:
+    """
+    Remove the least recently used entries until the cache is at most target_size bytes.
+
+    :return: a tuple of (amount of entries removed, size of the cache afterwards)
+    """
+    entries = []
+    for prefix in os.listdir(directory):
+        prefix_path = os.path.join(directory, prefix)
+        if prefix.startswith('.') or not os.path.isdir(prefix_path):
+            continue
+        for name in os.listdir(prefix_path):
+            entry = os.path.join(prefix_path, name)
+            try:
+                entries.append((os.stat(entry).st_mtime_ns, _entry_size(entry), entry))
+            except OSError:
+                pass
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, entry in entries:
+        if total <= target_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        evicted += 1
+    return evicted, total
+
+
+def run_cached(cfg: dict, location: str, args: tp.List[str]) -> tp.Optional[int]:
+    """
+    Serve a compilation from the cache, or run it and store it's outputs.
+
+    :param cfg: the configuration dictionary
+    :param location: path to the compiler binary
+    :param args: the rewritten command line, including argv[0]
+    :return: the exit code of the compilation, or None if the cache can't handle it and
+        the compiler should be exec'd as usual
+    """
+    directory = cache_directory(cfg.get('compile_cache_directory'))
+    if directory is None:
+        return None
+    max_size = cfg.get('compile_cache_size') or DEFAULT_MAX_SIZE
+    compilation = analyze(args[1:])
+    if compilation is None:
+        _try_update_stats(directory, max_size, uncacheable=1)
+        return None
+
+    preprocessor = subprocess.run([args[0]] + compilation.preprocess_arguments,
+                                  executable=location, stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if preprocessor.returncode != 0:
+        # let the compiler itself report what's wrong
+        _try_update_stats(directory, max_size, uncacheable=1)
+        return None
+    key = compute_key(location, args, preprocessor.stdout)
+
+    entry = _entry_path(directory, key)
+    if os.path.isdir(entry) and _serve(entry, compilation):
+        _try_update_stats(directory, max_size, hits=1)
+        return 0
+
+    compiler = subprocess.run(args, executable=location, stderr=subprocess.PIPE)
+    sys.stderr.buffer.write(compiler.stderr)
+    sys.stderr.flush()
+    if compiler.returncode != 0:
+        _try_update_stats(directory, max_size, failed=1)
+        return compiler.returncode
+    try:
+        size = _store(directory, key, compilation, compiler.stderr)
+    except OSError:
+        size = 0
+    _try_update_stats(directory, max_size, size, misses=1)
+    return 0
+
+
+def _try_update_stats(directory: str, max_size: int, size_delta: int = 0, **counters) -> None:
+    try:
+        _update_stats(directory, max_size, size_delta, **counters)
+    except OSError:
+        # a cache that can't be written to does not fail the build
+        pass
+
+
+def collect_stats(configured: tp.Optional[str] = None) -> tp.Dict[str, dict]:
+    """
+    Return the statistics of the caches of all users in given cache directory, as user id
+    to their statistics.
+    """
+    root = configured or COMPILE_CACHE_DIR
+    result = {}
+    if not os.path.isdir(root):
+        return result
+    for uid in sorted(os.listdir(root)):
+        try:
+            with open(os.path.join(root, uid, STATS), 'rb') as f_in:
+                result[uid] = load_stats(f_in.read())
+        except OSError:
+            pass
+    return result
@@ -0,0 +1,227 @@
+"""
+Rewriting compilation databases (compile_commands.json) with a tool's rules, so that IDEs,
+indexers and remote builds see the same arguments as the intercepted compiler does.
+
+The database is read and written as a stream, an entry at a time, so it's never held in
+memory as a whole. Entries are rewritten in chunks by a pool of processes, at most a few
+chunks per process in flight, and written in their original order.
+
+Only the argument rules are applied (see interceptor.rules), without the side effects of
+a call, such as displaying, logging or expanding response files. Entries given as a "command"
+string are split and joined back as a shell would. Entries with neither are left as they are.
+
+    from interceptor.config import load_effective_config
+    from interceptor.compdb import rewrite_compilation_database
+
+    rewrite_compilation_database(load_effective_config('g++'), 'g++',
+                                 'build/compile_commands.json', 'compile_commands.json')
+"""
+import collections
+import concurrent.futures
+import json
+import os
+import shlex
+import typing as tp
+
+from interceptor.paths import INTERCEPTED
+from interceptor.rules import CompiledRules, compile_rules
+
+READ_SIZE = 1024 * 1024
+# what may come between the entries
+SEPARATORS = ' \t\r\n,'
+CHUNK_SIZE = 512
+# chunks in flight per process
+PENDING_PER_JOB = 2
+
+_rules = None
+
+
+def iter_compilation_database(f_in: tp.TextIO) -> tp.Iterator[dict]:
+    """
+    Yield the entries of a compilation database, reading it a piece at a time.
+
+    :raises ValueError: it's not a JSON array of objects
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = '', 0, False
+    started = False
+    while True:
+        while position < len(buffer) and buffer[position] in SEPARATORS:
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError('The compilation database ends unexpectedly')
+            buffer, position = f_in.read(READ_SIZE), 0
+            eof = not buffer
+            continue
+        if not started:
+            if buffer[position] != '[':
+                raise ValueError('The compilation database is not a JSON array')
+            started = True
+            position += 1
+            continue
+        if buffer[position] == ']':
+            return
+        try:
+            entry, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise ValueError('The compilation database is invalid JSON')
+            # the entry was not read completely yet
+            data = f_in.read(READ_SIZE)
+            eof = not data
+            buffer, position = buffer[position:] + data, 0
+            continue
+        if not isinstance(entry, dict):
+            raise ValueError('An entry of the compilation database is not an object')
+        yield entry
+
+
+def is_entry_of(entry: dict, tool_name: str) -> bool:
+    """
+    Is the entry a call of given tool (or of it's intercepted binary)?
+    """
+    if 'arguments' in entry:
+        compiler = entry['arguments'][0] if entry['arguments'] else ''
+    else:
+        compiler = entry.get('command', '').split(None, 1)[0] if entry.get('command') else ''
+    name = os.path.basename(compiler)
+    return name == tool_name or name == tool_name + INTERCEPTED
+
+
+def rewrite_entry(rules: CompiledRules, entry: dict) -> tp.Tuple[dict, bool]:
+    """
+    :return: a tuple of (the entry with it's arguments rewritten, whether they changed)
+    """
+    if 'arguments' in entry:
+        args = entry['arguments']
+        new_args = args[:1] + rules.apply(args[1:])
+        if new_args == args:
+            return entry, False
+        return dict(entry, arguments=new_args), True
+    if 'command' not in entry:
+        return entry, False
+    args = shlex.split(entry['command'])
+    new_args = args[:1] + rules.apply(args[1:])
+    if new_args == args:
+        return entry, False
+    return dict(entry, command=' '.join(shlex.quote(arg) for arg in new_args)), True
+
+
+def _init_worker(tables: tuple) -> None:
+    global _rules
+    _rules = CompiledRules.from_tables(tables)
+
+
+def _rewrite_chunk(chunk: tp.List[dict], tool_name: tp.Optional[str]) -> tp.Tuple[list, int]:
+    """
+    :return: a tuple of (the entries serialized, amount of entries rewritten)
+    """
+    entries = []
+    rewritten = 0
+    for entry in chunk:
+        if tool_name is None or is_entry_of(entry, tool_name):
+            entry, changed = rewrite_entry(_rules, entry)
+            rewritten += changed
+        # serializing takes as long as rewriting, so it's done by the pool too
+        entries.append(json.dumps(entry, indent=2))
+    return entries, rewritten
+
+
+def _chunks(entries: tp.Iterator[dict]) -> tp.Iterator[tp.List[dict]]:
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _Writer:
+    def __init__(self, f_out: tp.TextIO):
+        self.f_out = f_out
+        self.count = 0
+        f_out.write('[')
+
+    def write(self, entries: tp.List[str]) -> None:
+        for entry in entries:
+            self.f_out.write(',\n' if self.count else '\n')
+            self.f_out.write(entry)
+            self.count += 1
+
+    def close(self) -> None:
+        self.f_out.write('\n]\n')
+
+
+def rewrite_stream(cfg: dict, tool_name: tp.Optional[str], f_in: tp.TextIO, f_out: tp.TextIO,
+                   jobs: tp.Optional[int] = None) -> tp.Tuple[int, int]:
+    """
+    Rewrite a compilation database read from f_in into f_out.
+
+    :param cfg: the configuration dictionary whose rules to apply, eg. as returned by
+        load_effective_config()
+    :param tool_name: rewrite only the entries of this tool, or all of them if None
+    :param jobs: amount of processes, by default as many as there are CPUs. With 1 everything
+        is done in this process.
+    :return: a tuple of (amount of entries, amount of entries rewritten)
+    :raises ValueError: the rules or the database are invalid
+    """
+    tables = compile_rules(cfg).to_tables()
+    jobs = jobs or os.cpu_count() or 1
+    writer = _Writer(f_out)
+    rewritten = 0
+    chunks = _chunks(iter_compilation_database(f_in))
+    if jobs == 1:
+        _init_worker(tables)
+        for chunk in chunks:
+            entries, chunk_rewritten = _rewrite_chunk(chunk, tool_name)
+            writer.write(entries)
+            rewritten += chunk_rewritten
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                                    initargs=(tables,)) as executor:
+            pending = collections.deque()
+            for chunk in chunks:
+                if len(pending) == jobs * PENDING_PER_JOB:
+                    entries, chunk_rewritten = pending.popleft().result()
+                    writer.write(entries)
+                    rewritten += chunk_rewritten
+                pending.append(executor.submit(_rewrite_chunk, chunk, tool_name))
+            for future in pending:
+                entries, chunk_rewritten = future.result()
+                writer.write(entries)
+                rewritten += chunk_rewritten
+    writer.close()
+    return writer.count, rewritten
+
+
+def rewrite_compilation_database(cfg: dict, tool_name: tp.Optional[str], input_path: str,
+                                 output_path: tp.Optional[str] = None,
+                                 jobs: tp.Optional[int] = None) -> tp.Tuple[int, int]:
+    """
+    Rewrite a compilation database file, see rewrite_stream().
+
+    :param output_path: where to write the result, by default over the input. It's written
+        via a rename, so it's never seen half-written, and keeps the mode of the file it replaces.
+    """
+    output_path = output_path or input_path
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(output_path)),
+                            '.%s.%s.tmp' % (os.path.basename(output_path), os.getpid()))
+    try:
+        with open(input_path, 'r', encoding='utf-8') as f_in, \
+                open(tmp_path, 'w', encoding='utf-8') as f_out:
+            result = rewrite_stream(cfg, tool_name, f_in, f_out, jobs)
+        try:
+            os.chmod(tmp_path, os.stat(output_path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.rename(tmp_path, output_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return result
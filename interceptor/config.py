@@ -1,18 +1,27 @@
-import copy
+import json
 import os
 import sys
 import typing as tp
 import warnings
 
-import pkg_resources
-from satella.coding import for_argument
-from satella.json import read_json_from_file, write_json_to_file
+from interceptor.paths import CONFIG_DIR, config_path
+from interceptor.resources import validate_resource_policy
+from interceptor.rules import compile_rules
+from interceptor.runtime import apply_configuration
+from interceptor.snapshot import read_snapshot_entry, stat_dependency, write_snapshot
+
+
+# rule and pattern lists, which are concatenated when a configuration extends others
+LIST_KEYS = ('args_to_disable', 'args_to_append', 'args_to_prepend', 'args_to_replace',
+             'args_to_disable_matching', 'args_to_replace_matching', 'memoize_probes')
+# dictionaries, which are merged key by key when a configuration extends others
+DICT_KEYS = ('rlimits', 'environment')
 
 
 class Configuration:
     @property
     def path(self) -> str:
-        return os.path.join('/etc/interceptor.d', self.app_name)
+        return config_path(self.app_name)
 
     def __init__(self, args_to_disable: tp.Optional[tp.List[str]] = None,
                  args_to_append: tp.Optional[tp.List[str]] = None,
@@ -22,7 +31,27 @@ class Configuration:
                  notify_about_actions: bool = False,
                  app_name: tp.Optional[str] = None,
                  deduplication: bool = False,
-                 log: bool = False):
+                 log: bool = False,
+                 wrapper_backend: str = 'python',
+                 expand_response_files: bool = False,
+                 response_file_directory: tp.Optional[str] = None,
+                 args_to_disable_matching: tp.Optional[tp.List[str]] = None,
+                 args_to_replace_matching: tp.Optional[tp.List[tp.Tuple[str, str]]] = None,
+                 metrics: bool = False,
+                 extends: tp.Optional[tp.List[str]] = None,
+                 compile_cache: bool = False,
+                 compile_cache_directory: tp.Optional[str] = None,
+                 compile_cache_size: tp.Optional[int] = None,
+                 max_concurrency: tp.Optional[int] = None,
+                 nice: tp.Optional[int] = None,
+                 ionice: tp.Optional[str] = None,
+                 cpu_affinity: tp.Optional[tp.Union[str, tp.List[int]]] = None,
+                 rlimits: tp.Optional[tp.Dict[str, tp.Union[int, str]]] = None,
+                 environment: tp.Optional[tp.Dict[str, tp.Optional[str]]] = None,
+                 dispatch_sockets: tp.Optional[tp.List[str]] = None,
+                 memoize_probes: tp.Optional[tp.List[str]] = None,
+                 memoize_ttl: tp.Optional[int] = None,
+                 trace: bool = False):
         self.args_to_disable = args_to_disable or []
         self.args_to_append = args_to_append or []
         self.args_to_prepend = args_to_prepend or []
@@ -32,6 +61,33 @@ class Configuration:
         self.app_name = app_name
         self.deduplication = deduplication
         self.log = log
+        self.wrapper_backend = wrapper_backend
+        self.expand_response_files = expand_response_files
+        self.response_file_directory = response_file_directory
+        self.args_to_disable_matching = args_to_disable_matching or []
+        self.args_to_replace_matching = args_to_replace_matching or []
+        self.metrics = metrics
+        self.extends = extends or []
+        self.compile_cache = compile_cache
+        self.compile_cache_directory = compile_cache_directory
+        self.compile_cache_size = compile_cache_size
+        self.max_concurrency = max_concurrency
+        self.nice = nice
+        self.ionice = ionice
+        self.cpu_affinity = cpu_affinity
+        self.rlimits = rlimits or {}
+        self.environment = environment or {}
+        self.dispatch_sockets = dispatch_sockets or []
+        self.memoize_probes = memoize_probes or []
+        self.memoize_ttl = memoize_ttl
+        self.trace = trace
+        # names of the options set explicitly, in the file or assigned since, see to_saved_json()
+        self.__dict__['explicit'] = set()
+
+    def __setattr__(self, key: str, value) -> None:
+        super().__setattr__(key, value)
+        if 'explicit' in self.__dict__:
+            self.explicit.add(key)
 
     def to_json(self):
         return {'args_to_disable': self.args_to_disable,
@@ -41,58 +97,65 @@ class Configuration:
                 'display_before_start': self.display_before_start,
                 'notify_about_actions': self.notify_about_actions,
                 'deduplication': self.deduplication,
-                'log': self.log}
+                'log': self.log,
+                'wrapper_backend': self.wrapper_backend,
+                'expand_response_files': self.expand_response_files,
+                'response_file_directory': self.response_file_directory,
+                'args_to_disable_matching': self.args_to_disable_matching,
+                'args_to_replace_matching': self.args_to_replace_matching,
+                'metrics': self.metrics,
+                'extends': self.extends,
+                'compile_cache': self.compile_cache,
+                'compile_cache_directory': self.compile_cache_directory,
+                'compile_cache_size': self.compile_cache_size,
+                'max_concurrency': self.max_concurrency,
+                'nice': self.nice,
+                'ionice': self.ionice,
+                'cpu_affinity': self.cpu_affinity,
+                'rlimits': self.rlimits,
+                'environment': self.environment,
+                'dispatch_sockets': self.dispatch_sockets,
+                'memoize_probes': self.memoize_probes,
+                'memoize_ttl': self.memoize_ttl,
+                'trace': self.trace}
+
+    def to_saved_json(self) -> dict:
+        """
+        Return the options to be written to the configuration file, ie. the ones that were set
+        explicitly or differ from the defaults. An option written to the file overrides the
+        one of the profiles it extends, even if it's the default, see flatten_config().
+        """
+        defaults = Configuration(app_name=self.app_name).to_json()
+        return {key: value for key, value in self.to_json().items()
+                if key in self.explicit or value != defaults[key]}
+
+    def effective_config(self) -> dict:
+        """
+        Return this configuration merged with the ones it extends, see flatten_config().
+
+        :raises ValueError: a configuration it extends does not exist or is invalid, or
+            it extends itself
+        """
+        return flatten_config(self.app_name, self.to_saved_json())[0]
 
-    @for_argument(None, copy.copy)
     def modify(self, args, *extra_args):
-        process, *arguments = args
-        for arg_to_take_away in self.args_to_disable:
-            while arg_to_take_away in arguments:
-                if self.notify_about_actions:
-                    print('interceptor(%s): taking away %s' % (self.app_name, arg_to_take_away))
-                del arguments[arguments.index(arg_to_take_away)]
-
-        for arg_to_replace, arg_to_replace_with in self.args_to_replace:
-            while arg_to_replace in arguments:
-                if self.notify_about_actions:
-                    print('interceptor(%s): replacing %s with %s' % (self.app_name, arg_to_replace,
-                                                                     arg_to_replace_with))
-                arguments[arguments.index(arg_to_replace)] = arg_to_replace_with
-
-        for arg_to_append in self.args_to_append:
-            if arg_to_append not in arguments:
-                if self.notify_about_actions:
-                    print('interceptor(%s): appending %s' % (self.app_name, arg_to_append))
-                arguments.append(arg_to_append)
-
-        for arg_to_prepend in reversed(self.args_to_prepend):
-            if arg_to_prepend not in arguments:
-                if self.notify_about_actions:
-                    print('interceptor(%s): prepending %s' % (self.app_name, arg_to_prepend))
-                arguments = [arg_to_prepend] + arguments
-
-        if self.deduplication:
-            new_arguments = []
-            added_args = {}
-            for arg in arguments:
-                if arg not in added_args:
-                    new_arguments.append(arg)
-                    added_args.add(arg)
-            arguments = new_arguments
-
-        if self.display_before_start:
-            print('%s %s' % (sys.argv[0], ' '.join(arguments)))
-
-        if self.log:
-            if not os.path.exists('/var/log/interceptor.d'):
-                os.mkdir('/var/log/interceptor.d')
-            with open(os.path.join('/var/log/interceptor.d', sys.argv[0], 'a')) as f_out:
-                f_out.write(' '.join(arguments))
-
-        return [process, *arguments]
-
-    def save(self):
-        write_json_to_file(self.path, self.to_json(), sort_keys=True, indent=4)
+        return apply_configuration(self.effective_config(), self.app_name, args)
+
+    def save(self, follow_symlinks: bool = True):
+        """
+        Atomically write this configuration and rebuild the snapshot.
+
+        :param follow_symlinks: if the configuration is a symlink, write to it's target.
+            Otherwise the symlink is replaced with a regular file.
+        :raises ValueError: a pattern rule or the resource policy is invalid, or see
+            effective_config()
+        """
+        effective = self.effective_config()
+        compile_rules(effective)
+        validate_resource_policy(effective)
+        path = os.path.realpath(self.path) if follow_symlinks else self.path
+        write_config_file(path, json.dumps(self.to_saved_json(), sort_keys=True, indent=4))
+        rebuild_snapshot()
 
     @classmethod
     def from_json(cls, dct, app_name: str):
@@ -109,7 +172,7 @@ class Configuration:
                 warnings.warn('args_to_take_away is deprecated, use args_to_prepend',
                               DeprecationWarning)
 
-        return Configuration(take_away,
+        cfg = Configuration(take_away,
                              dct.get('args_to_append'),
                              prepend,
                              dct.get('args_to_replace'),
@@ -117,7 +180,34 @@ class Configuration:
                              dct.get('notify_about_actions', False),
                              app_name=app_name,
                              deduplication=dct.get('deduplication', False),
-                             log=dct.get('log', False))
+                             log=dct.get('log', False),
+                             wrapper_backend=dct.get('wrapper_backend', 'python'),
+                             expand_response_files=dct.get('expand_response_files', False),
+                             response_file_directory=dct.get('response_file_directory'),
+                             args_to_disable_matching=dct.get('args_to_disable_matching'),
+                             args_to_replace_matching=dct.get('args_to_replace_matching'),
+                             metrics=dct.get('metrics', False),
+                             extends=dct.get('extends'),
+                             compile_cache=dct.get('compile_cache', False),
+                             compile_cache_directory=dct.get('compile_cache_directory'),
+                             compile_cache_size=dct.get('compile_cache_size'),
+                             max_concurrency=dct.get('max_concurrency'),
+                             nice=dct.get('nice'),
+                             ionice=dct.get('ionice'),
+                             cpu_affinity=dct.get('cpu_affinity'),
+                             rlimits=dct.get('rlimits'),
+                             environment=dct.get('environment'),
+                             dispatch_sockets=dct.get('dispatch_sockets'),
+                             memoize_probes=dct.get('memoize_probes'),
+                             memoize_ttl=dct.get('memoize_ttl'),
+                             trace=dct.get('trace', False))
+        explicit = set(dct)
+        if 'args_to_append_before' in explicit:
+            explicit.add('args_to_prepend')
+        if 'args_to_take_away' in explicit:
+            explicit.add('args_to_disable')
+        cfg.explicit.update(explicit.intersection(cfg.to_json()))
+        return cfg
 
 
 def assert_correct_version(version: str) -> None:
@@ -125,6 +215,7 @@ def assert_correct_version(version: str) -> None:
         # print('You have used an older version of interceptor to intercept this command.\n'
         #       'It is advised to undo the interception and reintercept the call to upgrade.')
         return
+    import pkg_resources
     my_version = pkg_resources.require('interceptor')[0].version
     if int(version.split('.')[0]) > int(my_version.split('.')[0]):
         sys.stderr.write('You have intercepted this call using a higher version of Interceptor. \n'
@@ -134,14 +225,174 @@ def assert_correct_version(version: str) -> None:
         sys.exit(1)
 
 
+def read_json_from_file(path: str):
+    with open(path, 'r', encoding='utf-8') as f_in:
+        return json.load(f_in)
+
+
+def flatten_config(name: str, dct: tp.Optional[dict] = None) -> tuple:
+    """
+    Merge a configuration with the ones it extends, recursively.
+
+    The configurations it extends are merged in order, each after the ones it extends itself,
+    followed by the configuration itself. A configuration extended more than once is merged
+    only once. Rule lists are concatenated, rlimits and environment are merged key by key,
+    other options are taken from the last of them that sets them at all, so a configuration
+    can also set back to the default what a profile it extends changed.
+
+    :param name: name of the configuration
+    :param dct: the configuration dictionary, if already read
+    :return: a tuple of (the effective configuration dictionary, names of the configuration
+        files it was made from, starting with name)
+    :raises ValueError: a configuration does not exist or is invalid, or extends itself
+    """
+    if dct is None:
+        dct = _read_extended_config(name, None)
+    order = []
+    _linearize(name, dct, (), order, {name: dct})
+
+    effective = Configuration(app_name=name).to_json()
+    for _, base_dct in order:
+        _merge_config(effective, base_dct)
+    effective['extends'] = []
+    return effective, [name] + [base for base, _ in order[:-1]]
+
+
+def _read_extended_config(name: str, extended_by: tp.Optional[str]) -> dict:
+    try:
+        return Configuration.from_json(read_json_from_file(config_path(name)),
+                                       app_name=name).to_saved_json()
+    except OSError:
+        raise ValueError('Configuration %s extended by %s does not exist' % (name, extended_by))
+    except (TypeError, AttributeError) as e:
+        raise ValueError('Configuration %s is invalid: %s' % (name, e))
+
+
+def _linearize(name: str, dct: dict, chain: tuple, order: list, read: dict) -> None:
+    """
+    Append (name, dictionary) of the configurations that given one extends to order,
+    depth-first, followed by itself.
+    """
+    chain = chain + (name,)
+    for base in dct.get('extends') or ():
+        if base in chain:
+            raise ValueError('Configuration %s extends itself: %s' % (
+                base, ' -> '.join(chain + (base,))))
+        if base not in read:
+            read[base] = _read_extended_config(base, name)
+            _linearize(base, read[base], chain, order, read)
+    order.append((name, dct))
+
+
+def _merge_config(effective: dict, dct: dict) -> None:
+    """
+    Merge the options that a configuration dictionary sets, as written to it's file, into
+    the effective one.
+    """
+    for key, value in dct.items():
+        if key in LIST_KEYS:
+            effective[key] = effective[key] + list(value or ())
+        elif key in DICT_KEYS:
+            effective[key] = dict(effective[key], **(value or {}))
+        elif key != 'extends':
+            effective[key] = value
+
+
+def config_sources(name: str) -> tp.List[str]:
+    """
+    Return the names of the configuration files that the effective configuration of given
+    name is made from, or just the name if it can't be flattened.
+    """
+    try:
+        return flatten_config(name)[1]
+    except ValueError:
+        return [name]
+
+
+def write_config_file(path: str, data: str) -> None:
+    """
+    Write a configuration file via a rename, so that a wrapper running concurrently
+    sees either the old or the new version, but never a half-written one.
+    """
+    tmp_path = os.path.join(os.path.dirname(path),
+                            '.%s.%s.tmp' % (os.path.basename(path), os.getpid()))
+    with open(tmp_path, 'w', encoding='utf-8') as f_out:
+        f_out.write(data)
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+
+def rebuild_snapshot(refresh_all_wrappers: bool = False) -> int:
+    """
+    Recompile every configuration in /etc/interceptor.d into the snapshot, and regenerate
+    the wrappers of tools that use the sh backend, since these have their rules inlined.
+
+    Every configuration is flattened (see flatten_config()), so changing a configuration
+    that others extend updates all of them. Configurations that are not valid are skipped,
+    so that their wrappers will report the error upon reading them.
+
+    :param refresh_all_wrappers: regenerate the wrappers of all tools, not only of these
+        using the sh backend
+    :return: amount of configurations compiled
+    """
+    # stat everything before reading, so that a concurrent change will make the entry stale
+    dependencies = {}
+    for name in os.listdir(CONFIG_DIR):
+        path = config_path(name)
+        if name.startswith('.') or not os.path.isfile(path):
+            continue
+        try:
+            dependencies[name] = stat_dependency(path)
+        except OSError:
+            pass
+
+    entries = {}
+    for name in dependencies:
+        try:
+            dct, sources = flatten_config(name)
+            tables = compile_rules(dct).to_tables()
+            validate_resource_policy(dct)
+        except ValueError:
+            continue
+        if all(source in dependencies for source in sources):
+            entries[name] = (dct, tables), [dependencies[source] for source in sources]
+    write_snapshot(entries)
+
+    from interceptor.wrappers import refresh_wrappers
+    refresh_wrappers({name: dct for name, ((dct, _), _) in entries.items()
+                      if refresh_all_wrappers or dct['wrapper_backend'] == 'sh'})
+    return len(entries)
+
+
 def load_config_for(name: str, version: tp.Optional[str] = '') -> Configuration:
+    """
+    Load the configuration of given name as it's written, without merging the configurations
+    it extends. Exits the process if it does not exist.
+    """
     if version is not None:
         assert_correct_version(version)
 
-    file_name = os.path.join('/etc/interceptor.d', name)
+    file_name = config_path(name)
     if not os.path.isfile(file_name):
         print('Configuration for %s does not exist or is not a file' % (name,))
         sys.exit(1)
 
     cfg = Configuration.from_json(read_json_from_file(file_name), app_name=name)
     return cfg
+
+
+def load_effective_config(name: str) -> dict:
+    """
+    Return the effective configuration dictionary of given name, preferably from the snapshot.
+
+    Exits the process if it does not exist or can't be flattened.
+    """
+    entry = read_snapshot_entry(name)
+    if entry is not None:
+        return entry[0]
+    cfg = load_config_for(name, None)
+    try:
+        return cfg.effective_config()
+    except ValueError as e:
+        print(e.args[0])
+        sys.exit(1)
@@ -0,0 +1,155 @@
+"""
+Running intercepted calls on a worker instead of exec'ing the tool.
+
+With dispatch_sockets set, the wrapper connects to one of these Unix sockets, picked by it's
+pid so that calls spread over them, and sends the rewritten command line, the working
+directory and the environment. The worker runs the tool and streams it's stdout and stderr
+back, followed by it's exit code, with which the wrapper exits. If no worker can be connected
+to, or the one connected to refuses the call before starting it, the wrapper execs the tool
+as usual. A worker that goes away after starting the tool fails the call with LOST_WORKER,
+since the tool may have done something already.
+
+The tool's stdin is not forwarded, it reads /dev/null on the worker, so calls that may read
+it (with - among the arguments, or stdin a pipe or a regular file) are exec'd as usual. So
+are calls whose response files the wrapper expanded, since the new response file is open
+only in the wrapper, see interceptor.response_files. The scheduling and
+resource controls of the tool (see interceptor.resources) are, the worker applies them to the
+tool it runs. If the wrapper is interrupted by SIGINT while the call runs, it closes the
+connection, so that the worker kills the tool, and dies of SIGINT itself. Other signals kill
+the wrapper as they would anyway, which closes the connection too.
+
+The protocol is a sequence of frames, each a byte of it's kind, the length of the payload
+as 4 bytes little-endian and the payload. The wrapper sends a single REQUEST, a JSON object
+of tool (it's name), location, argv, cwd, env and policy (a dictionary of the tool's
+controls that are set, but environment, which is in env already). The worker answers with
+STARTED or REFUSED (with the reason as payload), and after STARTED with any amount of STDOUT
+and STDERR frames, ended by EXIT, carrying the exit code as 4 bytes little-endian signed,
+negative if the tool was killed by a signal. See interceptor.worker for a worker.
+
+This module is imported by the wrappers that dispatch, so it imports only os at the top.
+"""
+import os
+
+REQUEST = b'Q'
+STARTED = b'S'
+REFUSED = b'R'
+STDOUT = b'O'
+STDERR = b'E'
+EXIT = b'X'
+HEADER_SIZE = 5
+# exit code of a call whose worker went away after starting it, as ssh does
+LOST_WORKER = 255
+
+
+def encode_frame(kind: bytes, payload: bytes = b'') -> bytes:
+    return kind + len(payload).to_bytes(4, 'little') + payload
+
+
+def read_exactly(sock, size: int) -> bytes:
+    """
+    :raises EOFError: the connection was closed first
+    """
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def read_frame(sock) -> tuple:
+    """
+    :return: a tuple of (kind, payload)
+    :raises EOFError: the connection was closed
+    """
+    header = read_exactly(sock, HEADER_SIZE)
+    return header[:1], read_exactly(sock, int.from_bytes(header[1:], 'little'))
+
+
+def _connect(sockets: list):
+    import socket
+    for i in range(len(sockets)):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sockets[(os.getpid() + i) % len(sockets)])
+        except OSError:
+            sock.close()
+            continue
+        return sock
+    return None
+
+
+def may_read_stdin(args: list) -> bool:
+    """
+    Could the call read something from stdin, that the worker would not get?
+    """
+    import stat
+    if '-' in args[1:]:
+        return True
+    try:
+        mode = os.fstat(0).st_mode
+    except OSError:
+        return False
+    return stat.S_ISFIFO(mode) or stat.S_ISREG(mode)
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def dispatch(sockets: list, tool_name: str, location: str, args: list, policy: dict = None):
+    """
+    Run the call on a worker.
+
+    :param sockets: paths to the Unix sockets of the workers
+    :param tool_name: name of the intercepted tool
+    :param location: path to the intercepted binary
+    :param args: the rewritten command line, including argv[0]
+    :param policy: the tool's scheduling and resource controls, for the worker to apply
+    :return: the exit code of the call, negative if it was killed by a signal, or None if
+        no worker took it and the tool should be exec'd as usual
+    """
+    if may_read_stdin(args):
+        return None
+    sock = _connect(sockets)
+    if sock is None:
+        return None
+    with sock:
+        try:
+            return _run_call(sock, tool_name, location, args, policy or {})
+        except KeyboardInterrupt:
+            # closing the connection makes the worker kill the tool
+            import signal
+            return -signal.SIGINT
+
+
+def _run_call(sock, tool_name: str, location: str, args: list, policy: dict):
+    """
+    Send the call over the connection and pass on what the worker answers, see dispatch().
+    """
+    import json
+    request = json.dumps({'tool': tool_name, 'location': location, 'argv': args,
+                          'cwd': os.getcwd(), 'env': dict(os.environ), 'policy': policy})
+    try:
+        sock.sendall(encode_frame(REQUEST, request.encode('utf-8')))
+        kind, _ = read_frame(sock)
+    except (OSError, EOFError):
+        return None
+    if kind != STARTED:
+        return None
+
+    while True:
+        try:
+            kind, payload = read_frame(sock)
+        except (OSError, EOFError):
+            os.write(2, ('interceptor(%s): lost the connection to the worker\n' % (
+                tool_name,)).encode())
+            return LOST_WORKER
+        if kind == STDOUT:
+            _write_all(1, payload)
+        elif kind == STDERR:
+            _write_all(2, payload)
+        elif kind == EXIT:
+            return int.from_bytes(payload, 'little', signed=True)
@@ -1,19 +1,38 @@
 #
 # Take care, in importing this module sys.argv gets changed!
 #
+import collections
+import concurrent.futures
+import json
 import os
+import re
 import shutil
+import statistics
+import subprocess
+import socket
 import sys
+import time
+import typing as tp
 
-import pkg_resources
 from satella.coding import silence_excs
-from satella.files import read_in_file, write_to_file
 
-from interceptor.config import load_config_for, Configuration
-from interceptor.whereis import filter_whereis
-
-INTERCEPTED = '-intercepted'
-INTERCEPTOR_WRAPPER_STRING = 'from interceptor.config import load_config_for'
+from interceptor import cache, metrics, probes, registry, shims, trace
+from interceptor.compdb import rewrite_compilation_database
+from interceptor.config import load_config_for, Configuration, rebuild_snapshot, \
+    write_config_file, load_effective_config, config_sources, flatten_config
+from interceptor.invocation_log import log_files, read_records
+from interceptor.paths import CONFIG_DIR, COMPILE_CACHE_DIR, DISPATCHER_PATH, LOG_DIR, \
+    METRICS_DIR, PROBES_DIR, SHIM_DIR, SHIM_INDEX_DIR, SLOTS_DIR, TRACES_DIR, config_path
+from interceptor.resources import RESOURCE_KEYS, describe_resource_policy, \
+    validate_resource_policy
+from interceptor.rules import DISABLE, REPLACE, APPEND, compile_rules
+from interceptor.runtime import TEMPLATE_VERSION
+from interceptor.slots import slots_taken
+from interceptor.snapshot import read_snapshot_entry
+from interceptor.whereis import filter_whereis, whereis_many
+from interceptor.wrappers import INTERCEPTED, INTERCEPTOR_WRAPPER_STRING, PACKAGE_PATH, \
+    BACKENDS, render_wrapper, write_wrapper, refresh_wrappers, is_sh_wrapper, \
+    wrapper_template_version, inspect_wrapper, link_or_copy, render_dispatcher
 
 FORCE = '--force' in sys.argv
 if FORCE:
@@ -31,7 +50,7 @@ def is_intercepted(path_name: str, print_messages=False) -> bool:
         if not b and print_messages:
             print('%s is intercepted, but %s-intercepted does not exist' % (file_name, file_name))
 
-            if not os.path.exists(os.path.join('/etc/interceptor.d', file_name)):
+            if not os.path.exists(config_path(file_name)):
                 print('Additionally, it\'s configuration is not present')
 
         return True
@@ -52,6 +71,13 @@ def assert_intercepted(name: str) -> None:
     if FORCE:
         print('Skipping a check to see if %s is intercepted due to --force' % (name, ))
         return
+    if registry.registered_wrappers(name) is not None:
+        return
+    if shims.is_shimmed(name):
+        return
+    if os.path.isfile(config_path(name)) and not whereis_many([name])[name]:
+        # a profile, that other configurations extend
+        return
     if is_all_intercepted(name):
         return
     if is_partially_intercepted(name):
@@ -82,6 +108,10 @@ def is_completely_unintercepted(name: str) -> bool:
 
 
 def can_be_unintercepted(name: str) -> bool:
+    wrappers = registry.registered_wrappers(name)
+    if wrappers is not None and all(os.path.exists(entry['original'])
+                                    for entry in wrappers.values()):
+        return True
     for path in filter_whereis(name):
         if not is_intercepted(path):
             print('%s is not intercepted' % (path,))
@@ -100,69 +130,185 @@ def abort():
 
 def unintercept_path(path_name: str) -> None:
     src_name = path_name + INTERCEPTED
-    shutil.move(src_name, path_name)
+    # the original is in the same directory, so this replaces the wrapper atomically
+    os.rename(src_name, path_name)
+    registry.unregister(path_name)
     print('Successfully unintercepted %s' % (path_name,))
 
 
 def intercept_path(tool_name: str, file_name: str) -> None:
-    source_file = pkg_resources.resource_filename(__name__, 'templates/cmdline.py')
     target_intercepted = file_name + INTERCEPTED
     previous_chmod = os.stat(file_name).st_mode & 0o777
-    shutil.copy(file_name, target_intercepted)
-    os.unlink(file_name)
-    source_content = read_in_file(source_file, 'utf-8')
-    source_content = source_content.format(EXECUTABLE=sys.executable,
-                                           TOOLNAME=tool_name,
-                                           LOCATION=target_intercepted,
-                                           VERSION=pkg_resources.require('interceptor')[0].version)
-    write_to_file(file_name, source_content, 'utf-8')
-    os.chmod(file_name, previous_chmod)
+    cfg = Configuration(app_name=tool_name).to_json()
+    if os.path.isfile(config_path(tool_name)):
+        with silence_excs(ValueError):
+            cfg = load_config_for(tool_name, None).effective_config()
+    source_content = render_wrapper(tool_name, target_intercepted, cfg)
+    # the original stays in place until the wrapper is renamed over it, so that the tool can
+    # be called at any moment, and a hard link means that even huge binaries aren't copied
+    link_or_copy(file_name, target_intercepted)
+    try:
+        write_wrapper(file_name, source_content, previous_chmod)
+    except BaseException:
+        os.unlink(target_intercepted)
+        raise
+    registry.register(tool_name, file_name, target_intercepted)
     print('Successfully intercepted %s' % (file_name,))
 
 
-def intercept_tool(tool_name: str):
-    if is_partially_intercepted(tool_name):
-        if not FORCE:
-            print(
-                '%s is partially intercepted. Use --force if you want to continue.' % (tool_name,))
-            abort()
-
-    if is_all_intercepted(tool_name):
-        print('%s is completely intercepted.' % (tool_name,))
-        abort()
-
-    for path in filter_whereis(tool_name):
-        if not is_intercepted(path):
-            intercept_path(tool_name, path)
+def _create_missing_config(tool_name: str, rebuild: bool = True) -> None:
+    if not os.path.isfile(config_path(tool_name)):
+        print('Config for %s not found, creating a fresh one' % (tool_name,))
+        if rebuild:
+            Configuration(app_name=tool_name).save()
+        else:
+            write_config_file(config_path(tool_name),
+                              json.dumps(Configuration(app_name=tool_name).to_saved_json(),
+                                         sort_keys=True, indent=4))
+        return
 
     try:
         load_config_for(tool_name, None)
         print('Config for %s already exists' % (tool_name,))
-    except KeyError:
-        print('Config for %s not found, creating a fresh one' % (tool_name,))
-        Configuration(app_name=tool_name).save()
     except ValueError:
         print('Config for %s exists, but is invalid. Usage of %s will be impossible until '
               'this is fixed' % (tool_name, tool_name))
 
 
+def intercept_tool(tool_name: str):
+    paths = list(filter_whereis(tool_name))
+    intercepted = [is_intercepted(path) for path in paths]
+    if all(intercepted):
+        print('%s is completely intercepted.' % (tool_name,))
+        abort()
+    if any(intercepted) and not FORCE:
+        print('%s is partially intercepted. Use --force if you want to continue.' % (tool_name,))
+        abort()
+
+    for path, is_path_intercepted in zip(paths, intercepted):
+        if not is_path_intercepted:
+            intercept_path(tool_name, path)
+
+    _create_missing_config(tool_name)
+
+
+def intercept_tools(tool_names: tp.List[str]) -> None:
+    """
+    Intercept many tools at once, resolving all of them with a single scan of PATH and
+    intercepting their binaries concurrently. Exits with 1 if any of them failed.
+    """
+    found = whereis_many(tool_names)
+    results = {}
+    jobs = []
+    for tool_name in found:
+        paths = found[tool_name]
+        if not paths:
+            results[tool_name] = 'not found'
+            continue
+        intercepted = [is_intercepted(path) for path in paths]
+        if all(intercepted):
+            results[tool_name] = 'already intercepted'
+        elif any(intercepted) and not FORCE:
+            results[tool_name] = 'partially intercepted, use --force to continue'
+        else:
+            jobs.extend((tool_name, path) for path, is_path_intercepted in zip(paths, intercepted)
+                        if not is_path_intercepted)
+
+    failures = collections.defaultdict(list)
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = {executor.submit(intercept_path, tool_name, path): (tool_name, path)
+                   for tool_name, path in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            tool_name, path = futures[future]
+            try:
+                future.result()
+            except (OSError, ValueError) as e:
+                failures[tool_name].append('%s: %s' % (path, e))
+
+    for tool_name in dict.fromkeys(tool_name for tool_name, _ in jobs):
+        if tool_name in failures:
+            results[tool_name] = 'failed, ' + '; '.join(failures[tool_name])
+        else:
+            _create_missing_config(tool_name, rebuild=False)
+            results[tool_name] = 'intercepted'
+    if jobs:
+        rebuild_snapshot()
+
+    print('Summary:')
+    width = max(len(tool_name) for tool_name in found)
+    for tool_name in found:
+        print('  %s  %s' % (tool_name.ljust(width), results[tool_name]))
+    if any(result not in ('intercepted', 'already intercepted') for result in results.values()):
+        sys.exit(1)
+
+
+def shim_tools(tool_names: tp.List[str]) -> None:
+    """
+    Shim the tools, see interceptor.shims. Their binaries are left as they are.
+    """
+    os.makedirs(SHIM_DIR, exist_ok=True)
+    # rewritten every time, so that it follows the Python and the TEMPLATE_VERSION in use
+    write_wrapper(DISPATCHER_PATH, render_dispatcher(), 0o755)
+    if not os.path.isdir(SHIM_INDEX_DIR):
+        # every user gets a directory of their own in it, for their index
+        os.makedirs(SHIM_INDEX_DIR)
+        os.chmod(SHIM_INDEX_DIR, 0o1777)
+    for tool_name in tool_names:
+        path = shims.shim_path(tool_name)
+        tmp_name = os.path.join(SHIM_DIR, '.%s.%s.tmp' % (tool_name, os.getpid()))
+        os.symlink(DISPATCHER_PATH, tmp_name)
+        os.rename(tmp_name, path)
+        _create_missing_config(tool_name, rebuild=False)
+        print('Shimmed %s' % (tool_name,))
+    rebuild_snapshot()
+    print('Put %s in front of PATH for the shims to take effect' % (SHIM_DIR,))
+
+
+def unshim_tools(tool_names: tp.List[str]) -> None:
+    for tool_name in tool_names:
+        try:
+            os.unlink(shims.shim_path(tool_name))
+            print('Unshimmed %s, leaving the configuration in-place' % (tool_name,))
+        except FileNotFoundError:
+            print('%s is not shimmed' % (tool_name,))
+
+
 def unintercept_tool(tool_name: str):
     if not can_be_unintercepted(tool_name):
         if not FORCE:
             print('%s cannot be unintercepted. Use --force to proceed' % (tool_name,))
             abort()
 
-    for path in filter_whereis(tool_name):
-        if is_intercepted(path):
+    wrappers = registry.registered_wrappers(tool_name)
+    if wrappers is not None:
+        for path in wrappers:
             unintercept_path(path)
-        else:
-            print('Skipping on %s' % (path,))
+    else:
+        for path in filter_whereis(tool_name):
+            if is_intercepted(path):
+                unintercept_path(path)
+            else:
+                print('Skipping on %s' % (path,))
     print('Unintercepted %s, leaving the configuration in-place' % (tool_name,))
 
 
 def check(tool_name: str, add_config: bool = False):
-    total_interception = is_all_intercepted(tool_name)
-    partial_interception = is_partially_intercepted(tool_name, True)
+    wrappers = registry.registered_wrappers(tool_name)
+    if wrappers is not None:
+        total_interception, partial_interception = True, False
+        for path, entry in wrappers.items():
+            print('%s is currently intercepted, the original is at %s, template version %s' % (
+                path, entry['original'], entry['template_version']))
+    else:
+        total_interception = is_all_intercepted(tool_name)
+        partial_interception = is_partially_intercepted(tool_name, True)
+    if shims.is_shimmed(tool_name):
+        location, _ = shims.search(tool_name, os.environ.get('PATH', ''))
+        print('%s is shimmed, calls of it resolve to %s' % (
+            tool_name, location or 'nothing, it\'s not in PATH'))
+        if location is not None and total_interception:
+            print('%s is intercepted in place too, the shim calls the original' % (tool_name,))
+        total_interception = True
     if not total_interception and not partial_interception:
         print('%s is not intercepted at all' % (tool_name,))
         sys.exit(0)
@@ -172,7 +318,7 @@ def check(tool_name: str, add_config: bool = False):
 intercept %s --force
 ''' % (tool_name, tool_name))
 
-    cfg_exists = False
+    cfg_exists = created = False
     try:
         cfg = load_config_for(tool_name, None)
         cfg_exists = True
@@ -183,28 +329,181 @@ intercept %s --force
         if add_config:
             print('%s configuration not found, creating a new one' % (tool_name,))
             cfg = Configuration(app_name=tool_name)
-            cfg_exists = True
+            cfg_exists = created = True
     if cfg_exists:
         if os.path.islink(cfg.path):
             target = os.readlink(cfg.path).split('/')[-1]
             print('%s config is a symlink to %s config' % (tool_name, target))
-        cfg.save()
+        try:
+            effective = cfg.effective_config()
+        except ValueError as e:
+            # eg. it extends a profile that's missing, or itself
+            print('%s is misconfigured: %s' % (tool_name, e.args[0]))
+            sys.exit(1)
+        max_concurrency = effective['max_concurrency']
+        if max_concurrency:
+            print('At most %s calls of %s run at once, %s are running now' % (
+                max_concurrency, tool_name, slots_taken(tool_name, max_concurrency)))
+        if effective['trace']:
+            print('Calls of %s are traced into %s' % (tool_name, trace.trace_directory()))
+        policy = describe_resource_policy(effective)
+        if policy:
+            print('Resource policy of %s: %s' % (tool_name, ', '.join(policy)))
+        # a status query only writes a configuration that it created
+        if created:
+            cfg.save()
+
+
+BACKUP_NAME = re.compile(r'^(.+)\.(\d+)$')
+
+
+def _validate_config(name: str) -> tp.Tuple[tp.Optional[str], tp.Optional[dict]]:
+    """
+    Return a tuple of (why the configuration of given name is invalid or None if it's valid,
+    it's effective configuration dictionary if it's valid).
+    """
+    try:
+        with open(config_path(name), 'r', encoding='utf-8') as f_in:
+            cfg = Configuration.from_json(json.load(f_in), app_name=name)
+        effective = cfg.effective_config()
+        compile_rules(effective)
+        validate_resource_policy(effective)
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        return str(e), None
+    return None, effective
+
+
+def _inspect_binary(path: str) -> dict:
+    wrapper = inspect_wrapper(path)
+    if wrapper is None:
+        return {'path': path, 'intercepted': False}
+    return {'path': path, 'intercepted': True,
+            'original_exists': os.path.exists(path + INTERCEPTED),
+            'backend': wrapper['backend'],
+            'template_version': wrapper['template_version'],
+            'stale': wrapper['template_version'] < TEMPLATE_VERSION}
+
+
+def audit() -> dict:
+    """
+    Return the status of every configuration in /etc/interceptor.d and of the binaries of
+    the tools they configure, as a JSON-serializable dictionary.
+
+    All the tools are resolved with a single scan of PATH, and their binaries are read
+    concurrently. Wrappers in the registry are included, even if they are not in PATH, as
+    are the tools that have registered wrappers, but no configuration.
+    """
+    registered = registry.load_registry()
+    names = sorted(set(name for name in os.listdir(CONFIG_DIR) if not name.startswith('.'))
+                   | set(registered))
+    found = whereis_many(names)
+    for name, wrappers in registered.items():
+        found[name].extend(path for path in wrappers if path not in found[name])
+    sources = {name: config_sources(name) for name in names}
+    extended = {base for name in names for base in sources[name][1:]}
+    paths = [path for name in names for path in found[name]]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        binaries = dict(zip(paths, executor.map(_inspect_binary, paths)))
+        validated = dict(zip(names, executor.map(_validate_config, names)))
+    errors = {name: error for name, (error, _) in validated.items()}
+
+    tools = []
+    summary = collections.Counter()
+    for name in names:
+        path = config_path(name)
+        backup_of = BACKUP_NAME.match(name)
+        is_backup = backup_of is not None and backup_of.group(1) in found \
+            and not found[name]
+        tool_binaries = [binaries[binary_path] for binary_path in found[name]]
+        intercepted = [binary['intercepted'] for binary in tool_binaries]
+        if is_backup:
+            status = 'backup'
+        elif not tool_binaries and name in extended:
+            status = 'profile'
+        elif not tool_binaries:
+            status = 'not found'
+        elif all(intercepted):
+            status = 'intercepted'
+        elif any(intercepted):
+            status = 'partially intercepted'
+        elif shims.is_shimmed(name):
+            status = 'shimmed'
+        else:
+            status = 'not intercepted'
+        tool = {'name': name,
+                'status': status,
+                'shimmed': shims.is_shimmed(name),
+                'config_valid': errors[name] is None,
+                'config_error': errors[name],
+                'symlink_to': os.readlink(path) if os.path.islink(path) else None,
+                'extends': sources[name][1:],
+                'in_snapshot': not is_backup and errors[name] is None
+                and read_snapshot_entry(name) is not None,
+                'resource_policy': {key: validated[name][1][key] for key in RESOURCE_KEYS
+                                    if validated[name][1] and validated[name][1][key]},
+                'binaries': tool_binaries}
+        if is_backup:
+            tool['backup_of'] = backup_of.group(1)
+        tool['problems'] = problems = []
+        if errors[name] is not None:
+            problems.append('invalid configuration')
+        if status == 'partially intercepted':
+            problems.append('partially intercepted')
+        if any(binary.get('stale') for binary in tool_binaries):
+            problems.append('stale wrapper')
+        if any(not registry.is_entry_valid(binary_path, entry)
+               for binary_path, entry in registered.get(name, {}).items()):
+            problems.append('registry out of date')
+        if any(binary['intercepted'] and not binary['original_exists']
+               for binary in tool_binaries):
+            problems.append('original binary missing')
+        summary[status] += 1
+        if problems:
+            summary['with problems'] += 1
+        tools.append(tool)
+
+    return {'host': socket.gethostname(),
+            'template_version': TEMPLATE_VERSION,
+            'summary': dict(summary),
+            'tools': tools}
+
+
+def rebuild_registry() -> None:
+    """
+    Reconcile the registry with the binaries, reading every binary of the tools that have
+    a configuration or are registered.
+    """
+    tool_names = set(registry.load_registry())
+    tool_names.update(name for name in os.listdir(CONFIG_DIR)
+                      if not name.startswith('.') and os.path.isfile(config_path(name)))
+    rebuilt = {}
+    for tool_name, paths in whereis_many(sorted(tool_names)).items():
+        for path in paths:
+            if is_intercepted(path) and os.path.exists(path + INTERCEPTED):
+                rebuilt.setdefault(tool_name, {})[path] = registry.make_entry(
+                    path, path + INTERCEPTED, wrapper_template_version(path))
+    registry.replace_registry(rebuilt)
+    print('Registered %s wrappers of %s tools' % (sum(map(len, rebuilt.values())),
+                                                 len(rebuilt)))
 
 
 def link(app_name, target_name, copy=False):
     assert_intercepted(app_name)
     assert_intercepted(target_name)
-    source = os.path.join('/etc/interceptor.d', app_name)
-    target = os.path.join('/etc/interceptor.d', target_name)
+    source = config_path(app_name)
+    target = config_path(target_name)
     if os.path.islink(source) and not FORCE and not copy:
         print('Refusing to link, since %s is already a symlink!' % (app_name,))
         abort()
-    with silence_excs(IOError):
-        os.unlink(target)
+    # create it under a temporary name and rename it over the target, so that the target's
+    # wrapper never finds it's configuration missing
+    tmp_target = os.path.join(CONFIG_DIR, '.%s.%s.tmp' % (target_name, os.getpid()))
     if copy:
-        shutil.copy(source, target)
+        shutil.copy(source, tmp_target)
     else:
-        os.symlink(source, target)
+        os.symlink(source, tmp_target)
+    os.rename(tmp_target, target)
+    rebuild_snapshot()
     if not copy:
         print('Linked %s to read from %s\'s config' % (target_name, app_name))
     else:
@@ -212,9 +511,9 @@ def link(app_name, target_name, copy=False):
 
 
 def assert_etc_interceptor_d_exists():
-    if not os.path.exists('/etc/interceptor.d'):
-        print('/etc/interceptor.d does not exist, creating...')
-        os.mkdir('/etc/interceptor.d')
+    if not os.path.exists(CONFIG_DIR):
+        print('%s does not exist, creating...' % (CONFIG_DIR, ))
+        os.mkdir(CONFIG_DIR)
 
 
 def edit(app_name):
@@ -225,17 +524,20 @@ def edit(app_name):
         if not editor:
             print('Neither nano nor vi were found')
             abort()
-    os.execv(editor[0], [editor[0], os.path.join('/etc/interceptor.d', app_name)])
+    pid = os.fork()
+    if pid == 0:
+        os.execv(editor[0], [editor[0], config_path(app_name)])
+    os.waitpid(pid, 0)
+    rebuild_snapshot()
 
 
 def reset(app_name):
     assert_intercepted(app_name)
-    path = os.path.join('/etc/interceptor.d', app_name)
+    path = config_path(app_name)
     if os.path.islink(path):
         target = os.readlink(path).split('/')[-1]
         print('%s config was previously a symlink to %s' % (app_name, target))
-    os.unlink(path)
-    Configuration(app_name=app_name).save()
+    Configuration(app_name=app_name).save(follow_symlinks=False)
     print('Configuration for %s reset' % (app_name, ))
 
 
@@ -243,13 +545,17 @@ def configure(op_name, app_name, target_name):
     assert_intercepted(app_name)
     cfg = load_config_for(app_name, None)
     if op_name == 'append':
-        cfg.arg_names_to_append.append(target_name)
+        cfg.args_to_append.append(target_name)
     elif op_name == 'prepend':
-        cfg.arg_names_to_prepend.append(target_name)
+        cfg.args_to_prepend.append(target_name)
     elif op_name == 'disable':
-        cfg.arg_names_to_disable.append(target_name)
+        cfg.args_to_disable.append(target_name)
     elif op_name == 'replace':
-        cfg.arg_names_to_replace.append([target_name, sys.target_namev[4]])
+        cfg.args_to_replace.append([target_name, sys.argv[4]])
+    elif op_name == 'disable-matching':
+        cfg.args_to_disable_matching.append(target_name)
+    elif op_name == 'replace-matching':
+        cfg.args_to_replace_matching.append([target_name, sys.argv[4]])
     elif op_name == 'display':
         cfg.display_before_start = True
     elif op_name == 'hide':
@@ -260,7 +566,294 @@ def configure(op_name, app_name, target_name):
         cfg.notify_about_actions = False
     elif op_name == 'log':
         cfg.log = True
+        if not os.path.isdir(LOG_DIR):
+            # wrappers run as whoever calls the tool, and every user logs into a file of their own
+            os.makedirs(LOG_DIR)
+            os.chmod(LOG_DIR, 0o1777)
     elif op_name == 'unlog':
         cfg.log = False
-    cfg.save()
+    elif op_name == 'measure':
+        cfg.metrics = True
+        if not os.path.isdir(METRICS_DIR):
+            # wrappers run as whoever calls the tool
+            os.makedirs(METRICS_DIR)
+            os.chmod(METRICS_DIR, 0o1777)
+    elif op_name == 'unmeasure':
+        cfg.metrics = False
+    elif op_name == 'cache':
+        cfg.compile_cache = True
+        if target_name is not None:
+            cfg.compile_cache_size = int(target_name)
+        if not os.path.isdir(COMPILE_CACHE_DIR):
+            # every user gets a directory of their own in it
+            os.makedirs(COMPILE_CACHE_DIR)
+            os.chmod(COMPILE_CACHE_DIR, 0o1777)
+    elif op_name == 'uncache':
+        cfg.compile_cache = False
+    elif op_name == 'limit':
+        try:
+            cfg.max_concurrency = int(target_name)
+        except (TypeError, ValueError):
+            cfg.max_concurrency = 0
+        if cfg.max_concurrency < 1:
+            print('Give the maximum amount of calls of %s running at once' % (app_name,))
+            abort()
+        if not os.path.isdir(SLOTS_DIR):
+            # wrappers run as whoever calls the tool
+            os.makedirs(SLOTS_DIR)
+            os.chmod(SLOTS_DIR, 0o1777)
+    elif op_name == 'unlimit':
+        cfg.max_concurrency = None
+    elif op_name == 'dispatch':
+        cfg.dispatch_sockets.append(os.path.abspath(target_name))
+    elif op_name == 'undispatch':
+        cfg.dispatch_sockets = []
+    elif op_name == 'memoize':
+        cfg.memoize_probes.append(target_name)
+        if not os.path.isdir(PROBES_DIR):
+            # every user gets a directory of their own in it
+            os.makedirs(PROBES_DIR)
+            os.chmod(PROBES_DIR, 0o1777)
+    elif op_name == 'unmemoize':
+        cfg.memoize_probes = []
+    elif op_name == 'trace':
+        cfg.trace = True
+        if not os.path.isdir(TRACES_DIR):
+            # every user appends to a file of their own in it
+            os.makedirs(TRACES_DIR)
+            os.chmod(TRACES_DIR, 0o1777)
+    elif op_name == 'untrace':
+        cfg.trace = False
+    try:
+        cfg.save()
+    except ValueError as e:
+        print(e.args[0])
+        abort()
     print('Configuration changed')
+
+
+def _median_run_time(args: tp.List[str], rounds: int) -> float:
+    times = []
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started_at)
+    return statistics.median(times)
+
+
+def timing(app_name: str, args: tp.List[str], rounds: int = 20) -> None:
+    """
+    Display how much time does the interception add to a call of app_name with given args.
+    """
+    assert_intercepted(app_name)
+    args = args or ['--version']
+    path = next(path for path in filter_whereis(app_name) if is_intercepted(path))
+
+    bare_interpreter = _median_run_time([sys.executable, '-IS', '-c', 'pass'], rounds)
+    with_runtime = _median_run_time(
+        [sys.executable, '-IS', '-c',
+         'import sys; sys.path.insert(0, %r); import interceptor.runtime' % (PACKAGE_PATH,)],
+        rounds)
+    wrapped = _median_run_time([path, *args], rounds)
+    direct = _median_run_time([path + INTERCEPTED, *args], rounds)
+
+    print('Median times of %s rounds of %s %s:' % (rounds, app_name, ' '.join(args)))
+    print('  interpreter start-up:            %8.2f ms' % (bare_interpreter * 1000,))
+    print('  importing interceptor.runtime:   %8.2f ms' % (
+        (with_runtime - bare_interpreter) * 1000,))
+    print('  through the wrapper:             %8.2f ms' % (wrapped * 1000,))
+    print('  exec of %s directly:' % (os.path.basename(path + INTERCEPTED),))
+    print('                                   %8.2f ms' % (direct * 1000,))
+    print('  interception overhead:           %8.2f ms' % ((wrapped - direct) * 1000,))
+
+
+def _describe_rule(cfg: Configuration, action: int, rule) -> str:
+    if action == DISABLE:
+        if rule < len(cfg.args_to_disable):
+            return 'disable %s' % (cfg.args_to_disable[rule],)
+        return 'disable matching %s' % (
+            cfg.args_to_disable_matching[rule - len(cfg.args_to_disable)],)
+    elif action == REPLACE:
+        if rule < len(cfg.args_to_replace):
+            return 'replace %s with %s' % tuple(cfg.args_to_replace[rule])
+        return 'replace matching %s with %s' % tuple(
+            cfg.args_to_replace_matching[rule - len(cfg.args_to_replace)])
+    elif action == APPEND:
+        return 'append %s' % (rule,)
+    else:
+        return 'prepend %s' % (rule,)
+
+
+def stats(app_name: str, top: int = 10) -> None:
+    """
+    Display statistics of the calls of app_name, read from it's invocation log.
+    """
+    assert_intercepted(app_name)
+    files = log_files(app_name)
+    if not files:
+        print('%s has no invocation log, enable it with intercept log %s' % (app_name, app_name))
+        return
+
+    invocations = 0
+    first_call = last_call = None
+    arguments = collections.Counter()
+    hits = collections.Counter()
+    invalid = []
+    for path in files:
+        for timestamp, _, _, argv, record_hits in read_records(path, invalid):
+            invocations += 1
+            if first_call is None or timestamp < first_call:
+                first_call = timestamp
+            if last_call is None or timestamp > last_call:
+                last_call = timestamp
+            arguments.update(argv[1:])
+            # count a rule once per call, so that the result is a rate
+            hits.update(set(record_hits))
+
+    print('%s was called %s times' % (app_name, invocations))
+    if invocations:
+        print('  between %s and %s' % (time.ctime(first_call),
+                                       time.ctime(last_call)))
+    if invalid:
+        print('  %s bytes of the logs could not be read' % (sum(invalid),))
+    if arguments:
+        print('Top arguments:')
+        for arg, count in arguments.most_common(top):
+            print('  %8s  %s' % (count, arg))
+
+    cfg = Configuration.from_json(load_effective_config(app_name), app_name)
+    if hits:
+        print('Rule hits:')
+        for (action, rule), count in sorted(hits.items(), key=lambda item: -item[1]):
+            try:
+                description = _describe_rule(cfg, action, rule)
+            except (IndexError, TypeError):
+                description = 'a rule that is no longer configured'
+            print('  %8s  %5.1f%%  %s' % (count, 100 * count / invocations, description))
+
+
+def export_metrics(output_path: tp.Optional[str] = None) -> None:
+    """
+    Print the metrics of all tools in the Prometheus text format, or write them atomically
+    to output_path, eg. in node_exporter's textfile collector directory.
+    """
+    text = metrics.render(metrics.collect())
+    if output_path is None:
+        sys.stdout.write(text)
+        return
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(output_path)),
+                            '.%s.%s.tmp' % (os.path.basename(output_path), os.getpid()))
+    with open(tmp_path, 'w', encoding='utf-8') as f_out:
+        f_out.write(text)
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, output_path)
+
+
+def export_trace(output_path: tp.Optional[str] = None) -> None:
+    """
+    Merge the traced calls into a Chrome trace, written atomically to output_path (by default
+    trace.json), and print their summary per tool.
+    """
+    directory = trace.trace_directory()
+    calls = trace.read_calls(directory)
+    if not calls:
+        print('No calls were traced into %s' % (directory,))
+        return
+    output_path = output_path or 'trace.json'
+    chrome_trace = trace.to_chrome_trace(calls)
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(output_path)),
+                            '.%s.%s.tmp' % (os.path.basename(output_path), os.getpid()))
+    with open(tmp_path, 'w', encoding='utf-8') as f_out:
+        json.dump(chrome_trace, f_out)
+    os.rename(tmp_path, output_path)
+
+    summary = chrome_trace['otherData']['summary']
+    print('Wrote %s calls to %s' % (len(calls), output_path))
+    print('Wall time %.2f s, of which %.2f s idle, %.1f calls running on average, '
+          'at most %s' % (summary['wall_time'], summary['idle_time'],
+                          summary['average_concurrency'], summary['peak_concurrency']))
+    tools = sorted(summary['tools'].items(), key=lambda item: -item[1]['critical_time'])
+    width = max(len('tool'), *(len(name) for name, _ in tools))
+    print('%s  %8s  %6s  %10s  %10s  %10s  %4s' % ('tool'.ljust(width), 'calls', 'failed',
+                                                   'total', 'busy', 'critical', 'peak'))
+    for name, tool in tools:
+        print('%s  %8s  %6s  %9.2fs  %9.2fs  %9.2fs  %4s' % (
+            name.ljust(width), tool['calls'], tool['failed'], tool['total_time'],
+            tool['busy_time'], tool['critical_time'], tool['peak_concurrency']))
+
+
+def clear_trace() -> None:
+    directory = trace.trace_directory()
+    removed = 0
+    with silence_excs(FileNotFoundError):
+        for name in os.listdir(directory):
+            if name.endswith('.jsonl'):
+                with silence_excs(FileNotFoundError, PermissionError):
+                    os.unlink(os.path.join(directory, name))
+                    removed += 1
+    print('Removed %s trace files from %s' % (removed, directory))
+
+
+def cache_stats() -> None:
+    """
+    Display the hits, misses and sizes of the compile caches of all users, in the default
+    cache directory and in these configured for any tool.
+    """
+    directories = {COMPILE_CACHE_DIR}
+    for name in os.listdir(CONFIG_DIR):
+        if name.startswith('.') or not os.path.isfile(config_path(name)):
+            continue
+        try:
+            directory = flatten_config(name)[0]['compile_cache_directory']
+        except ValueError:
+            continue
+        if directory:
+            directories.add(directory)
+
+    found = False
+    for directory in sorted(directories):
+        for uid, counters in cache.collect_stats(directory).items():
+            found = True
+            lookups = counters['hits'] + counters['misses']
+            print('%s (uid %s): %s hits, %s misses (%.1f%% hit rate), %s failed, '
+                  '%s uncacheable, %s evicted, %.1f MiB' % (
+                    os.path.join(directory, uid), uid, counters['hits'], counters['misses'],
+                    100 * counters['hits'] / lookups if lookups else 0, counters['failed'],
+                    counters['uncacheable'], counters['evicted'], counters['size'] / 1048576))
+    if not found:
+        print('No compile cache was used yet')
+
+
+def apply_to_compilation_database(app_name: str, input_path: str,
+                                  output_path: tp.Optional[str] = None) -> None:
+    """
+    Rewrite the entries of app_name in a compilation database with it's rules.
+    """
+    cfg = load_effective_config(app_name)
+    try:
+        count, rewritten = rewrite_compilation_database(cfg, app_name, input_path, output_path)
+    except (OSError, ValueError) as e:
+        print(e)
+        abort()
+    print('Rewrote %s of %s entries of %s' % (rewritten, count, output_path or input_path))
+
+
+def clear_probes(app_name: str) -> None:
+    removed = probes.clear(app_name)
+    print('Forgot the probes of %s of %s users' % (app_name, removed))
+
+
+def set_backend(app_name: str, backend: str) -> None:
+    assert_intercepted(app_name)
+    if backend not in BACKENDS:
+        print('Unknown backend %s, choose one of: %s' % (backend, ', '.join(BACKENDS)))
+        abort()
+    cfg = load_config_for(app_name, None)
+    cfg.wrapper_backend = backend
+    cfg.save()
+    refresh_wrappers({app_name: cfg.effective_config()})
+    if backend == 'sh' and not all(is_sh_wrapper(path) for path in filter_whereis(app_name)):
+        print('%s\'s configuration can\'t be expressed by the sh backend, '
+              'the Python wrapper is used instead' % (app_name,))
+    print('%s will use the %s backend' % (app_name, backend))
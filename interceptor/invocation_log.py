@@ -0,0 +1,154 @@
+"""
+The invocation log, kept for tools with log enabled.
+
+Every call appends a single record to LOG_DIR/<tool>.<uid>. Each user appends to a log of their
+own, created as 0644 and written to only if the user owns it, so that the first user to log
+a call does not lock the others out, and only logs owned by the user that their name says,
+and writable by nobody else, are read. A record is RECORD_MAGIC, the length
+of the payload as 4 bytes little-endian and the payload, which is a marshalled tuple of:
+
+* time of the call, as returned by time.time()
+* pid of the wrapper (which is the pid of the tool, since it's exec'd)
+* current working directory
+* the rewritten command line, including argv[0]
+* rules that were hit, as a tuple of (action, rule index), see interceptor.rules. Appends and
+  prepends are given by their argument instead of the index.
+
+A record is written with a single write() to a descriptor opened with O_APPEND, so records of
+concurrent calls never interleave. Once the log grows past MAX_LOG_SIZE, it's renamed to
+<tool>.<uid>.1 (and older ones to <tool>.<uid>.2 and so on, up to BACKUP_COUNT), and a new one
+is started.
+
+Writing is imported by the generated wrappers, so this module imports only os and marshal
+at the top.
+"""
+import marshal
+import os
+
+from interceptor.paths import LOG_DIR
+
+RECORD_MAGIC = b'\xa5I'
+HEADER_SIZE = len(RECORD_MAGIC) + 4
+MAX_LOG_SIZE = 16 * 1024 * 1024
+BACKUP_COUNT = 3
+READ_SIZE = 65536
+
+
+def log_path(tool_name: str, uid: int = None) -> str:
+    return os.path.join(LOG_DIR, '%s.%s' % (tool_name, os.getuid() if uid is None else uid))
+
+
+def encode_record(timestamp: float, pid: int, cwd: str, argv: list, hits: tuple) -> bytes:
+    payload = marshal.dumps((timestamp, pid, cwd, argv, hits))
+    return RECORD_MAGIC + len(payload).to_bytes(4, 'little') + payload
+
+
+def write_record(tool_name: str, argv: list, hits: tuple) -> None:
+    """
+    Append a record of a call to the tool's log, rotating it if it grew too large.
+
+    :param tool_name: name of the intercepted tool
+    :param argv: the rewritten command line, including argv[0]
+    :param hits: tuple of (action, rule index or argument) of the rules that were hit
+    """
+    import time
+    try:
+        cwd = os.getcwd()
+    except OSError:
+        cwd = None
+    record = encode_record(time.time(), os.getpid(), cwd, argv, hits)
+    path = log_path(tool_name)
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC | os.O_NOFOLLOW
+    try:
+        fd = os.open(path, flags, 0o644)
+    except FileNotFoundError:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        fd = os.open(path, flags, 0o644)
+    try:
+        # one planted by someone else would not be read anyway
+        if os.fstat(fd).st_uid != os.getuid():
+            return
+        os.write(fd, record)
+        if os.fstat(fd).st_size >= MAX_LOG_SIZE:
+            _rotate(path, fd)
+    finally:
+        os.close(fd)
+
+
+def _rotate(path: str, fd: int) -> None:
+    import fcntl
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # someone else is rotating it right now
+        return
+    try:
+        # it might have been rotated already, between our write and taking the lock
+        if os.stat(path).st_ino != os.fstat(fd).st_ino:
+            return
+    except FileNotFoundError:
+        return
+    for i in range(BACKUP_COUNT - 1, 0, -1):
+        try:
+            os.rename('%s.%s' % (path, i), '%s.%s' % (path, i + 1))
+        except FileNotFoundError:
+            pass
+    os.rename(path, path + '.1')
+
+
+def log_files(tool_name: str) -> list:
+    """
+    Return the existing log files of given tool, of all users, oldest first for each of them.
+    """
+    import stat
+    try:
+        names = os.listdir(LOG_DIR)
+    except FileNotFoundError:
+        return []
+    prefix = tool_name + '.'
+    uids = set()
+    for name in names:
+        uid = name[len(prefix):].split('.')[0]
+        if name.startswith(prefix) and uid.isdigit():
+            uids.add(int(uid))
+    files = []
+    for uid in sorted(uids):
+        path = log_path(tool_name, uid)
+        for candidate in ['%s.%s' % (path, i) for i in range(BACKUP_COUNT, 0, -1)] + [path]:
+            try:
+                st = os.lstat(candidate)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_uid == uid and not st.st_mode & 0o022:
+                files.append(candidate)
+    return files
+
+
+def read_records(path: str, invalid: list = None):
+    """
+    Iterate over the records of a log file, as tuples, reading it in a streaming fashion.
+
+    Reading stops at the first thing that's not a valid record, eg. a log written by an older
+    version of interceptor.
+
+    :param path: path to the log file
+    :param invalid: if given, the amount of bytes that could not be read will be appended
+    """
+    size = os.path.getsize(path)
+    position = 0
+    with open(path, 'rb', buffering=READ_SIZE) as f_in:
+        while True:
+            header = f_in.read(HEADER_SIZE)
+            if not header:
+                break
+            length = int.from_bytes(header[len(RECORD_MAGIC):], 'little')
+            if len(header) < HEADER_SIZE or not header.startswith(RECORD_MAGIC) \
+                    or position + HEADER_SIZE + length > size:
+                break
+            try:
+                yield marshal.loads(f_in.read(length))
+            except (EOFError, ValueError, TypeError):
+                break
+            position += HEADER_SIZE + length
+    if invalid is not None and position < size:
+        invalid.append(size - position)
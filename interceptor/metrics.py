@@ -0,0 +1,251 @@
+"""
+Metrics of the overhead that the wrappers add to every call.
+
+With metrics enabled for a tool, the wrapper measures how long each phase of it took and
+appends a fixed-size record to METRICS_DIR/<tool>.<uid>.v<RECORDS_VERSION>, with a single
+write() to a descriptor opened with O_APPEND, so that no locking is needed and it costs a few
+microseconds. Each user appends to a file of their own, created as 0644, and only files owned
+by the user that their name says, and writable by nobody else, are read, so users can't forge
+each other's metrics. A record is len(PHASES) times the amount of microseconds, as 4 bytes
+little-endian:
+
+* startup - CPU time of the process until the wrapper started running, ie. starting the
+  interpreter and importing the runtime
+* load - reading the configuration
+* modify - rewriting the command line
+* wait - waiting for a free slot, if the tool's max_concurrency is set (see interceptor.slots)
+* total - all of the above but waiting, plus everything else done before the tool is exec'd
+
+RECORDS_VERSION is bumped whenever the records change, so that files of records of another
+version are left alone rather than misread.
+
+intercept metrics folds the new records into per-file histograms, kept in
+METRICS_DIR/.<name of the file>.<uid of the caller>.state, and renders them summed up per tool
+in the Prometheus text format, as read by node_exporter's textfile collector. Once a tool's
+records grow past COMPACT_SIZE, they are renamed away and removed after the next fold, so that
+a record written by a wrapper that opened the file right before it was renamed is not lost.
+
+Recording is imported by the generated wrappers, so this module imports only os at the top.
+"""
+import os
+
+from interceptor.paths import METRICS_DIR
+
+# bump whenever PHASES or FIELD_SIZE change
+RECORDS_VERSION = 2
+PHASES = ('startup', 'load', 'modify', 'wait', 'total')
+FIELD_SIZE = 4
+RECORD_SIZE = FIELD_SIZE * len(PHASES)
+MAX_FIELD_VALUE = 2 ** (8 * FIELD_SIZE) - 1
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0)
+COMPACT_SIZE = RECORD_SIZE * 65536
+METRIC_NAME = 'interceptor_wrapper_phase_seconds'
+
+
+def metrics_path(tool_name: str, uid: int = None) -> str:
+    return os.path.join(METRICS_DIR, '%s.%s.v%s' % (tool_name, os.getuid() if uid is None else uid,
+                                                    RECORDS_VERSION))
+
+
+def parse_metrics_name(name: str):
+    """
+    :return: a tuple of (tool name, uid) for the name of a records file of RECORDS_VERSION,
+        or None if it's not one
+    """
+    rest, _, version = name.rpartition('.')
+    tool_name, _, uid = rest.rpartition('.')
+    if name.startswith('.') or not tool_name or not uid.isdigit() or \
+            version != 'v%s' % (RECORDS_VERSION,):
+        return None
+    return tool_name, int(uid)
+
+
+def record_call(tool_name: str, phases: tuple) -> None:
+    """
+    Append a record of a call to the tool's metrics.
+
+    :param tool_name: name of the intercepted tool
+    :param phases: duration of each of PHASES, in seconds
+    """
+    record = b''.join(min(int(phase * 1000000), MAX_FIELD_VALUE).to_bytes(FIELD_SIZE, 'little')
+                      for phase in phases)
+    path = metrics_path(tool_name)
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC | os.O_NOFOLLOW
+    try:
+        fd = os.open(path, flags, 0o644)
+    except FileNotFoundError:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        fd = os.open(path, flags, 0o644)
+    try:
+        # one planted by someone else would not be read anyway
+        if os.fstat(fd).st_uid == os.getuid():
+            os.write(fd, record)
+    finally:
+        os.close(fd)
+
+
+def _empty_state() -> dict:
+    return {'offset': 0, 'inode': None, 'old_offset': None, 'count': 0,
+            'sums': [0] * len(PHASES),
+            'buckets': [[0] * len(BUCKETS) for _ in PHASES]}
+
+
+def _state_path(name: str) -> str:
+    # whoever runs intercept metrics keeps states of their own
+    return os.path.join(METRICS_DIR, '.%s.%s.state' % (name, os.getuid()))
+
+
+def _old_path(name: str) -> str:
+    return os.path.join(METRICS_DIR, '.%s.old' % (name,))
+
+
+def _is_owned_by(st: os.stat_result, uid: int) -> bool:
+    """
+    Is it a regular file owned by uid and writable by nobody else?
+    """
+    import stat
+    return stat.S_ISREG(st.st_mode) and st.st_uid == uid and not st.st_mode & 0o022
+
+
+def _load_state(name: str) -> dict:
+    import marshal
+    try:
+        with open(_state_path(name), 'rb') as f_in:
+            if not _is_owned_by(os.fstat(f_in.fileno()), os.getuid()):
+                return _empty_state()
+            state = marshal.load(f_in)
+        if len(state['sums']) == len(PHASES) and len(state['buckets'][0]) == len(BUCKETS):
+            return state
+    except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError):
+        pass
+    return _empty_state()
+
+
+def _save_state(name: str, state: dict) -> None:
+    import marshal
+    path = _state_path(name)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f_out:
+        marshal.dump(state, f_out)
+    os.rename(tmp_path, path)
+
+
+def _fold_file(path: str, offset: int, state: dict) -> int:
+    """
+    Fold the complete records of a file, starting at offset, into the state.
+
+    :return: offset of the first record that was not folded
+    """
+    import bisect
+    thresholds = [int(bound * 1000000) for bound in BUCKETS]
+    sums = state['sums']
+    buckets = state['buckets']
+    with open(path, 'rb') as f_in:
+        f_in.seek(offset)
+        while True:
+            data = f_in.read(RECORD_SIZE * 4096)
+            whole = len(data) - len(data) % RECORD_SIZE
+            for start in range(0, whole, RECORD_SIZE):
+                for phase in range(len(PHASES)):
+                    position = start + phase * FIELD_SIZE
+                    value = int.from_bytes(data[position:position + FIELD_SIZE], 'little')
+                    sums[phase] += value
+                    bucket = bisect.bisect_left(thresholds, value)
+                    if bucket < len(thresholds):
+                        buckets[phase][bucket] += 1
+            state['count'] += whole // RECORD_SIZE
+            offset += whole
+            if whole != len(data) or not data:
+                # a partially written record will be read next time
+                return offset
+
+
+def fold(name: str) -> dict:
+    """
+    Fold the new records of a file, named <tool>.<uid>.v<RECORDS_VERSION>, into it's histograms
+    and return them.
+
+    The caller must hold the lock, see collect().
+    """
+    uid = parse_metrics_name(name)[1]
+    state = _load_state(name)
+    old_path = _old_path(name)
+    if state['old_offset'] is not None:
+        # the records were renamed away during the previous fold, late writers are done by now
+        try:
+            _fold_file(old_path, state['old_offset'], state)
+            os.unlink(old_path)
+        except FileNotFoundError:
+            pass
+        state['old_offset'] = None
+
+    path = os.path.join(METRICS_DIR, name)
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        _save_state(name, state)
+        return state
+    if not _is_owned_by(st, uid):
+        return state
+    if st.st_ino != state['inode'] or st.st_size < state['offset']:
+        state['inode'], state['offset'] = st.st_ino, 0
+    state['offset'] = _fold_file(path, state['offset'], state)
+    if state['offset'] >= COMPACT_SIZE and os.getuid() in (0, uid):
+        os.rename(path, old_path)
+        state['old_offset'], state['inode'], state['offset'] = state['offset'], None, 0
+    _save_state(name, state)
+    return state
+
+
+def collect() -> dict:
+    """
+    Fold the records of all tools and return a dictionary of tool name to it's state, summed
+    up over the users.
+    """
+    import fcntl
+    if not os.path.isdir(METRICS_DIR):
+        return {}
+    states = {}
+    lock_path = os.path.join(METRICS_DIR, '.lock.%s' % (os.getuid(),))
+    with open(lock_path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for name in sorted(os.listdir(METRICS_DIR)):
+            parsed = parse_metrics_name(name)
+            if parsed is None:
+                continue
+            state = fold(name)
+            total = states.setdefault(parsed[0], _empty_state())
+            total['count'] += state['count']
+            for i in range(len(PHASES)):
+                total['sums'][i] += state['sums'][i]
+                for j in range(len(BUCKETS)):
+                    total['buckets'][i][j] += state['buckets'][i][j]
+    return states
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(states: dict) -> str:
+    """
+    Render the histograms in the Prometheus text exposition format.
+
+    :param states: as returned by collect()
+    """
+    lines = ['# HELP %s Time that interceptor\'s wrapper spent in each phase of a call.' % (
+                 METRIC_NAME,),
+             '# TYPE %s histogram' % (METRIC_NAME,)]
+    for tool_name, state in states.items():
+        for i, phase in enumerate(PHASES):
+            labels = 'tool="%s",phase="%s"' % (_escape_label(tool_name), phase)
+            cumulative = 0
+            for bound, count in zip(BUCKETS, state['buckets'][i]):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %s' % (METRIC_NAME, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %s' % (METRIC_NAME, labels, state['count']))
+            lines.append('%s_sum{%s} %s' % (METRIC_NAME, labels, state['sums'][i] / 1000000))
+            lines.append('%s_count{%s} %s' % (METRIC_NAME, labels, state['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,50 @@
+"""
+Locations of everything interceptor keeps on disk.
+
+This module is imported by the generated wrappers, so it must not import anything but os.
+"""
+import os
+
+CONFIG_DIR = '/etc/interceptor.d'
+SNAPSHOT_PATH = os.path.join(CONFIG_DIR, '.snapshot')
+LOG_DIR = '/var/log/interceptor.d'
+STATE_DIR = '/var/lib/interceptor'
+METRICS_DIR = os.path.join(STATE_DIR, 'metrics')
+REGISTRY_PATH = os.path.join(STATE_DIR, 'registry.json')
+SLOTS_DIR = os.path.join(STATE_DIR, 'slots')
+# the default, a build can trace into a directory of it's own, see interceptor.trace
+TRACES_DIR = os.path.join(STATE_DIR, 'traces')
+CACHE_DIR = '/var/cache/interceptor'
+COMPILE_CACHE_DIR = os.path.join(CACHE_DIR, 'compile')
+PROBES_DIR = os.path.join(CACHE_DIR, 'probes')
+SHIM_INDEX_DIR = os.path.join(CACHE_DIR, 'shims')
+# the shim directory mode, see interceptor.shims
+DISPATCHER_PATH = '/usr/local/lib/interceptor/dispatcher'
+SHIM_DIR = '/usr/local/lib/interceptor/shims'
+
+# suffix of the name under which the original binary of an intercepted tool is kept
+INTERCEPTED = '-intercepted'
+
+
+def config_path(name: str) -> str:
+    return os.path.join(CONFIG_DIR, name)
+
+
+def user_directory(parent: str):
+    """
+    Return the directory of the current user in a directory shared by all users, creating it
+    as 0700 if it's missing.
+
+    :return: the path, or None if it can't be created, or it's not a directory owned by the user
+        and writable by nobody else, eg. one planted by another user
+    """
+    import stat
+    path = os.path.join(parent, str(os.getuid()))
+    try:
+        os.makedirs(path, 0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        return None
+    return path
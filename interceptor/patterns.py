@@ -0,0 +1,345 @@
+"""
+Pattern rules, matching arguments by prefix, glob or regular expression.
+
+Patterns are given as strings of kind:pattern, eg.:
+
+* prefix:-march= - matches every argument starting with -march=
+* glob:-W* - matches arguments against a shell-style wildcard
+* regex:-O[0-3] - matches arguments against a regular expression, which has to match
+  the whole argument
+
+All the patterns of a kind of rule are compiled into a single matcher, a trie of the prefixes.
+Globs and regexes are placed in the trie at their literal prefix, eg. -march= for glob:-march=*,
+and the ones that share a node are combined into a single alternation. Matching an argument
+walks the trie once and tries only the alternations found along the way, so patterns whose
+literal prefix the argument does not start with cost nothing. Patterns without a literal prefix,
+eg. regex:(-O1|-g), sit at the root and are tried on every argument, so keep them few. The
+compiled matcher contains only marshallable types, keeping the alternations as their source,
+each compiled when an argument first gets to it, so that wrappers that don't get that far don't
+import re at all.
+
+Replacing with a pattern works as follows:
+
+* for prefixes, the prefix is replaced with the replacement
+* for globs and regexes, the whole argument is replaced with the replacement, in which
+  \\0 to \\99 and \\g<N> refer to the groups of the match (0 being the whole argument)
+
+The first pattern (in order given) that matches wins. Regexes may not contain named groups or
+backreferences, since they are combined with the others.
+
+This module is imported by the generated wrappers, so the compiling part imports what it needs
+by itself.
+"""
+KINDS = ('prefix', 'glob', 'regex')
+TRIE_TERMINAL = ''
+# a trie node maps this to the number of the bucket of globs and regexes with that literal prefix
+TRIE_PATTERNS = 0
+GLOB_SPECIALS = '*?['
+REGEX_SPECIALS = '.^$*+?{}[]\\|()'
+QUANTIFIERS = '*+?{'
+
+
+def parse_pattern(spec: str) -> tuple:
+    """
+    Split a kind:pattern string into a tuple of (kind, pattern).
+
+    :raises ValueError: invalid kind
+    """
+    kind, sep, pattern = spec.partition(':')
+    if not sep or kind not in KINDS:
+        raise ValueError('Invalid pattern %s, expected one of %s followed by a colon' % (
+            spec, ', '.join(KINDS)))
+    return kind, pattern
+
+
+class PatternMatcher:
+    """
+    A compiled set of disable patterns and replace patterns.
+
+    Use compile_patterns() or PatternMatcher.from_tables() to obtain one.
+    """
+    __slots__ = ('disable_trie', 'disable_buckets', 'disable_regexes', 'replace_trie',
+                 'replace_buckets', 'replace_regexes', 'replace_rules', 'tables')
+
+    def __init__(self, disable_trie: dict, disable_buckets: tuple, replace_trie: dict,
+                 replace_buckets: tuple, replace_rules: tuple):
+        self.tables = (disable_trie, disable_buckets, replace_trie, replace_buckets,
+                       replace_rules)
+        # prefix trie, nested dictionaries of a character to the next node. A node that ends
+        # a prefix maps TRIE_TERMINAL to the index of the rule, a node that is the literal
+        # prefix of globs or regexes maps TRIE_PATTERNS to the number of their bucket.
+        self.disable_trie = disable_trie
+        # number of the bucket -> (source of the alternation, number of the group wrapping
+        # a rule's regex -> index of the rule)
+        self.disable_buckets = disable_buckets
+        # number of the bucket -> the compiled alternation, once it's needed
+        self.disable_regexes = [None] * len(disable_buckets)
+        self.replace_trie = replace_trie
+        self.replace_buckets = replace_buckets
+        self.replace_regexes = [None] * len(replace_buckets)
+        # index of the rule -> (pattern spec, length of the prefix, replacement, template),
+        # where template is None for prefixes, else a tuple of strings and group numbers
+        # (already offset)
+        self.replace_rules = replace_rules
+
+    def to_tables(self) -> tuple:
+        return self.tables
+
+    @classmethod
+    def from_tables(cls, tables: tuple) -> 'PatternMatcher':
+        return cls(*tables)
+
+    def disabling_rule(self, arg: str):
+        """
+        Return the index of the first disable pattern that matches the argument, or None
+        """
+        found = _first_match(self.disable_trie, self.disable_buckets, self.disable_regexes, arg)
+        return None if found is None else found[0]
+
+    def replacement(self, arg: str):
+        """
+        Return a tuple of (index of the rule, what to replace the argument with) for the first
+        replace pattern that matches the argument, or None
+        """
+        found = _first_match(self.replace_trie, self.replace_buckets, self.replace_regexes, arg)
+        if found is None:
+            return None
+        index, match = found
+        _, prefix_length, replacement, template = self.replace_rules[index]
+        if match is None:
+            return index, replacement + arg[prefix_length:]
+        return index, ''.join(part if part.__class__ is str else (match.group(part) or '')
+                              for part in template)
+
+
+def _first_match(trie: dict, buckets: tuple, regexes: list, arg: str):
+    """
+    Walk the trie along the argument, trying the buckets on the way.
+
+    :return: a tuple of (lowest index of a rule that matches, the match, or None if that rule
+        is a prefix), or None
+    """
+    found = None
+    node = trie
+    position = 0
+    while True:
+        index = node.get(TRIE_TERMINAL)
+        if index is not None and (found is None or index < found[0]):
+            found = index, None
+        bucket = node.get(TRIE_PATTERNS)
+        if bucket is not None:
+            regex = regexes[bucket]
+            if regex is None:
+                regex = regexes[bucket] = _compile(buckets[bucket][0])
+            match = regex.fullmatch(arg)
+            if match is not None:
+                index = buckets[bucket][1][match.lastindex]
+                if found is None or index < found[0]:
+                    found = index, match
+        if position == len(arg):
+            return found
+        node = node.get(arg[position])
+        if node is None:
+            return found
+        position += 1
+
+
+def _compile(source: str):
+    import re
+    return re.compile(source)
+
+
+def _has_backreference(pattern: str) -> bool:
+    """
+    Does the regular expression refer to a group, by \\N or (?(N)...)? Escaped backslashes and
+    character classes, in which neither means a group, are skipped.
+    """
+    import re
+    return re.search(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\()', _strip_classes(pattern)) is not None
+
+
+def _strip_classes(pattern: str) -> str:
+    """
+    Remove the character classes, eg. [\\1], from a regular expression.
+    """
+    result = []
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        if char == '\\':
+            result.append(pattern[position:position + 2])
+            position += 2
+        elif char == '[':
+            position += 1
+            # a ] right after [ or [^ is a literal
+            if pattern[position:position + 1] == '^':
+                position += 1
+            if pattern[position:position + 1] == ']':
+                position += 1
+            while position < len(pattern) and pattern[position] != ']':
+                position += 2 if pattern[position] == '\\' else 1
+            position += 1
+        else:
+            result.append(char)
+            position += 1
+    return ''.join(result)
+
+
+def _pattern_regex(kind: str, pattern: str) -> str:
+    """
+    Return the source of a regular expression matching what given glob or regex matches.
+
+    :raises ValueError: the regex is invalid or can't be combined with others
+    """
+    import re
+    if kind == 'glob':
+        import fnmatch
+        return fnmatch.translate(pattern)
+    try:
+        compiled = re.compile(pattern)
+    except re.error as e:
+        raise ValueError('Invalid regular expression %s: %s' % (pattern, e))
+    if compiled.groupindex or _has_backreference(pattern):
+        raise ValueError('Regular expression %s may not contain named groups '
+                         'or backreferences' % (pattern,))
+    return '(?:%s)' % (pattern,)
+
+
+def _parse_template(template: str, offset: int, groups: int) -> tuple:
+    """
+    Parse a replacement template into a tuple of strings and (offset) group numbers.
+    """
+    import re
+    parts = []
+    position = 0
+    for match in re.finditer(r'\\(?:(\d{1,2})|g<(\d+)>|(\\))', template):
+        parts.append(template[position:match.start()])
+        position = match.end()
+        if match.group(3):
+            parts.append('\\')
+            continue
+        group = int(match.group(1) or match.group(2))
+        if group > groups:
+            raise ValueError('Replacement %s refers to group %s, but the pattern has only %s' % (
+                template, group, groups))
+        parts.append(offset + group)
+    parts.append(template[position:])
+    return tuple(part for part in parts if part != '')
+
+
+def _literal_prefix(kind: str, pattern: str) -> str:
+    """
+    Return what every argument matched by given glob or regex has to start with.
+
+    For regexes this is conservative: it stops at the first character that isn't a literal,
+    drops a literal that is quantified and is empty if there's an alternation at the top level.
+    """
+    if kind == 'glob':
+        for position, char in enumerate(pattern):
+            if char in GLOB_SPECIALS:
+                return pattern[:position]
+        return pattern
+
+    depth = 0
+    stripped = _strip_classes(pattern)
+    position = 0
+    while position < len(stripped):
+        char = stripped[position]
+        if char == '\\':
+            position += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return ''
+        position += 1
+
+    prefix = []
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        if char == '\\':
+            char = pattern[position + 1:position + 2]
+            # \d, \b, \1 and the like aren't literals, escaped punctuation is
+            if not char or (char.isascii() and char.isalnum()):
+                break
+            length = 2
+        elif char in REGEX_SPECIALS:
+            break
+        else:
+            length = 1
+        quantifier = pattern[position + length:position + length + 1]
+        if quantifier and quantifier in QUANTIFIERS:
+            break
+        prefix.append(char)
+        position += length
+    return ''.join(prefix)
+
+
+def _compile_kind(rules: list, with_templates: bool) -> tuple:
+    """
+    Compile a list of (pattern spec, replacement) into a trie, a tuple of buckets and a tuple
+    of rules.
+    """
+    import re
+    trie = {}
+    # number of the bucket -> list of (index of the rule, source, number of groups in it)
+    bucket_rules = []
+    replace_rules = []
+    for index, (spec, replacement) in enumerate(rules):
+        kind, pattern = parse_pattern(spec)
+        replace_rules.append((spec, len(pattern), replacement, None))
+        node = trie
+        if kind == 'prefix':
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node.setdefault(TRIE_TERMINAL, index)
+            continue
+        source = _pattern_regex(kind, pattern)
+        for char in _literal_prefix(kind, pattern):
+            node = node.setdefault(char, {})
+        if TRIE_PATTERNS not in node:
+            node[TRIE_PATTERNS] = len(bucket_rules)
+            bucket_rules.append([])
+        bucket_rules[node[TRIE_PATTERNS]].append((index, source, re.compile(source).groups))
+
+    buckets = []
+    for members in bucket_rules:
+        sources = []
+        groups = {}
+        group_number = 1
+        for index, source, inner_groups in members:
+            sources.append('(%s)' % (source,))
+            groups[group_number] = index
+            if with_templates:
+                spec, prefix_length, replacement, _ = replace_rules[index]
+                replace_rules[index] = spec, prefix_length, replacement, _parse_template(
+                    replacement, group_number, inner_groups)
+            group_number += 1 + inner_groups
+        regex = '|'.join(sources)
+        try:
+            re.compile(regex)
+        except re.error as e:
+            raise ValueError('Patterns can\'t be combined: %s' % (e,))
+        buckets.append((regex, groups))
+    return trie, tuple(buckets), tuple(replace_rules)
+
+
+def compile_patterns(disable_patterns: list, replace_patterns: list):
+    """
+    Compile the patterns of a configuration.
+
+    :param disable_patterns: list of pattern specs to disable
+    :param replace_patterns: list of (pattern spec, replacement)
+    :return: a PatternMatcher, or None if there are no patterns at all
+    :raises ValueError: a pattern is invalid
+    """
+    if not disable_patterns and not replace_patterns:
+        return None
+    disable_trie, disable_buckets, _ = _compile_kind(
+        [(spec, None) for spec in disable_patterns], False)
+    replace_trie, replace_buckets, replace_rules = _compile_kind(
+        [(spec, replacement) for spec, replacement in replace_patterns], True)
+    return PatternMatcher(disable_trie, disable_buckets, replace_trie, replace_buckets,
+                          replace_rules)
@@ -0,0 +1,145 @@
+"""
+Memoizing probes, calls that only tell something about the tool, eg. gcc --version,
+-dumpmachine or -print-search-dirs.
+
+Configure scripts and CMake make such calls hundreds of times per build. If every argument
+of a call matches one of the tool's memoize_probes patterns, the wrapper looks the call up
+among the results of the previous ones. These are keyed by the rewritten command line, the
+inode, mtime and size of the intercepted binary and a few environment variables that
+may change the answer. A result younger than memoize_ttl seconds is answered with, without
+running the tool at all. Otherwise the tool is run, it's stdout, stderr and exit code are
+remembered and passed on.
+
+Probes get /dev/null as stdin, since their answer must not depend on it.
+
+The results of a tool are kept in a single file per user, PROBES_DIR/<uid>/<tool>, as
+a marshalled dictionary of key to (time, exit code, stdout, stderr), which is replaced with
+a rename. Only MAX_ENTRIES of the newest results are kept. PROBES_DIR/<uid> is created as
+0700, and unless it and the file are owned by the user and writable by nobody else, the
+probe is exec'd as usual, so that users can't plant answers for each other.
+
+This module is imported by the wrappers of tools that memoize, so it imports only os, sys and
+time at the top.
+"""
+import os
+import sys
+import time
+
+from interceptor.paths import PROBES_DIR, user_directory
+
+DEFAULT_TTL = 3600
+MAX_ENTRIES = 256
+ENVIRONMENT = ('PATH', 'LANG', 'LC_ALL', 'LC_MESSAGES', 'COMPILER_PATH', 'GCC_EXEC_PREFIX',
+               'LIBRARY_PATH')
+
+
+def probes_path(tool_name: str, uid: int = None) -> str:
+    return os.path.join(PROBES_DIR, str(os.getuid() if uid is None else uid), tool_name)
+
+
+def _is_trusted(st: os.stat_result) -> bool:
+    import stat
+    return stat.S_ISREG(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def _load(path: str):
+    """
+    :return: the results, or None if the file can't be trusted
+    """
+    import marshal
+    try:
+        with open(path, 'rb') as f_in:
+            if not _is_trusted(os.fstat(f_in.fileno())):
+                return None
+            results = marshal.load(f_in)
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    return results if isinstance(results, dict) else {}
+
+
+def _remember(path: str, key: tuple, result: tuple) -> None:
+    """
+    Add a result to the file, under a lock so that concurrent probes don't lose each other's.
+    """
+    import fcntl
+    import marshal
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        results = _load(path)
+        if results is None:
+            return
+        results[key] = result
+        if len(results) > MAX_ENTRIES:
+            newest = sorted(results.items(), key=lambda item: item[1][0])[-MAX_ENTRIES:]
+            results = dict(newest)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f_out:
+            marshal.dump(results, f_out)
+        os.rename(tmp_path, path)
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def run_memoized(cfg: dict, tool_name: str, location: str, args: list):
+    """
+    Answer a probe with a remembered result, or run it and remember it's result.
+
+    :param cfg: the configuration dictionary
+    :param tool_name: name of the intercepted tool
+    :param location: path to the intercepted binary
+    :param args: the rewritten command line, including argv[0]
+    :return: the exit code of the probe, or None if the results can't be trusted and the tool
+        should be exec'd as usual
+    """
+    if user_directory(PROBES_DIR) is None:
+        return None
+    path = probes_path(tool_name)
+    results = _load(path)
+    if results is None:
+        return None
+    st = os.stat(location)
+    key = (tuple(args), st.st_ino, st.st_mtime_ns, st.st_size,
+           tuple(os.environ.get(name) for name in ENVIRONMENT))
+    ttl = cfg.get('memoize_ttl') or DEFAULT_TTL
+
+    result = results.get(key)
+    if result is None or time.time() - result[0] >= ttl:
+        import subprocess
+        process = subprocess.run(args, executable=location, stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = (time.time(), process.returncode, process.stdout, process.stderr)
+        # a probe that was killed tells nothing about the tool
+        if process.returncode >= 0:
+            try:
+                _remember(path, key, result)
+            except OSError:
+                pass
+
+    _, returncode, stdout, stderr = result
+    _write_all(sys.stdout.fileno(), stdout)
+    _write_all(sys.stderr.fileno(), stderr)
+    return returncode
+
+
+def clear(tool_name: str) -> int:
+    """
+    Forget the results of given tool's probes, of all users whose results can be removed.
+
+    :return: amount of files removed
+    """
+    removed = 0
+    try:
+        uids = os.listdir(PROBES_DIR)
+    except FileNotFoundError:
+        return 0
+    for uid in uids:
+        path = os.path.join(PROBES_DIR, uid, tool_name)
+        try:
+            os.unlink(path)
+            removed += 1
+        except (FileNotFoundError, PermissionError):
+            pass
+    return removed
@@ -0,0 +1,120 @@
+"""
+The registry of intercepted binaries.
+
+Telling whether a binary is intercepted means reading it, and finding all the binaries of
+a tool means scanning PATH. The registry records, for every tool, each wrapper that was
+installed, so that checking whether a tool is intercepted takes a stat() per wrapper
+instead. An entry is valid only as long as the wrapper's inode, mtime and size are the ones
+recorded, so anything that touches a wrapper behind interceptor's back invalidates it, and
+the callers fall back to reading the binaries.
+
+The registry is a JSON file at REGISTRY_PATH:
+
+    {"tool name": {"wrapper path": {"original": ..., "inode": ..., "mtime_ns": ...,
+                                    "size": ..., "template_version": ...}}}
+
+Updates are read-modify-write under a lock, and the file is replaced with a rename.
+"""
+import fcntl
+import json
+import os
+import threading
+import typing as tp
+
+from interceptor.paths import REGISTRY_PATH
+from interceptor.runtime import TEMPLATE_VERSION
+
+# guards updates made from multiple threads, the file lock guards them from other processes
+_lock = threading.Lock()
+
+
+def load_registry() -> tp.Dict[str, tp.Dict[str, dict]]:
+    try:
+        with open(REGISTRY_PATH, 'r', encoding='utf-8') as f_in:
+            registry = json.load(f_in)
+    except (OSError, ValueError):
+        return {}
+    return registry if isinstance(registry, dict) else {}
+
+
+def _save_registry(registry: dict) -> None:
+    tmp_path = '%s.%s.%s.tmp' % (REGISTRY_PATH, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w', encoding='utf-8') as f_out:
+        json.dump(registry, f_out, sort_keys=True, indent=4)
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, REGISTRY_PATH)
+
+
+def _update(modify: tp.Callable[[dict], None]) -> None:
+    """
+    Modify the registry in place with given function, under the lock.
+    """
+    os.makedirs(os.path.dirname(REGISTRY_PATH), exist_ok=True)
+    with _lock, open(REGISTRY_PATH + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        registry = load_registry()
+        modify(registry)
+        _save_registry(registry)
+
+
+def make_entry(wrapper_path: str, original_path: str,
+               template_version: int = TEMPLATE_VERSION) -> dict:
+    st = os.stat(wrapper_path)
+    return {'original': original_path,
+            'inode': st.st_ino,
+            'mtime_ns': st.st_mtime_ns,
+            'size': st.st_size,
+            'template_version': template_version}
+
+
+def register(tool_name: str, wrapper_path: str, original_path: str) -> None:
+    """
+    Record that a wrapper was installed at wrapper_path, or that it was rewritten.
+    """
+    entry = make_entry(wrapper_path, original_path)
+    _update(lambda registry: registry.setdefault(tool_name, {}).__setitem__(wrapper_path, entry))
+
+
+def unregister(wrapper_path: str) -> None:
+    """
+    Record that wrapper_path is no longer a wrapper, whichever tool it belonged to.
+    """
+    def modify(registry: dict) -> None:
+        for tool_name in list(registry):
+            registry[tool_name].pop(wrapper_path, None)
+            if not registry[tool_name]:
+                del registry[tool_name]
+    _update(modify)
+
+
+def replace_registry(registry: dict) -> None:
+    _update(lambda current: (current.clear(), current.update(registry)))
+
+
+def is_entry_valid(wrapper_path: str, entry: dict) -> bool:
+    """
+    Is the wrapper still what was registered? Costs a single stat().
+    """
+    try:
+        st = os.stat(wrapper_path)
+    except OSError:
+        return False
+    return st.st_ino == entry['inode'] and st.st_mtime_ns == entry['mtime_ns'] \
+        and st.st_size == entry['size']
+
+
+def registered_wrappers(tool_name: str,
+                        registry: tp.Optional[dict] = None) -> tp.Optional[tp.Dict[str, dict]]:
+    """
+    Return the wrappers of given tool, as wrapper path to it's entry, if the registry has
+    any and all of them are valid. Otherwise return None, and the binaries have to be read.
+    """
+    if registry is None:
+        registry = load_registry()
+    wrappers = registry.get(tool_name)
+    if not wrappers:
+        return None
+    for wrapper_path, entry in wrappers.items():
+        if not is_entry_valid(wrapper_path, entry):
+            return None
+    return wrappers
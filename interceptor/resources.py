@@ -0,0 +1,195 @@
+"""
+Scheduling and resource controls that the wrapper applies to itself before exec'ing the tool,
+so that the tool inherits them.
+
+* nice - added to the niceness, as nice -n does
+* ionice - I/O scheduling class, "idle", "best-effort" or "realtime", optionally followed by
+  a colon and the level (0 to 7, lower is more important), eg. "best-effort:7"
+* cpu_affinity - CPUs the tool may run on, as a list of numbers or a string of numbers and
+  ranges, eg. "0-3,8"
+* rlimits - a dictionary of resource name to it's soft limit, eg. {"as": 4294967296,
+  "nofile": 1024}. Names are these of the RLIMIT_* constants, in any case. "unlimited" or -1
+  mean no limit. The limit is lowered to the hard limit if it's higher.
+* environment - a dictionary of variables to set, eg. {"OMP_NUM_THREADS": "4"}. A value of
+  null unsets the variable.
+
+A call dispatched to a worker (see interceptor.dispatch) takes all but environment along, and
+the worker applies them to the tool it runs, the environment is sent anyway.
+
+A control that can't be applied (eg. the CPUs are not there, or realtime I/O scheduling
+without the privileges) is reported on stderr and skipped, the tool runs anyway.
+
+This module is imported by the generated wrappers, so it imports only os at the top.
+"""
+import os
+
+RESOURCE_KEYS = ('nice', 'ionice', 'cpu_affinity', 'rlimits', 'environment')
+IONICE_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# number of the ioprio_set system call, which Python has no wrapper for
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30,
+              'armv7l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+
+
+def has_resource_policy(cfg: dict) -> bool:
+    for key in RESOURCE_KEYS:
+        if cfg.get(key):
+            return True
+    return False
+
+
+def parse_ionice(value: str) -> tuple:
+    """
+    :return: a tuple of (class, level)
+    :raises ValueError: value is invalid
+    """
+    name, _, level = str(value).partition(':')
+    if name not in IONICE_CLASSES:
+        raise ValueError('Unknown ionice class %s, choose one of: %s' % (
+            name, ', '.join(IONICE_CLASSES)))
+    level = int(level) if level else (7 if name == 'idle' else 4)
+    if not 0 <= level <= 7:
+        raise ValueError('ionice level must be between 0 and 7, not %s' % (level,))
+    return IONICE_CLASSES[name], level
+
+
+def parse_cpu_list(value) -> set:
+    """
+    :raises ValueError: value is invalid
+    """
+    if isinstance(value, list):
+        return {int(cpu) for cpu in value}
+    cpus = set()
+    for part in str(value).split(','):
+        first, _, last = part.strip().partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def rlimit_value(value) -> int:
+    import resource
+    if value in ('unlimited', -1):
+        return resource.RLIM_INFINITY
+    return int(value)
+
+
+def rlimit_resource(name: str) -> int:
+    import resource
+    try:
+        return getattr(resource, 'RLIMIT_' + name.upper())
+    except AttributeError:
+        raise ValueError('Unknown resource limit %s' % (name,))
+
+
+def validate_resource_policy(cfg: dict) -> None:
+    """
+    :raises ValueError: a control of given configuration dictionary is invalid
+    """
+    try:
+        int(cfg.get('nice') or 0)
+        if cfg.get('ionice'):
+            parse_ionice(cfg['ionice'])
+        if cfg.get('cpu_affinity') and not parse_cpu_list(cfg['cpu_affinity']):
+            raise ValueError('cpu_affinity allows no CPUs')
+        for name, value in (cfg.get('rlimits') or {}).items():
+            rlimit_resource(name)
+            rlimit_value(value)
+        for name, value in (cfg.get('environment') or {}).items():
+            if not name or '=' in name or not isinstance(value, (str, type(None))):
+                raise ValueError('Invalid environment variable %s=%r, values must be strings' % (
+                    name, value))
+    except (TypeError, AttributeError) as e:
+        raise ValueError('Invalid resource policy: %s' % (e,))
+
+
+def _warn(tool_name: str, control: str, e: Exception) -> None:
+    os.write(2, ('interceptor(%s): could not set %s: %s\n' % (tool_name, control, e)).encode())
+
+
+_libc = None
+
+
+def load_libc():
+    """
+    Load the C library, once. A process that applies the controls in a child it forked, while
+    it runs other threads, must call this before forking, so that the child does not dlopen().
+    """
+    global _libc
+    if _libc is None:
+        import ctypes
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc
+
+
+def _set_ionice(io_class: int, level: int) -> None:
+    import ctypes
+    number = IOPRIO_SET.get(os.uname().machine)
+    if number is None:
+        raise OSError('not supported on %s' % (os.uname().machine,))
+    libc = load_libc()
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0,
+                    (io_class << IOPRIO_CLASS_SHIFT) | level) == -1:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def apply_resource_policy(cfg: dict, tool_name: str) -> None:
+    """
+    Apply the controls of given configuration dictionary to the current process.
+    """
+    if cfg.get('nice'):
+        try:
+            os.nice(int(cfg['nice']))
+        except OSError as e:
+            _warn(tool_name, 'nice', e)
+    if cfg.get('ionice'):
+        try:
+            _set_ionice(*parse_ionice(cfg['ionice']))
+        except (OSError, ValueError) as e:
+            _warn(tool_name, 'ionice', e)
+    if cfg.get('cpu_affinity'):
+        try:
+            os.sched_setaffinity(0, parse_cpu_list(cfg['cpu_affinity']))
+        except (OSError, ValueError) as e:
+            _warn(tool_name, 'cpu_affinity', e)
+    if cfg.get('rlimits'):
+        import resource
+        for name, value in cfg['rlimits'].items():
+            try:
+                limit = rlimit_resource(name)
+                soft = rlimit_value(value)
+                hard = resource.getrlimit(limit)[1]
+                if hard != resource.RLIM_INFINITY and (soft == resource.RLIM_INFINITY
+                                                       or soft > hard):
+                    soft = hard
+                resource.setrlimit(limit, (soft, hard))
+            except (OSError, ValueError) as e:
+                _warn(tool_name, 'rlimit %s' % (name,), e)
+    for name, value in (cfg.get('environment') or {}).items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+def describe_resource_policy(cfg: dict) -> list:
+    """
+    Return human-readable descriptions of the controls of given configuration dictionary.
+    """
+    descriptions = []
+    if cfg.get('nice'):
+        descriptions.append('niceness increased by %s' % (cfg['nice'],))
+    if cfg.get('ionice'):
+        descriptions.append('I/O scheduling class %s' % (cfg['ionice'],))
+    if cfg.get('cpu_affinity'):
+        descriptions.append('runs on CPUs %s' % (
+            ','.join(str(cpu) for cpu in sorted(parse_cpu_list(cfg['cpu_affinity']))),))
+    for name, value in sorted((cfg.get('rlimits') or {}).items()):
+        descriptions.append('RLIMIT_%s limited to %s' % (name.upper(), value))
+    for name, value in sorted((cfg.get('environment') or {}).items()):
+        if value is None:
+            descriptions.append('%s is unset' % (name,))
+        else:
+            descriptions.append('%s=%s' % (name, value))
+    return descriptions
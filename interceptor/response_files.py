@@ -0,0 +1,204 @@
+"""
+Streaming rewrite of @response files.
+
+Compilers and linkers accept @file arguments, that are replaced with the arguments read from
+the file (which may in turn contain further @file arguments). With expand_response_files on,
+the wrapper expands them, applies the rules to every argument read and writes the result to
+a single new response file, so that the command line stays under ARG_MAX. Arguments are
+streamed from the files through the rules into the new file, never collected into a list.
+
+Quoting follows GCC's (libiberty's) rules: arguments are separated by whitespace, and
+single quotes, double quotes and backslashes can be used to include whitespace in them.
+A @file argument naming a file that can't be read is left alone, as GCC does.
+
+The new response file is unlinked right after it's created, and passed to the tool as
+@/proc/self/fd/N with the descriptor left open over execv, so it's removed by the kernel
+once the tool exits, however it exits. Where there's no /proc, the file is passed by name,
+and files left behind by processes that are no longer running are removed on the next call.
+
+This module is imported by the generated wrappers, so keep it lean.
+"""
+import os
+
+READ_SIZE = 65536
+MAX_DEPTH = 32
+WHITESPACE = ' \t\n\r\f\v'
+SPECIAL_CHARACTERS = frozenset(WHITESPACE + '\'"\\')
+WHITESPACE_TO_SPACE = str.maketrans(WHITESPACE, ' ' * len(WHITESPACE))
+FILE_PREFIX = 'interceptor-'
+FILE_SUFFIX = '.rsp'
+
+
+def has_response_files(arguments: list) -> bool:
+    """
+    Is any of the arguments a @file naming a readable file? If none is, there's nothing to
+    expand and the arguments are left as they are.
+    """
+    for arg in arguments:
+        if arg.startswith('@') and os.path.isfile(arg[1:]) and os.access(arg[1:], os.R_OK):
+            return True
+    return False
+
+
+def _read_chunks(path: str):
+    with open(path, 'r', encoding='utf-8', errors='surrogateescape') as f_in:
+        while True:
+            chunk = f_in.read(READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def tokenize(chunks):
+    """
+    Split the text of a response file, given as an iterable of chunks, into arguments.
+    """
+    token = []
+    in_token = False
+    quote = None
+    escaped = False
+    for chunk in chunks:
+        if not chunk:
+            # eg. an empty file, which must not start an empty argument
+            continue
+        if not escaped and quote is None and '\\' not in chunk and '"' not in chunk \
+                and "'" not in chunk:
+            # fast path, the chunk is plain whitespace-separated words
+            parts = chunk.translate(WHITESPACE_TO_SPACE).split(' ')
+            if len(parts) == 1:
+                token.append(chunk)
+                in_token = True
+                continue
+            # the first part continues the current token, the last may continue in the next chunk
+            first = ''.join(token) + parts[0]
+            if in_token or first:
+                yield first
+            for word in parts[1:-1]:
+                if word:
+                    yield word
+            token = [parts[-1]]
+            in_token = bool(parts[-1])
+            continue
+
+        for char in chunk:
+            if escaped:
+                token.append(char)
+                escaped = False
+            elif char == '\\':
+                escaped = True
+                in_token = True
+            elif quote is not None:
+                if char == quote:
+                    quote = None
+                else:
+                    token.append(char)
+            elif char in '\'"':
+                quote = char
+                in_token = True
+            elif char in WHITESPACE:
+                if in_token:
+                    yield ''.join(token)
+                    token = []
+                    in_token = False
+            else:
+                token.append(char)
+                in_token = True
+    if in_token:
+        yield ''.join(token)
+
+
+def quote_argument(arg: str) -> str:
+    if not arg:
+        return "''"
+    if not SPECIAL_CHARACTERS.intersection(arg):
+        return arg
+    return ''.join('\\' + char if char in SPECIAL_CHARACTERS else char for char in arg)
+
+
+def expand(arguments, _stack: tuple = ()):
+    """
+    Iterate over the arguments, with every readable @file replaced by it's arguments,
+    recursively.
+    """
+    for arg in arguments:
+        if arg.startswith('@') and len(_stack) < MAX_DEPTH:
+            path = os.path.realpath(arg[1:])
+            if path not in _stack and os.path.isfile(path):
+                try:
+                    # read the first chunk now, so that unreadable files are left alone
+                    chunks = _read_chunks(path)
+                    first_chunk = next(chunks, '')
+                except OSError:
+                    yield arg
+                    continue
+                yield from expand(tokenize(_prepend(first_chunk, chunks)), _stack + (path,))
+                continue
+        yield arg
+
+
+def _prepend(first, iterator):
+    yield first
+    yield from iterator
+
+
+def response_file_directory(configured: str = None) -> str:
+    if configured:
+        return configured
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return os.environ.get('TMPDIR', '/tmp')
+
+
+def _remove_stale_files(directory: str) -> None:
+    for name in os.listdir(directory):
+        if not name.startswith(FILE_PREFIX) or not name.endswith(FILE_SUFFIX):
+            continue
+        try:
+            pid = int(name[len(FILE_PREFIX):].split('-')[0])
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+        except (ValueError, OSError):
+            pass
+
+
+def rewrite(rules, arguments: list, directory: str = None, events: list = None) -> list:
+    """
+    Expand the response files among the arguments, rewrite the result with given rules
+    and return arguments that pass it as a single new response file.
+
+    :param rules: a CompiledRules
+    :param arguments: arguments, without argv[0]
+    :param directory: where to create the response file, preferably a tmpfs
+    :param events: see CompiledRules.apply()
+    :return: prepended arguments, the new @file and appended arguments
+    """
+    directory = response_file_directory(directory)
+    use_proc = os.path.isdir('/proc/self/fd')
+    if not use_proc:
+        _remove_stale_files(directory)
+
+    # the directory is usually world-writable, so never open anything that's already there
+    path = os.path.join(directory, '%s%s-%s%s' % (FILE_PREFIX, os.getpid(),
+                                                  os.urandom(8).hex(), FILE_SUFFIX))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    if use_proc:
+        os.unlink(path)
+    present = set()
+    with os.fdopen(os.dup(fd), 'w', encoding='utf-8', errors='surrogateescape',
+                   buffering=READ_SIZE) as f_out:
+        for arg in rules.stream(expand(arguments), present, events):
+            f_out.write(quote_argument(arg))
+            f_out.write('\n')
+    prepended, appended = rules.finish(present, events)
+
+    if use_proc:
+        os.set_inheritable(fd, True)
+        response_file = '@/proc/self/fd/%s' % (fd,)
+    else:
+        os.close(fd)
+        response_file = '@' + path
+    return prepended + [response_file] + appended
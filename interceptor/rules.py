@@ -0,0 +1,213 @@
+"""
+The rewrite engine, applying the argument rules of a configuration to a command line.
+
+The rules are compiled once into hash-based lookup tables, which are then applied in a single
+pass over the arguments, so rewriting costs O(arguments + rules) no matter how long the
+command line is. The semantics are these of applying every rule in turn to the whole
+command line:
+
+1. every argument in args_to_disable is removed
+2. every replacement in args_to_replace is applied in order, so replacements chain
+3. arguments in args_to_append that don't occur in the command line are appended
+4. arguments in args_to_prepend that don't occur in the command line are prepended
+5. if deduplication is on, only the first occurrence of every argument is kept
+
+Pattern rules (args_to_disable_matching and args_to_replace_matching, see
+interceptor.patterns) are applied to arguments that the exact rules did not disable,
+respectively after the exact replacements.
+
+Probe patterns (memoize_probes) are compiled along, for telling whether a call is a probe whose
+output is memoized, see interceptor.probes.
+
+The compiled tables contain only marshallable types, so that they can be stored in
+the snapshot. This module is imported by the generated wrappers, so keep it lean.
+"""
+
+from interceptor.patterns import PatternMatcher, compile_patterns
+
+DISABLE, REPLACE, APPEND, PREPEND = range(4)
+
+
+class CompiledRules:
+    """
+    Argument rules of a configuration, compiled into lookup tables.
+
+    Use compile_rules() or CompiledRules.from_tables() to obtain one.
+    """
+    __slots__ = ('disabled', 'replacements', 'appends', 'prepends', 'candidates',
+                 'deduplication', 'patterns', 'pattern_offsets', 'probes')
+
+    def __init__(self, disabled: dict, replacements: dict, appends: tuple, prepends: tuple,
+                 deduplication: bool, patterns: tuple = None, pattern_offsets: tuple = (0, 0),
+                 probes: tuple = None):
+        # argument to disable -> index of the rule that disables it
+        self.disabled = disabled
+        # argument to replace -> (what it finally becomes, ((rule index, from, to), ...))
+        self.replacements = replacements
+        # arguments that may be appended and prepended, in the order that they will be placed
+        # on the command line if none of them are already present
+        self.appends = appends
+        self.prepends = prepends
+        self.candidates = frozenset(appends + prepends)
+        self.deduplication = deduplication
+        # a PatternMatcher, or None if there are no pattern rules
+        self.patterns = PatternMatcher.from_tables(patterns) if patterns is not None else None
+        # pattern rules are numbered after the exact rules of their kind, these are the
+        # amounts of exact disable and replace rules
+        self.pattern_offsets = pattern_offsets
+        # a PatternMatcher of the probe patterns as disable patterns, or None if there are none
+        self.probes = PatternMatcher.from_tables(probes) if probes is not None else None
+
+    def to_tables(self) -> tuple:
+        patterns = self.patterns.to_tables() if self.patterns is not None else None
+        probes = self.probes.to_tables() if self.probes is not None else None
+        return self.disabled, self.replacements, self.appends, self.prepends, \
+            self.deduplication, patterns, self.pattern_offsets, probes
+
+    @classmethod
+    def from_tables(cls, tables: tuple) -> 'CompiledRules':
+        return cls(*tables)
+
+    def is_probe(self, arguments: list) -> bool:
+        """
+        Does every one of the arguments, of which there is at least one, match a probe pattern?
+        """
+        if self.probes is None or not arguments:
+            return False
+        for arg in arguments:
+            if self.probes.disabling_rule(arg) is None:
+                return False
+        return True
+
+    def stream(self, arguments, present: set, events: list = None):
+        """
+        Rewrite arguments one by one, without appending or prepending anything.
+
+        Use this for command lines too long to keep in memory, and call finish() once it's
+        exhausted to learn what to prepend and append.
+
+        :param arguments: an iterable of arguments, without argv[0]
+        :param present: a set, to which arguments that will cause an append or a prepend
+            to be skipped will be added
+        :param events: see apply()
+        :return: an iterator of rewritten arguments
+        """
+        disabled = self.disabled
+        replacements = self.replacements
+        candidates = self.candidates
+        patterns = self.patterns
+        disable_offset, replace_offset = self.pattern_offsets
+        seen = set() if self.deduplication else None
+
+        for arg in arguments:
+            if arg in disabled:
+                if events is not None:
+                    events.append((DISABLE, disabled[arg], arg, None))
+                continue
+            if patterns is not None:
+                rule_index = patterns.disabling_rule(arg)
+                if rule_index is not None:
+                    if events is not None:
+                        events.append((DISABLE, disable_offset + rule_index, arg, None))
+                    continue
+            replacement = replacements.get(arg)
+            if replacement is not None:
+                arg, steps = replacement
+                if events is not None:
+                    for rule_index, source, target in steps:
+                        events.append((REPLACE, rule_index, source, target))
+            if patterns is not None:
+                replacement = patterns.replacement(arg)
+                if replacement is not None:
+                    rule_index, target = replacement
+                    if events is not None:
+                        events.append((REPLACE, replace_offset + rule_index, arg, target))
+                    arg = target
+            if arg in candidates:
+                present.add(arg)
+            if seen is not None:
+                if arg in seen:
+                    continue
+                seen.add(arg)
+            yield arg
+
+    def finish(self, present: set, events: list = None) -> tuple:
+        """
+        Return a tuple of (arguments to prepend, arguments to append) after stream() is
+        exhausted.
+
+        :param present: the set given to stream()
+        :param events: the list given to stream()
+        """
+        appended = [arg for arg in self.appends if arg not in present]
+        prepended = [arg for arg in self.prepends if arg not in present]
+
+        if events is not None:
+            # applying the rules one by one would group actions by the rule that took them
+            events.sort(key=lambda event: (event[0], event[1]))
+            events.extend((APPEND, None, arg, None) for arg in appended)
+            # prepending is done back to front
+            events.extend((PREPEND, None, arg, None) for arg in reversed(prepended))
+        return prepended, appended
+
+    def apply(self, arguments: list, events: list = None) -> list:
+        """
+        Return the rewritten arguments. Give it the arguments without argv[0].
+
+        :param arguments: arguments to rewrite, won't be modified
+        :param events: an empty list. If given, (action, rule index, argument, replaced with)
+            will be appended to it for every action taken, in the order that applying
+            the rules one after another would take them.
+        """
+        present = set()
+        result = list(self.stream(arguments, present, events))
+        prepended, appended = self.finish(present, events)
+        if prepended:
+            result = prepended + result
+        if appended:
+            result.extend(appended)
+        return result
+
+
+def compile_rules(cfg: dict) -> CompiledRules:
+    """
+    Compile the argument rules of given configuration dictionary.
+
+    :raises ValueError: a pattern rule is invalid
+    """
+    disabled = {}
+    for i, arg in enumerate(cfg.get('args_to_disable', ())):
+        disabled.setdefault(arg, i)
+
+    rules = [(source, target) for source, target in cfg.get('args_to_replace', ())]
+    replacements = {}
+    for source, _ in rules:
+        if source in replacements:
+            continue
+        value = source
+        steps = []
+        for i, (rule_source, rule_target) in enumerate(rules):
+            if value == rule_source and rule_source != rule_target:
+                steps.append((i, value, rule_target))
+                value = rule_target
+        if steps:
+            replacements[source] = value, tuple(steps)
+
+    appends = []
+    for arg in cfg.get('args_to_append', ()):
+        if arg not in appends:
+            appends.append(arg)
+    prepends = []
+    for arg in reversed(cfg.get('args_to_prepend', ())):
+        if arg not in prepends and arg not in appends:
+            prepends.insert(0, arg)
+
+    patterns = compile_patterns(cfg.get('args_to_disable_matching', ()),
+                                cfg.get('args_to_replace_matching', ()))
+    probes = compile_patterns(cfg.get('memoize_probes', ()), ())
+
+    return CompiledRules(disabled, replacements, tuple(appends), tuple(prepends),
+                         bool(cfg.get('deduplication', False)),
+                         patterns.to_tables() if patterns is not None else None,
+                         (len(cfg.get('args_to_disable', ())), len(rules)),
+                         probes.to_tables() if probes is not None else None)
@@ -3,19 +3,61 @@ import os
 import sys
 import shutil
 
-from satella.files import write_to_file, read_in_file
+from satella.files import read_in_file
 
+from interceptor.config import write_config_file, rebuild_snapshot, load_config_for
 from interceptor.intercepting import intercept_tool, unintercept_tool, assert_intercepted, check, \
-    abort, link, assert_etc_interceptor_d_exists, edit, reset, configure
+    abort, link, assert_etc_interceptor_d_exists, edit, reset, configure, timing, \
+    set_backend, stats, export_metrics, intercept_tools, rebuild_registry, \
+    audit, cache_stats, clear_probes, apply_to_compilation_database, shim_tools, unshim_tools, \
+    export_trace, clear_trace
+from interceptor.paths import config_path, SNAPSHOT_PATH
+
+
+OPERATIONS = {'undo', 'configure', 'show', 'status', 'edit', 'append', 'prepend', 'disable',
+              'replace', 'display', 'hide', 'notify', 'unnotify', 'log', 'unlog',
+              'disable-matching', 'replace-matching', 'measure', 'unmeasure', 'cache', 'uncache',
+              'limit', 'unlimit', 'dispatch', 'undispatch', 'memoize', 'unmemoize', 'trace',
+              'untrace', 'apply', 'link', 'copy', 'backend', 'timing', 'stats', 'reset',
+              'backup', 'restore'}
+
+
+def read_tool_names(path: str) -> list:
+    """
+    Read tool names from a file, one per line. Empty lines and lines starting with # are
+    skipped.
+    """
+    with open(path, 'r', encoding='utf-8') as f_in:
+        return [line.strip() for line in f_in
+                if line.strip() and not line.strip().startswith('#')]
+
+
+def are_tool_names(names: list) -> bool:
+    """
+    Could these be tools to intercept at once, rather than a mistyped command? A name that
+    starts with - or contains / never is, and the first one must be found in PATH.
+    """
+    if any(name.startswith('-') or '/' in name for name in names):
+        return False
+    return shutil.which(names[0]) is not None
 
 
 def banner():
     print('''Usage:
     * intercept foo - intercept foo
+    * intercept foo bar baz ... - intercept all of these tools at once
+    * intercept --from-file FILE - intercept all tools listed in FILE, one per line
     * intercept undo foo - cancel intercepting foo
+    * intercept shim foo bar ... - intercept these tools by shims, leaving their binaries as they
+      are. Put /usr/local/lib/interceptor/shims in front of PATH for them to take effect.
+    * intercept unshim foo bar ... - remove the shims of these tools
     * intercept configure foo - type in the configuration for foo in JSON format, end with Ctrl+D
     * intercept show foo - show the configuration for foo
+    * intercept show foo --effective - show the configuration for foo merged with the
+      configurations that it extends
     * intercept status foo - display foo's status of interception and details about it's configuration
+    * intercept status --all - display the status of all configured tools, their binaries and
+      configurations as JSON
     * intercept display foo - enable displaying what is launched on foo's startup
     * intercept hide foo - disable displaying what is launched on foo's startup
     * intercept edit foo - launch a nano/vi to edit it's configuration
@@ -23,6 +65,10 @@ def banner():
     * intercept prepend foo ARG - add ARG to be prepended to command line whenever foo is ran
     * intercept disable foo ARG - add ARG to be eliminated from the command line whenever foo is ran
     * intercept replace foo ARG1 ARG2 - add ARG1 to be replaced with ARG2 whenever it is passed to foo
+    * intercept disable-matching foo PATTERN - add a pattern (prefix:..., glob:... or regex:...)
+      of arguments to be eliminated from the command line whenever foo is ran
+    * intercept replace-matching foo PATTERN ARG - add arguments matching PATTERN to be replaced
+      with ARG whenever they are passed to foo
     * intercept notify foo - display a notification each time an argument action is taken
     * intercept unnotify foo - hide the notification each time an argument action is taken
     * intercept link foo bar - symlink bar's config file to that of foo
@@ -32,6 +78,41 @@ def banner():
     * intercept reset foo - reset foo's configuration (delete it and create a new one)
     * intercept log foo - enable logging to /var/log/interceptor.d for foo
     * intercept unlog foo - disable logging to /var/log/interceptor.d for foo
+    * intercept stats foo - show how many times foo was called, it's top arguments and how often
+      it's rules were hit, read from the log
+    * intercept measure foo - enable collecting metrics of the time that interception adds to foo
+    * intercept unmeasure foo - disable collecting metrics for foo
+    * intercept metrics [FILE] - print the metrics of all tools in Prometheus text format,
+      or write them to FILE (eg. in node_exporter's textfile collector directory)
+    * intercept cache foo [MAX_BYTES] - serve foo's -c compilations from a compile cache,
+      evicting the least recently used entries past MAX_BYTES (5 GiB by default)
+    * intercept uncache foo - stop using the compile cache for foo
+    * intercept cache stats - show the hits, misses and sizes of the compile caches
+    * intercept limit foo N - run at most N calls of foo at once, the others wait
+    * intercept unlimit foo - run any amount of calls of foo at once
+    * intercept dispatch foo SOCKET - run foo's calls on the worker listening on SOCKET,
+      or on any of the workers if given more than once
+    * intercept undispatch foo - run foo's calls locally
+    * intercept worker SOCKET [JOBS] - run a worker for dispatched calls, that runs them locally,
+      at most JOBS at once
+    * intercept memoize foo PATTERN - remember the output of calls of foo whose every argument
+      matches a pattern (prefix:..., glob:... or regex:...), eg. prefix:--version
+    * intercept unmemoize foo - stop remembering the output of foo's calls
+    * intercept cache clear foo - forget the remembered output of foo's calls
+    * intercept trace foo - run foo as a child and record each call in the trace, the directory
+      in INTERCEPTOR_TRACE_DIR or /var/lib/interceptor/traces
+    * intercept untrace foo - exec foo as usual
+    * intercept trace export [FILE] - merge the trace into a Chrome trace, trace.json by default,
+      and summarize the wall time each tool took
+    * intercept trace clear - remove the trace
+    * intercept apply foo compile_commands.json [OUTPUT] - rewrite the arguments of foo's entries
+      in a compilation database with foo's rules, in place or into OUTPUT
+    * intercept timing foo [ARGS...] - measure how much time the interception adds to foo ARGS
+    * intercept backend foo python|sh - choose the kind of wrapper generated for foo
+    * intercept registry rebuild - reconcile the registry of intercepted binaries, that status,
+      undo and others use instead of reading the binaries, with what's actually on disk
+    * intercept compile - recompile the snapshot of all configurations read by the wrappers
+      and regenerate the wrappers
 Use the optional switch --force is you need a command to complete despite the command telling you 
 that it is impossible to complete. One trick: already intercepted files won't be intercepted, because
 that would lead to overwriting of the original executable, so interceptor won't do that.
@@ -41,8 +122,38 @@ that would lead to overwriting of the original executable, so interceptor won't
 def run():
     assert_etc_interceptor_d_exists()
 
-    if len(sys.argv) == 2:
+    if len(sys.argv) == 2 and sys.argv[1] == 'compile':
+        count = rebuild_snapshot(refresh_all_wrappers=True)
+        print('Compiled %s configurations into %s' % (count, SNAPSHOT_PATH))
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == 'metrics':
+        export_metrics(sys.argv[2] if len(sys.argv) == 3 else None)
+    elif sys.argv[1:] == ['registry', 'rebuild']:
+        rebuild_registry()
+    elif sys.argv[1:] == ['cache', 'stats']:
+        cache_stats()
+    elif len(sys.argv) == 4 and sys.argv[1:3] == ['cache', 'clear']:
+        clear_probes(sys.argv[3])
+    elif len(sys.argv) in (3, 4) and sys.argv[1:3] == ['trace', 'export']:
+        export_trace(sys.argv[3] if len(sys.argv) == 4 else None)
+    elif sys.argv[1:] == ['trace', 'clear']:
+        clear_trace()
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == 'worker':
+        from interceptor.worker import serve
+        serve(sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else None)
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'shim':
+        shim_tools(sys.argv[2:])
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'unshim':
+        unshim_tools(sys.argv[2:])
+    elif len(sys.argv) == 3 and sys.argv[1] == '--from-file':
+        intercept_tools(read_tool_names(sys.argv[2]))
+    elif len(sys.argv) == 2:
         intercept_tool(sys.argv[1])
+    elif len(sys.argv) >= 3 and sys.argv[1] not in OPERATIONS:
+        if not are_tool_names(sys.argv[1:]):
+            print('Unrecognized command %s' % (sys.argv[1],))
+            banner()
+            sys.exit(1)
+        intercept_tools(sys.argv[1:])
     elif len(sys.argv) >= 3:
         op_name = sys.argv[1]
         app_name = sys.argv[2]
@@ -55,43 +166,70 @@ def run():
             data = sys.stdin.read()
             try:
                 json.loads(data)
-            except json.JSONDecoder:
+            except json.JSONDecodeError:
                 print('Configuration is invalid JSON')
                 abort()
-            write_to_file(os.path.join('/etc/interceptor.d', app_name), data, 'utf-8')
+            write_config_file(config_path(app_name), data)
+            rebuild_snapshot()
             print('Configuration successfully written')
+        elif op_name == 'show' and target_name == '--effective':
+            assert_intercepted(app_name)
+            try:
+                config = load_config_for(app_name, None).effective_config()
+            except ValueError as e:
+                print(e.args[0])
+                abort()
+            print(json.dumps(config, sort_keys=True, indent=4))
         elif op_name == 'show':
             assert_intercepted(app_name)
-            config = read_in_file(os.path.join('/etc/interceptor.d', app_name), 'utf-8')
+            config = read_in_file(config_path(app_name), 'utf-8')
             print(config)
+        elif op_name == 'status' and app_name == '--all':
+            json.dump(audit(), sys.stdout, indent=4)
+            sys.stdout.write('\n')
         elif op_name == 'status':
             check(app_name, add_config=False)
         elif op_name == 'edit':
             edit(app_name)
+        elif op_name in ('replace', 'replace-matching') and len(sys.argv) < 5:
+            print('%s needs what to replace and what to replace it with' % (op_name,))
+            banner()
+            sys.exit(1)
         elif op_name in ('append', 'prepend', 'disable', 'replace', 'display', 'hide',
-                         'notify', 'unnotify', 'log', 'unlog'):
+                         'notify', 'unnotify', 'log', 'unlog', 'disable-matching',
+                         'replace-matching', 'measure', 'unmeasure', 'cache', 'uncache',
+                         'limit', 'unlimit', 'dispatch', 'undispatch', 'memoize',
+                         'unmemoize', 'trace', 'untrace'):
             configure(op_name, app_name, target_name)
         elif op_name == 'link':
             link(app_name, target_name)
         elif op_name == 'copy':
             link(app_name, target_name, copy=True)
+        elif op_name == 'backend':
+            set_backend(app_name, target_name)
+        elif op_name == 'apply' and target_name is not None:
+            apply_to_compilation_database(app_name, target_name,
+                                          sys.argv[4] if len(sys.argv) >= 5 else None)
+        elif op_name == 'timing':
+            timing(app_name, sys.argv[3:])
+        elif op_name == 'stats':
+            stats(app_name)
         elif op_name == 'reset':
             reset(app_name)
         elif op_name == 'backup':
             i = 1
-            while os.path.exists(os.path.join('/etc/interceptor.d/', f'{app_name}.{i}')):
+            while os.path.exists(config_path(f'{app_name}.{i}')):
                 i += 1
-            shutil.copy(os.path.join('/etc/interceptor.d', f'{app_name}'),
-                        os.path.join('/etc/interceptor.d', f'{app_name}.{i}'))
+            shutil.copy(config_path(app_name), config_path(f'{app_name}.{i}'))
             print(f'Backed up {app_name}\'s config as save number {i}')
         elif op_name == 'restore':
             i = int(target_name)
-            if not os.path.exists(os.path.join('/etc/interceptor.d', f'{app_name}.{i}')):
+            if not os.path.exists(config_path(f'{app_name}.{i}')):
                 print(f'Save number {i} does not exist')
                 sys.exit(1)
-            os.unlink(os.path.join('/etc/interceptor.d', app_name))
-            shutil.copy(os.path.join('/etc/interceptor.d', f'{app_name}.{i}'),
-                        os.path.join('/etc/interceptor.d', app_name))
+            write_config_file(config_path(app_name),
+                              read_in_file(config_path(f'{app_name}.{i}'), 'utf-8'))
+            rebuild_snapshot()
             print(f'Restored configuration for {app_name} from save number {i}')
         else:
             print('Unrecognized command %s' % (op_name,))
@@ -0,0 +1,234 @@
+"""
+The code ran by the generated wrappers on every call of an intercepted tool.
+
+This is the hot path of every intercepted call, so this module imports only os, sys, time and
+the other lean modules of interceptor (no typing, no satella, no pkg_resources). The wrapper
+runs the interpreter in isolated, no-site mode and adds interceptor's location to sys.path
+by itself, so that no site-packages have to be scanned either.
+
+The slower interceptor.config is imported only if the snapshot is missing or stale.
+"""
+import os
+import sys
+import time
+
+from interceptor.invocation_log import write_record
+from interceptor.metrics import record_call
+from interceptor.paths import INTERCEPTED
+from interceptor.resources import RESOURCE_KEYS, has_resource_policy, apply_resource_policy
+from interceptor.response_files import has_response_files, rewrite as rewrite_response_files
+from interceptor.rules import CompiledRules, compile_rules, DISABLE, REPLACE, APPEND, PREPEND
+from interceptor.slots import acquire_slot
+from interceptor.snapshot import read_snapshot_entry
+
+# Version of the protocol between the generated wrapper and this module. Wrappers are
+# generated with this value baked in, and refuse to run with an older runtime. Bump it
+# whenever a template or what the runtime expects of the wrappers changes, so that the
+# wrappers generated before are reported as stale and regenerated by intercept compile.
+TEMPLATE_VERSION = 3
+
+# present in the header of every wrapper that interceptor has ever generated
+INTERCEPTOR_WRAPPER_STRING = 'Generated automatically by interceptor'
+
+ACTION_NAMES = {DISABLE: 'taking away', APPEND: 'appending', PREPEND: 'prepending'}
+
+
+def apply_configuration(cfg: dict, app_name: str, args: list,
+                        rules: CompiledRules = None) -> list:
+    """
+    Return the command line rewritten according to given configuration dictionary.
+
+    This performs all the side effects (displaying, logging) that the configuration asks for.
+    If expand_response_files is on and there are any @files among the arguments, this
+    creates a response file that lives as long as the process, see
+    interceptor.response_files.
+
+    :param cfg: configuration, as returned by Configuration.to_json()
+    :param app_name: name of the intercepted tool
+    :param args: command line, including argv[0]. It won't be modified.
+    :param rules: the configuration's rules, if already compiled
+    """
+    if rules is None:
+        rules = compile_rules(cfg)
+    process, *arguments = args
+    notify = cfg.get('notify_about_actions', False)
+    log = cfg.get('log', False)
+    events = [] if notify or log else None
+    if cfg.get('expand_response_files', False) and has_response_files(arguments):
+        arguments = rewrite_response_files(rules, arguments, cfg.get('response_file_directory'),
+                                           events)
+    else:
+        arguments = rules.apply(arguments, events)
+
+    if notify:
+        for action, _, arg, replaced_with in events:
+            if action == REPLACE:
+                print('interceptor(%s): replacing %s with %s' % (app_name, arg, replaced_with))
+            else:
+                print('interceptor(%s): %s %s' % (app_name, ACTION_NAMES[action], arg))
+
+    if cfg.get('display_before_start', False):
+        print('%s %s' % (process, ' '.join(arguments)))
+
+    if log:
+        try:
+            # appends and prepends are told apart by their argument
+            write_record(app_name, [process, *arguments],
+                         tuple((action, arg if index is None else index)
+                               for action, index, arg, _ in events))
+        except OSError:
+            # not being able to log should not fail the build
+            pass
+
+    return [process, *arguments]
+
+
+def load_configuration(tool_name: str) -> tuple:
+    """
+    Return the configuration dictionary for given tool and it's compiled rules, preferably
+    from the snapshot.
+
+    Exits the process if the configuration does not exist.
+    """
+    entry = read_snapshot_entry(tool_name)
+    if entry is None:
+        from interceptor.config import load_effective_config
+        cfg = load_effective_config(tool_name)
+        return cfg, compile_rules(cfg)
+    cfg, tables = entry
+    return cfg, CompiledRules.from_tables(tables)
+
+
+def run_wrapper(tool_name: str, location: str, template_version: int) -> None:
+    """
+    Entry point of a generated wrapper. Rewrites sys.argv and execs the intercepted binary.
+
+    :param tool_name: name of the intercepted tool
+    :param location: path to the intercepted binary
+    :param template_version: TEMPLATE_VERSION that the wrapper was generated with
+    """
+    if template_version > TEMPLATE_VERSION:
+        sys.stderr.write('You have intercepted this call using a higher version of Interceptor. \n'
+                         'This might not work as advertised. Try undo\'ing the interception \n'
+                         'and intercepting this again.\n'
+                         'Aborting.\n')
+        sys.exit(1)
+
+    # CPU time taken by starting the interpreter and importing this module
+    startup = time.process_time()
+    started_at = time.perf_counter()
+    cfg, rules = load_configuration(tool_name)
+    loaded_at = time.perf_counter()
+    args = apply_configuration(cfg, tool_name, sys.argv, rules)
+    modified_at = time.perf_counter()
+
+    if rules.probes is not None and rules.is_probe(args[1:]):
+        from interceptor.probes import run_memoized
+        sys.stdout.flush()
+        returncode = _answer(cfg, tool_name, args, run_memoized, cfg, tool_name, location, args)
+        if returncode is not None:
+            exit_with_status(returncode)
+
+    waited = 0.0
+    if cfg.get('max_concurrency'):
+        try:
+            waited = acquire_slot(tool_name, cfg['max_concurrency'])[1]
+        except OSError as e:
+            # eg. SLOTS_DIR is missing, or another user created a slot file that can't be read
+            sys.stderr.write('interceptor: running %s without a slot: %s\n' % (tool_name, e))
+    if cfg.get('metrics', False):
+        try:
+            record_call(tool_name, (startup, loaded_at - started_at, modified_at - loaded_at,
+                                    waited, startup + time.perf_counter() - started_at - waited))
+        except OSError:
+            pass
+
+    if has_resource_policy(cfg):
+        apply_resource_policy(cfg, tool_name)
+
+    if cfg.get('compile_cache', False):
+        from interceptor.cache import run_cached
+        returncode = _answer(cfg, tool_name, args, run_cached, cfg, location, args)
+        if returncode is not None:
+            sys.stdout.flush()
+            exit_with_status(returncode)
+
+    # a response file that apply_configuration() made is open only in this process
+    if cfg.get('dispatch_sockets') and not (cfg.get('expand_response_files', False)
+                                            and has_response_files(sys.argv[1:])):
+        from interceptor.dispatch import dispatch
+        # what the wrapper printed has to come before what the tool prints
+        sys.stdout.flush()
+        # the worker applies them to the tool, the environment is sent anyway
+        policy = {key: cfg[key] for key in RESOURCE_KEYS if key != 'environment' and cfg.get(key)}
+        returncode = _answer(cfg, tool_name, args, dispatch, cfg['dispatch_sockets'], tool_name,
+                             location, args, policy)
+        if returncode is not None:
+            exit_with_status(returncode)
+
+    # execv discards what's buffered, and stdout is buffered if it's not a terminal
+    sys.stdout.flush()
+    if cfg.get('trace', False):
+        from interceptor.trace import run_traced
+        exit_with_status(run_traced(tool_name, location, args))
+    _exec(location, args)
+
+
+def _answer(cfg: dict, tool_name: str, args: list, answer, *answer_args):
+    """
+    Call answer(*answer_args), which returns the exit code of the call if it answered it
+    without exec'ing the tool, or None. With trace on, the calls it answers are recorded.
+    """
+    if not cfg.get('trace', False):
+        return answer(*answer_args)
+    from interceptor.trace import now, record_answered_call
+    start = now()
+    returncode = answer(*answer_args)
+    if returncode is not None:
+        record_answered_call(tool_name, args, returncode, start)
+    return returncode
+
+
+def exit_with_status(returncode: int) -> None:
+    """
+    Exit the way a child process that returned given returncode did, re-raising the signal
+    that killed it if it was killed.
+    """
+    if returncode < 0:
+        import signal
+        # SIGKILL can't be handled, so it always acts by default
+        if -returncode != signal.SIGKILL:
+            signal.signal(-returncode, signal.SIG_DFL)
+        os.kill(os.getpid(), -returncode)
+        returncode = 128 - returncode
+    sys.exit(returncode)
+
+
+def original_location(location: str):
+    """
+    Return the path to the original binary if the tool was unintercepted while the wrapper
+    was running, ie. the intercepted binary is gone and the original is back in place and not
+    a wrapper. Otherwise return None.
+    """
+    if not location.endswith(INTERCEPTED) or os.path.lexists(location):
+        return None
+    original = location[:-len(INTERCEPTED)]
+    try:
+        with open(original, 'rb') as f_in:
+            if INTERCEPTOR_WRAPPER_STRING.encode('utf-8') in f_in.read(512):
+                return None
+    except OSError:
+        return None
+    return original
+
+
+def _exec(location: str, args: list) -> None:
+    try:
+        os.execv(location, args)
+    except FileNotFoundError:
+        # also raised if eg. the interpreter of a script is missing
+        original = original_location(location)
+        if original is None:
+            raise
+    # the tool was unintercepted while this was running, so the original is back in place
+    os.execv(original, args)
@@ -0,0 +1,212 @@
+"""
+The sh wrapper backend.
+
+For configurations that only disable, replace, append, prepend and deduplicate arguments
+starting Python at all is pure overhead, so such a configuration can be translated into
+a shell script with it's rules inlined. Every generated script is checked against
+apply_configuration() with a single command line of every argument that the rules know
+before it is used, and if anything goes wrong the Python wrapper is used instead. The
+backends are compared over randomized configurations and command lines by
+tests/test_shell.py.
+
+The script falls back to the Python runtime on it's own if the configuration file is newer
+than the script, or if deduplication is on and an argument contains a newline.
+"""
+import os
+import subprocess
+import tempfile
+import typing as tp
+
+from interceptor.rules import compile_rules
+from interceptor.runtime import apply_configuration, TEMPLATE_VERSION
+
+# Shells to try, in order of preference. exec -a is not POSIX, but we need it to pass the
+# original argv[0], so the first one that supports it is used.
+SHELL_CANDIDATES = ['/bin/sh', '/bin/bash', '/usr/bin/bash']
+
+# Keys of the configuration that the sh backend can express. If any other key is set,
+# the Python wrapper has to be used.
+SUPPORTED_OPTIONS = {'args_to_disable', 'args_to_append', 'args_to_prepend', 'args_to_replace',
+                     'deduplication', 'wrapper_backend'}
+
+# present in the header of every wrapper generated by this backend
+SH_BACKEND_STRING = 'This is the sh backend'
+
+# arguments that need quoting, checked along with the ones that the rules know
+TRICKY_ARGUMENTS = ['', '-c', 'a b', "it's", '"', '*', '?', '[a]', '$HOME', '\\', '-', '--']
+
+_shell = None
+
+
+def quote(value: str) -> str:
+    return "'%s'" % (value.replace("'", "'\\''"),)
+
+
+def find_shell() -> tp.Optional[str]:
+    """
+    Return the path to the first shell that supports exec -a, or None if there's none.
+    """
+    global _shell
+    if _shell is None:
+        _shell = ''
+        for shell in SHELL_CANDIDATES:
+            if not os.path.exists(shell):
+                continue
+            try:
+                result = subprocess.run([shell, '-c', 'exec -a test true'],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError:
+                continue
+            if result.returncode == 0:
+                _shell = shell
+                break
+    return _shell or None
+
+
+def can_express(cfg: dict) -> bool:
+    """
+    Can given configuration be expressed by the sh backend?
+    """
+    for option, value in cfg.items():
+        if value and option not in SUPPORTED_OPTIONS:
+            return False
+    return find_shell() is not None
+
+
+def render(cfg: dict, tool_name: str, location: str, config_paths: tp.List[str],
+           python_fallback: tp.List[str]) -> str:
+    """
+    Render a sh wrapper for given configuration.
+
+    :param cfg: configuration dictionary. can_express() must be True for it.
+    :param tool_name: name of the intercepted tool
+    :param location: path to the intercepted binary
+    :param config_paths: paths to the configuration file and the ones it extends. If any of
+        them is newer than the wrapper, the wrapper will fall back to the Python runtime.
+    :param python_fallback: command that runs the Python runtime, the wrapper will append
+        it's argv[0] and arguments to it
+    """
+    rules = compile_rules(cfg)
+    disabled = list(rules.disabled)
+    replacements = {source: target for source, (target, _) in rules.replacements.items()}
+    appends, prepends = rules.appends, rules.prepends
+    candidates = {arg: i for i, arg in enumerate(appends + prepends)}
+    deduplication = rules.deduplication
+
+    lines = ['#!%s' % (find_shell(),),
+             '',
+             '# Generated automatically by interceptor, a tool to intercept calls',
+             '# to the commands and to alter their arguments.',
+             '',
+             '# To learn more visit https://github.com/Dronehub/interceptor',
+             '',
+             '# %s, generated from %s' % (SH_BACKEND_STRING, ', '.join(config_paths)),
+             '# It will be regenerated each time the configuration changes.',
+             '',
+             '_ic_toolname=%s' % (quote(tool_name),),
+             '_ic_location=%s' % (quote(location),),
+             '_ic_template_version=%s' % (TEMPLATE_VERSION,),
+             '',
+             'fallback() {',
+             '    exec %s "$0" "$@"' % (' '.join(quote(arg) for arg in python_fallback),),
+             '}',
+             '',
+             'for _ic_config in %s; do' % (' '.join(quote(path) for path in config_paths),),
+             '    if [ "$_ic_config" -nt "$0" ]; then',
+             '        fallback "$@"',
+             '    fi',
+             'done',
+             '']
+
+    if candidates:
+        variables = ' '.join('_ic_present_%s' % (i,) for i in candidates.values())
+        lines.extend(['unset %s' % (variables,), ''])
+
+    if deduplication:
+        lines.extend(['_ic_nl=\'',
+                      '\'',
+                      'case "$*" in',
+                      '    *"$_ic_nl"*) fallback "$@" ;;',
+                      'esac',
+                      '_ic_seen="$_ic_nl"',
+                      ''])
+
+    if disabled or replacements or candidates or deduplication:
+        lines.append('for _ic_arg do')
+        lines.append('    shift')
+        if disabled or replacements:
+            lines.append('    case $_ic_arg in')
+            if disabled:
+                patterns = '|'.join(quote(arg) for arg in disabled)
+                lines.append('        %s) continue ;;' % (patterns,))
+            for source, target in replacements.items():
+                lines.append('        %s) _ic_arg=%s ;;' % (quote(source), quote(target)))
+            lines.append('    esac')
+        if candidates:
+            lines.append('    case $_ic_arg in')
+            for arg, i in candidates.items():
+                lines.append('        %s) _ic_present_%s=1 ;;' % (quote(arg), i))
+            lines.append('    esac')
+        if deduplication:
+            lines.extend(['    case $_ic_seen in',
+                          '        *"$_ic_nl$_ic_arg$_ic_nl"*) continue ;;',
+                          '    esac',
+                          '    _ic_seen="$_ic_seen$_ic_arg$_ic_nl"'])
+        lines.append('    set -- "$@" "$_ic_arg"')
+        lines.append('done')
+        lines.append('')
+
+    for arg in appends:
+        lines.append('[ -n "$_ic_present_%s" ] || set -- "$@" %s' % (candidates[arg], quote(arg)))
+    for arg in reversed(prepends):
+        lines.append('[ -n "$_ic_present_%s" ] || set -- %s "$@"' % (candidates[arg], quote(arg)))
+
+    lines.append('exec -a "$0" "$_ic_location" "$@"')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def known_arguments(cfg: dict) -> tp.List[str]:
+    """
+    Return the arguments that the rules of given configuration know, and TRICKY_ARGUMENTS.
+    """
+    arguments = list(cfg.get('args_to_disable', []))
+    for source, target in cfg.get('args_to_replace', []):
+        arguments.extend((source, target))
+    arguments.extend(cfg.get('args_to_append', []))
+    arguments.extend(cfg.get('args_to_prepend', []))
+    return arguments + TRICKY_ARGUMENTS
+
+
+def verify(cfg: dict, tool_name: str,
+           command_lines: tp.Optional[tp.List[tp.List[str]]] = None) -> bool:
+    """
+    Check that the sh wrapper for given configuration rewrites given command lines (without
+    argv[0]) exactly the same as apply_configuration() does.
+
+    :param command_lines: by default a single one, of known_arguments() twice over, so that
+        deduplication is exercised too
+    """
+    if command_lines is None:
+        command_lines = [known_arguments(cfg) * 2]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        printer = os.path.join(tmp_dir, 'printer')
+        with open(printer, 'w') as f_out:
+            # the leading marker tells no arguments apart from a single empty argument
+            f_out.write('#!/bin/sh\nprintf "%s\\0" - "$@"\n')
+        os.chmod(printer, 0o755)
+
+        script = os.path.join(tmp_dir, tool_name)
+        with open(script, 'w') as f_out:
+            # the script is it's own configuration, so that it never falls back to Python
+            f_out.write(render(cfg, tool_name, printer, [script], ['/bin/false']))
+        os.chmod(script, 0o755)
+
+        for arguments in command_lines:
+            expected = apply_configuration(cfg, tool_name, [script, *arguments])[1:]
+            result = subprocess.run([script, *arguments], stdout=subprocess.PIPE)
+            if result.returncode != 0:
+                return False
+            if result.stdout.decode('utf-8').split('\0')[1:-1] != expected:
+                return False
+    return True
@@ -0,0 +1,165 @@
+"""
+The shim directory mode, intercepting tools without touching their binaries.
+
+SHIM_DIR holds a symlink named after every shimmed tool, all of them to a single dispatcher,
+and is put in front of PATH. The dispatcher tells the tool by the name it was called by,
+finds the tool's binary in PATH, skipping the shims, and runs the wrapper for it. So shimming
+or unshimming a whole toolchain is just creating or removing symlinks, and package upgrades,
+which replace the binaries, don't undo the interception.
+
+Resolved binaries are remembered in a per-user index, as PATH to tool name to (path to the
+binary, ((directory, mtime), ...)) for the directories of PATH up to and including the one
+with the binary. As long as none of these directories changed, no binary could have been
+added in front of it or removed, and the remembered path is used without scanning PATH.
+The index is kept in SHIM_INDEX_DIR/<uid>, created as 0700, and it's ignored unless it and
+that directory are owned by the user and writable by nobody else, so that users can't make
+each other's shims run something else. So is an entry whose binary is not in the last
+directory searched.
+
+This module is imported by the dispatcher, so it imports only os, sys and stat at the top.
+"""
+import os
+import stat
+import sys
+
+from interceptor.paths import DISPATCHER_PATH, INTERCEPTED, SHIM_DIR, SHIM_INDEX_DIR, \
+    user_directory
+from interceptor.runtime import run_wrapper
+
+# PATHs remembered in the index, before it starts anew
+MAX_INDEXED_PATHS = 16
+
+
+def shim_path(tool_name: str) -> str:
+    return os.path.join(SHIM_DIR, tool_name)
+
+
+def is_shimmed(tool_name: str) -> bool:
+    return os.path.islink(shim_path(tool_name))
+
+
+def index_path():
+    """
+    Return the path to the index of the current user, or None if it's directory can't be
+    trusted.
+    """
+    directory = user_directory(SHIM_INDEX_DIR)
+    return None if directory is None else os.path.join(directory, 'index')
+
+
+def _load_index(path: str) -> dict:
+    import marshal
+    try:
+        with open(path, 'rb') as f_in:
+            st = os.fstat(f_in.fileno())
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or \
+                    st.st_mode & 0o022:
+                return {}
+            index = marshal.load(f_in)
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def _save_index(path: str, index: dict) -> None:
+    import marshal
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f_out:
+            marshal.dump(index, f_out)
+        os.rename(tmp_path, path)
+    except OSError:
+        # the index is only a cache
+        pass
+
+
+def _is_valid(entry) -> bool:
+    """
+    Is it an entry of the index whose binary is in the last directory searched, and none of
+    the directories changed?
+    """
+    try:
+        location, directories = entry
+        if not directories or os.path.normpath(directories[-1][0]) != \
+                os.path.normpath(os.path.dirname(location)):
+            return False
+    except (TypeError, ValueError, IndexError):
+        return False
+    return _is_unchanged(directories)
+
+
+def _is_unchanged(directories: tuple) -> bool:
+    for directory, mtime_ns in directories:
+        try:
+            if os.stat(directory).st_mtime_ns != mtime_ns:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def search(tool_name: str, path_variable: str) -> tuple:
+    """
+    Find the binary of a tool in PATH, skipping the shims.
+
+    :return: a tuple of (path to the binary or None, ((directory, mtime), ...) of the
+        directories searched)
+    """
+    searched = []
+    for directory in path_variable.split(':'):
+        # an empty entry is the working directory, which is never trusted
+        if not directory or os.path.normpath(directory) == SHIM_DIR:
+            continue
+        try:
+            searched.append((directory, os.stat(directory).st_mtime_ns))
+        except OSError:
+            continue
+        path = os.path.join(directory, tool_name)
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            continue
+        if not stat.S_ISREG(mode) or not os.access(path, os.X_OK):
+            continue
+        if os.path.realpath(path) == os.path.realpath(DISPATCHER_PATH):
+            # a shim that's not in SHIM_DIR
+            continue
+        if os.path.exists(path + INTERCEPTED):
+            # intercepted in place too, don't apply the rules twice
+            path += INTERCEPTED
+        return path, tuple(searched)
+    return None, tuple(searched)
+
+
+def resolve(tool_name: str) -> str:
+    """
+    Return the path to the binary of a tool, or None if it's not in PATH.
+    """
+    path_variable = os.environ.get('PATH', '')
+    path = index_path()
+    index = {} if path is None else _load_index(path)
+    entry = index.get(path_variable, {}).get(tool_name)
+    if entry is not None and _is_valid(entry):
+        return entry[0]
+    location, searched = search(tool_name, path_variable)
+    if location is not None and path is not None:
+        if path_variable not in index and len(index) >= MAX_INDEXED_PATHS:
+            index = {}
+        index.setdefault(path_variable, {})[tool_name] = (location, searched)
+        _save_index(path, index)
+    return location
+
+
+def run_shim(template_version: int) -> None:
+    """
+    Entry point of the dispatcher. Finds the binary of the tool it was called as and runs
+    the wrapper for it.
+    """
+    tool_name = os.path.basename(sys.argv[0])
+    location = resolve(tool_name)
+    if location is None:
+        sys.stderr.write('interceptor: %s not found in PATH\n' % (tool_name,))
+        sys.exit(127)
+    # tools such as gcc find their other parts relative to argv[0]
+    sys.argv[0] = location
+    run_wrapper(tool_name, location, template_version)
@@ -0,0 +1,86 @@
+"""
+Limiting how many calls of a tool run at the same time.
+
+A tool with max_concurrency set to N has N slot files, SLOTS_DIR/<tool>.0 to <tool>.N-1.
+Before exec'ing the tool, the wrapper takes an exclusive flock() on one of them, waiting
+if all of them are taken. The descriptor is inherited over exec, so the tool itself holds
+the slot, and the kernel releases it when the process exits, however it does (even if it's
+killed with SIGKILL). Note that processes that the tool starts in the background inherit the
+descriptor as well, and hold the slot until they exit too.
+
+This module is imported by the generated wrappers, so it imports only os, time and fcntl.
+"""
+import fcntl
+import os
+import time
+
+from interceptor.paths import SLOTS_DIR
+
+# bounds of the time to sleep between attempts at taking a slot, in seconds
+MIN_BACKOFF = 0.001
+MAX_BACKOFF = 0.05
+
+
+def slot_path(tool_name: str, slot: int) -> str:
+    return os.path.join(SLOTS_DIR, '%s.%s' % (tool_name, slot))
+
+
+def _open_slot(tool_name: str, slot: int) -> int:
+    # a read-only descriptor is enough for flock(), so slot files created by one user
+    # can be taken by all the others
+    return os.open(slot_path(tool_name, slot), os.O_RDONLY | os.O_CREAT, 0o444)
+
+
+def _try_slot(tool_name: str, slot: int) -> int:
+    """
+    Return a descriptor holding given slot, or -1 if it's taken.
+    """
+    fd = _open_slot(tool_name, slot)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return -1
+    return fd
+
+
+def acquire_slot(tool_name: str, max_concurrency: int) -> tuple:
+    """
+    Take one of the tool's slots, waiting until one is free.
+
+    The returned descriptor is inheritable, so that the slot is held until the exec'd tool
+    exits. Just don't close it.
+
+    :return: a tuple of (the descriptor, seconds spent waiting)
+    :raises OSError: if a slot file can't be opened, eg. SLOTS_DIR is missing
+    """
+    started_at = time.perf_counter()
+    first = os.getpid() % max_concurrency
+    backoff = MIN_BACKOFF
+    while True:
+        for i in range(max_concurrency):
+            fd = _try_slot(tool_name, (first + i) % max_concurrency)
+            if fd != -1:
+                os.set_inheritable(fd, True)
+                return fd, time.perf_counter() - started_at
+        time.sleep(backoff)
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+def slots_taken(tool_name: str, max_concurrency: int) -> int:
+    """
+    Return how many of the tool's slots are taken right now.
+    """
+    taken = 0
+    for slot in range(max_concurrency):
+        try:
+            fd = os.open(slot_path(tool_name, slot), os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            taken += 1
+        finally:
+            os.close(fd)
+    return taken
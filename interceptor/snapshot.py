@@ -0,0 +1,116 @@
+"""
+A precompiled, mmap-able snapshot of every configuration in /etc/interceptor.d.
+
+The wrappers read their configuration from here instead of parsing JSON on every call.
+The file layout is:
+
+* 4 bytes of magic, 4 bytes of snapshot format version and 4 bytes of index length,
+  all integers little-endian
+* a marshalled index, mapping tool name to (offset, length, dependencies), where
+  dependencies is a tuple of (path, st_ino, st_mtime_ns, st_size) of the files the entry
+  was built from
+* marshalled entries, at the offsets given by the index. An entry is a tuple of
+  the configuration dictionary and it's compiled rules (see interceptor.rules)
+
+An entry is only used if all of it's dependencies still match a stat() of the file system,
+otherwise the caller is expected to fall back to reading the JSON.
+
+This module is imported by the generated wrappers, so keep it's imports (typing included)
+to the bare minimum.
+"""
+import marshal
+import mmap
+import os
+
+from interceptor.paths import SNAPSHOT_PATH
+
+MAGIC = b'ICSN'
+FORMAT_VERSION = 4
+HEADER_SIZE = 12
+
+
+def stat_dependency(path: str) -> tuple:
+    """
+    Return the dependency tuple for given path, following symlinks.
+
+    :raises OSError: file does not exist
+    """
+    st = os.stat(path)
+    return path, st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def is_dependency_fresh(dependency: tuple) -> bool:
+    path, ino, mtime_ns, size = dependency
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_ino == ino and st.st_mtime_ns == mtime_ns and st.st_size == size
+
+
+def read_snapshot_entry(name: str, path: str = SNAPSHOT_PATH):
+    """
+    Return the entry for given tool, or None if the snapshot does not exist, is corrupt,
+    does not contain it or the entry is stale.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:4] != MAGIC or int.from_bytes(mm[4:8], 'little') != FORMAT_VERSION:
+                return None
+            index_end = HEADER_SIZE + int.from_bytes(mm[8:12], 'little')
+            entry = marshal.loads(mm[HEADER_SIZE:index_end]).get(name)
+            if entry is None:
+                return None
+            offset, length, dependencies = entry
+            for dependency in dependencies:
+                if not is_dependency_fresh(dependency):
+                    return None
+            return marshal.loads(mm[offset:offset + length])
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(entries: dict, path: str = SNAPSHOT_PATH) -> None:
+    """
+    Atomically replace the snapshot with given entries.
+
+    :param entries: a dictionary of tool name to a tuple of (entry, dependencies)
+    :param path: path to write the snapshot to
+    """
+    payloads = []
+    index = {}
+    for name, (entry, dependencies) in sorted(entries.items()):
+        payloads.append((name, marshal.dumps(entry), tuple(dependencies)))
+
+    # The offsets depend on the length of the index, which depends on the offsets,
+    # so iterate until it settles. It always does within a few rounds.
+    index_bytes = b''
+    while True:
+        offset = HEADER_SIZE + len(index_bytes)
+        for name, payload, dependencies in payloads:
+            index[name] = offset, len(payload), dependencies
+            offset += len(payload)
+        new_index_bytes = marshal.dumps(index)
+        settled = len(new_index_bytes) == len(index_bytes)
+        index_bytes = new_index_bytes
+        if settled:
+            break
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f_out:
+        f_out.write(MAGIC)
+        f_out.write(FORMAT_VERSION.to_bytes(4, 'little'))
+        f_out.write(len(index_bytes).to_bytes(4, 'little'))
+        f_out.write(index_bytes)
+        for _, payload, _ in payloads:
+            f_out.write(payload)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
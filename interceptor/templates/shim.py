@@ -0,0 +1,15 @@
+#!{EXECUTABLE} -IS
+
+# Generated automatically by interceptor, a tool to intercept calls
+# to the commands and to alter their arguments.
+
+# To learn more visit https://github.com/Dronehub/interceptor
+
+# The dispatcher of the shim directory, every shim is a symlink to it.
+
+import sys
+sys.path.insert(0, '{PACKAGE_PATH}')
+from interceptor.shims import run_shim
+
+if __name__ == '__main__':
+    run_shim({TEMPLATE_VERSION})
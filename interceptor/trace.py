@@ -0,0 +1,328 @@
+"""
+Tracing calls, to see what takes the wall time of a build.
+
+With trace enabled for a tool, the wrapper runs the tool as a child instead of exec'ing it,
+and once it exits appends a record of the call to the trace directory, with a single write()
+to a descriptor opened with O_APPEND. A record is a line of JSON, of the tool's name,
+the pid of the tool, the pid of whatever called it (ppid), the host, the working directory,
+the rewritten command line, it's exit code and when it started and ended, in microseconds
+since the epoch. Each host and user append to a file of their own, <host>.<uid>.jsonl, which
+is opened with O_NOFOLLOW and written to only if the user owns it.
+
+Calls that the wrapper answers without exec'ing the tool are recorded too, with the pid of
+the wrapper: memoized probes, compilations served or run by the compile cache, and calls
+dispatched to a worker, see record_answered_call().
+
+The trace directory is INTERCEPTOR_TRACE_DIR if it's set, so that a build can trace into
+a directory of it's own, or TRACES_DIR otherwise.
+
+While the tool runs, the wrapper waits for it with the signals in FORWARDED blocked, and
+passes on those that were sent to it by kill(). Those sent by the terminal to the whole
+process group reach the tool anyway, so they are not passed on twice. The wrapper exits the
+way the tool did, re-raising the signal that killed it if it was killed. The job control
+signals are left alone, so the wrapper stops and continues along with the tool.
+
+intercept trace export merges the records into the Chrome trace event format, as read by
+chrome://tracing and https://ui.perfetto.dev, with the calls laid out in as few lanes as they
+fit in, and summarizes them per tool, see summarize().
+
+Running is imported by the generated wrappers, so this module imports only os and signal at
+the top.
+"""
+import os
+import signal
+
+from interceptor.paths import TRACES_DIR
+from interceptor.runtime import original_location
+
+FORWARDED = {signal.SIGHUP, signal.SIGINT, signal.SIGQUIT, signal.SIGTERM, signal.SIGUSR1,
+             signal.SIGUSR2, signal.SIGALRM, signal.SIGWINCH}
+
+
+def trace_directory() -> str:
+    return os.environ.get('INTERCEPTOR_TRACE_DIR') or TRACES_DIR
+
+
+def now() -> int:
+    """
+    :return: microseconds since the epoch
+    """
+    import time
+    return int(time.time() * 1000000)
+
+
+def _spawn(location: str, args: list, mask) -> int:
+    """
+    Start the tool with given signal mask.
+
+    :return: the pid of the tool
+    """
+    if not hasattr(os, 'posix_spawn'):
+        # before Python 3.8
+        return _fork_exec(location, args, mask)
+    try:
+        return os.posix_spawn(location, args, os.environ, setsigmask=mask)
+    except FileNotFoundError:
+        original = original_location(location)
+        if original is None:
+            raise
+    # the tool was unintercepted while this was running, so the original is back in place
+    return os.posix_spawn(original, args, os.environ, setsigmask=mask)
+
+
+def _fork_exec(location: str, args: list, mask) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        try:
+            os.execv(location, args)
+        except FileNotFoundError:
+            original = original_location(location)
+            if original is None:
+                raise
+        os.execv(original, args)
+    except OSError as e:
+        os.write(2, ('interceptor: could not run %s: %s\n' % (location, e)).encode())
+    finally:
+        os._exit(127)
+
+
+def _wait(pid: int) -> int:
+    """
+    Wait for the child, passing on the signals sent to this process.
+
+    :return: the exit code of the child, negative if it was killed by a signal
+    """
+    waited = FORWARDED | {signal.SIGCHLD}
+    while True:
+        info = signal.sigwaitinfo(waited)
+        if info.si_signo == signal.SIGCHLD:
+            # it may have only stopped or continued
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+            if reaped:
+                if os.WIFSIGNALED(status):
+                    return -os.WTERMSIG(status)
+                return os.WEXITSTATUS(status)
+        elif info.si_code <= 0:
+            # sent by kill() or sigqueue(), rather than by the terminal
+            try:
+                os.kill(pid, info.si_signo)
+            except ProcessLookupError:
+                pass
+
+
+def run_traced(tool_name: str, location: str, args: list) -> int:
+    """
+    Run the tool as a child and append a record of the call to the trace.
+
+    :param tool_name: name of the intercepted tool
+    :param location: path to the intercepted binary
+    :param args: the rewritten command line, including argv[0]
+    :return: the exit code of the tool, negative if it was killed by a signal
+    """
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, FORWARDED | {signal.SIGCHLD})
+    start = now()
+    pid = _spawn(location, args, old_mask)
+    returncode = _wait(pid)
+    end = now()
+
+    # the tool got whatever is still pending, and the signal that killed it gets re-raised
+    for signum in FORWARDED:
+        signal.signal(signum, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+    _try_record(tool_name, pid, args, returncode, start, end)
+    return returncode
+
+
+def record_answered_call(tool_name: str, args: list, returncode: int, start: int) -> None:
+    """
+    Append a record of a call that the wrapper answered without exec'ing the tool, ending now.
+
+    :param start: as returned by now() before the call was answered
+    """
+    _try_record(tool_name, os.getpid(), args, returncode, start, now())
+
+
+def _try_record(tool_name: str, pid: int, args: list, returncode: int, start: int,
+                end: int) -> None:
+    try:
+        record_call({'tool': tool_name, 'pid': pid, 'ppid': os.getppid(),
+                     'host': os.uname().nodename, 'cwd': os.getcwd(), 'argv': args,
+                     'exit': returncode, 'start': start, 'end': end})
+    except OSError:
+        # tracing must not fail the build
+        pass
+
+
+def record_call(record: dict) -> None:
+    import json
+    directory = trace_directory()
+    path = os.path.join(directory, '%s.%s.jsonl' % (record['host'], os.getuid()))
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC | os.O_NOFOLLOW
+    try:
+        fd = os.open(path, flags, 0o644)
+    except FileNotFoundError:
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, flags, 0o644)
+    try:
+        # one planted by someone else could be read by them, or rewritten
+        if os.fstat(fd).st_uid == os.getuid():
+            os.write(fd, (json.dumps(record) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def read_calls(directory: str) -> list:
+    """
+    Read the records of all the calls traced into given directory, sorted by their start.
+    Lines that can't be read, eg. written by a wrapper killed halfway, are skipped.
+    """
+    import json
+    calls = []
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+    for name in names:
+        if not name.endswith('.jsonl'):
+            continue
+        with open(os.path.join(directory, name), 'r', encoding='utf-8',
+                  errors='replace') as f_in:
+            for line in f_in:
+                try:
+                    call = json.loads(line)
+                    if call['end'] >= call['start']:
+                        calls.append(call)
+                except (ValueError, KeyError, TypeError):
+                    continue
+    calls.sort(key=lambda call: (call['start'], -call['end']))
+    return calls
+
+
+def _nested(calls: list) -> list:
+    """
+    :return: whether each of the calls was made by another traced call, eg. cc1 by gcc
+    """
+    by_pid = {}
+    for call in calls:
+        by_pid.setdefault((call['host'], call['pid']), []).append(call)
+    return [any(parent['start'] <= call['start'] <= parent['end']
+                for parent in by_pid.get((call['host'], call['ppid']), ()))
+            for call in calls]
+
+
+def assign_lanes(calls: list) -> list:
+    """
+    Lay the calls out in as few lanes as they fit in without overlapping.
+
+    :param calls: sorted by their start
+    :return: the lane of each call, counted from 0
+    """
+    import heapq
+    lanes = []
+    busy = []
+    free = []
+    for call in calls:
+        while busy and busy[0][0] <= call['start']:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        lane = heapq.heappop(free) if free else len(busy)
+        heapq.heappush(busy, (call['end'], lane))
+        lanes.append(lane)
+    return lanes
+
+
+def summarize(calls: list) -> dict:
+    """
+    Summarize the calls, as a dictionary of:
+
+    * wall_time - from the start of the first call to the end of the last one
+    * idle_time - when no traced call was running
+    * peak_concurrency and average_concurrency - of the calls running at once, while any was
+    * tools - a dictionary of tool name to a dictionary of:
+
+      * calls and failed - amount of calls and of those that did not exit with 0
+      * total_time - sum of the durations of the calls
+      * busy_time - when any call of the tool was running
+      * critical_time - when a call of the tool was the only one running. Nothing else could
+        go on meanwhile, so it certainly lies on the critical path of the build.
+      * peak_concurrency - of the calls of the tool running at once
+
+    Times are in seconds. Calls made by other traced calls, eg. cc1 by gcc, count towards
+    the concurrency and the critical time of the call that made them.
+    """
+    nested = _nested(calls)
+    tools = {}
+    edges = []
+    for call, is_nested in zip(calls, nested):
+        tool = tools.setdefault(call['tool'], {
+            'calls': 0, 'failed': 0, 'total_time': 0, 'busy_time': 0, 'critical_time': 0,
+            'peak_concurrency': 0})
+        tool['calls'] += 1
+        tool['failed'] += call['exit'] != 0
+        tool['total_time'] += call['end'] - call['start']
+        edges.append((call['start'], 1, call['tool'], is_nested))
+        edges.append((call['end'], -1, call['tool'], is_nested))
+    # calls that end free their place before the ones that start at the same time take it
+    edges.sort(key=lambda edge: (edge[0], edge[1]))
+
+    running = {name: 0 for name in tools}
+    top_level = {name: 0 for name in tools}
+    total_running = 0
+    peak = 0
+    concurrency_time = 0
+    active_time = 0
+    previous = edges[0][0] if edges else 0
+    for moment, delta, name, is_nested in edges:
+        elapsed = moment - previous
+        if total_running:
+            active_time += elapsed
+            concurrency_time += elapsed * total_running
+            for tool_name, count in running.items():
+                if count:
+                    tools[tool_name]['busy_time'] += elapsed
+            if total_running == 1:
+                only = next(tool_name for tool_name, count in top_level.items() if count)
+                tools[only]['critical_time'] += elapsed
+        previous = moment
+        running[name] += delta
+        tools[name]['peak_concurrency'] = max(tools[name]['peak_concurrency'], running[name])
+        if not is_nested:
+            top_level[name] += delta
+            total_running += delta
+            peak = max(peak, total_running)
+
+    wall_time = edges[-1][0] - edges[0][0] if edges else 0
+    for tool in tools.values():
+        for key in ('total_time', 'busy_time', 'critical_time'):
+            tool[key] /= 1000000
+    return {'wall_time': wall_time / 1000000,
+            'idle_time': (wall_time - active_time) / 1000000,
+            'peak_concurrency': peak,
+            'average_concurrency': concurrency_time / active_time if active_time else 0,
+            'tools': tools}
+
+
+def to_chrome_trace(calls: list) -> dict:
+    """
+    Convert the calls into the Chrome trace event format, as complete ("X") events of
+    a single process, a thread per lane.
+    """
+    origin = calls[0]['start'] if calls else 0
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0,
+               'args': {'name': 'build'}}]
+    lanes = assign_lanes(calls)
+    for lane in range(max(lanes) + 1 if lanes else 0):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane + 1,
+                       'args': {'name': 'lane %s' % (lane + 1,)}})
+    for call, lane in zip(calls, lanes):
+        events.append({'name': call['tool'], 'cat': 'exit %s' % (call['exit'],), 'ph': 'X',
+                       'ts': call['start'] - origin, 'dur': call['end'] - call['start'],
+                       'pid': 1, 'tid': lane + 1,
+                       'args': {'pid': call['pid'], 'ppid': call['ppid'], 'host': call['host'],
+                                'cwd': call['cwd'], 'argv': call['argv'],
+                                'exit': call['exit']}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {'summary': summarize(calls)}}
@@ -1,22 +1,56 @@
 import logging
 import os
-
-from satella.os import whereis
+import stat
 import sys
 import typing as tp
 
+from interceptor.paths import SHIM_DIR
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 
+def whereis_many(apps: tp.Iterable[str]) -> tp.Dict[str, tp.List[str]]:
+    """
+    Find executables of all the given names with a single scan of PATH.
+
+    Directories that occur in PATH more than once, also by a symlink, are scanned only once,
+    so that no executable is returned twice. The shim directory is skipped, since it's
+    shims are not binaries of the tools.
+
+    :return: a dictionary of name to a list of paths to it's executables, in PATH order
+    """
+    found = {app: [] for app in apps}
+    scanned = {os.path.realpath(SHIM_DIR)}
+    for directory in os.environ.get('PATH', '').split(':'):
+        real_directory = os.path.realpath(directory)
+        if real_directory in scanned:
+            continue
+        scanned.add(real_directory)
+        try:
+            files = os.listdir(directory)
+        except OSError:
+            continue
+        for file in files:
+            if file not in found:
+                continue
+            path = os.path.join(directory, file)
+            try:
+                mode = os.stat(path).st_mode
+            except OSError:
+                continue
+            if stat.S_ISDIR(mode) or not mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+                continue
+            found[file].append(path)
+    return found
+
+
 def filter_whereis(app: str, abort_on_failure=True) -> tp.Iterator[str]:
     """
     Return a position of an executable. Verify that it's executable.
     """
     found = False
-    for path in whereis(app):
-        if os.path.isdir(path):
-            continue
+    for path in whereis_many([app])[app]:
         found = True
         yield path
 
@@ -0,0 +1,149 @@
+"""
+A stand-in worker for the dispatch mode, see interceptor.dispatch.
+
+It listens on a Unix socket and runs each call it receives locally, at most jobs of them at
+once, as whoever started it. It runs only binaries of intercepted tools (ones named
+*-intercepted), and the socket is accessible only to it's owner, since whoever can connect
+can run them with any arguments, environment and resource controls, which it applies to the
+tool before exec'ing it. If the wrapper goes away while the tool is
+running (eg. it's killed by Ctrl+C), the tool is killed, with the processes it started.
+"""
+import json
+import os
+import selectors
+# imported here, rather than in the forked child when the resource controls are applied
+import resource  # noqa: F401
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import typing as tp
+
+from interceptor.dispatch import REQUEST, STARTED, REFUSED, STDOUT, STDERR, EXIT, \
+    encode_frame, read_frame
+from interceptor.paths import INTERCEPTED
+from interceptor.resources import apply_resource_policy, load_libc, validate_resource_policy
+
+CHUNK_SIZE = 65536
+
+
+class CallHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        try:
+            kind, payload = read_frame(self.request)
+        except (OSError, EOFError):
+            return
+        if kind != REQUEST:
+            return
+        try:
+            call = json.loads(payload.decode('utf-8'))
+            location, argv, cwd, env = call['location'], call['argv'], call['cwd'], call['env']
+            tool_name, policy = str(call.get('tool', '')), dict(call.get('policy') or {})
+        except (ValueError, KeyError, TypeError):
+            self.refuse('invalid request')
+            return
+        if not location.endswith(INTERCEPTED) or not os.path.isfile(location):
+            self.refuse('%s is not an intercepted binary' % (location,))
+            return
+        try:
+            validate_resource_policy(policy)
+        except ValueError as e:
+            self.refuse(str(e))
+            return
+
+        with self.server.jobs:
+            try:
+                process = subprocess.Popen(argv, executable=location, cwd=cwd, env=env,
+                                           stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE, start_new_session=True,
+                                           preexec_fn=(lambda: apply_resource_policy(
+                                               policy, tool_name)) if policy else None)
+            except (OSError, subprocess.SubprocessError) as e:
+                # SubprocessError if preexec_fn failed, the controls themselves only warn
+                self.refuse(str(e))
+                return
+            try:
+                self.request.sendall(encode_frame(STARTED))
+                self.stream(process)
+                returncode = process.wait()
+                self.request.sendall(encode_frame(EXIT, returncode.to_bytes(4, 'little',
+                                                                            signed=True)))
+            except OSError:
+                # the wrapper went away, kill the tool along with whatever it started
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+
+    def refuse(self, reason: str) -> None:
+        try:
+            self.request.sendall(encode_frame(REFUSED, reason.encode('utf-8')))
+        except OSError:
+            pass
+
+    def stream(self, process: subprocess.Popen) -> None:
+        """
+        Send the output of the process until it closes it.
+
+        :raises OSError: the wrapper went away
+        """
+        kinds = {process.stdout.fileno(): STDOUT, process.stderr.fileno(): STDERR}
+        with selectors.DefaultSelector() as selector:
+            for fd in kinds:
+                selector.register(fd, selectors.EVENT_READ)
+            # the wrapper sends nothing more, so this becomes readable only if it goes away
+            selector.register(self.request, selectors.EVENT_READ)
+            while kinds:
+                for key, _ in selector.select():
+                    if key.fileobj is self.request:
+                        raise ConnectionResetError('the wrapper went away')
+                    data = os.read(key.fd, CHUNK_SIZE)
+                    if data:
+                        self.request.sendall(encode_frame(kinds[key.fd], data))
+                    else:
+                        selector.unregister(key.fd)
+                        del kinds[key.fd]
+        process.stdout.close()
+        process.stderr.close()
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, jobs: int):
+        self.jobs = threading.BoundedSemaphore(jobs)
+        super().__init__(socket_path, CallHandler)
+
+
+def serve(socket_path: str, jobs: tp.Optional[int] = None) -> None:
+    """
+    Serve calls on given socket until interrupted.
+
+    :param jobs: how many calls to run at once, by default as many as there are CPUs
+    """
+    jobs = jobs or os.cpu_count() or 1
+    # so that ionice does not dlopen() it in a child forked while other threads run
+    load_libc()
+    with socket.socket(socket.AF_UNIX) as probe:
+        if probe.connect_ex(socket_path) == 0:
+            print('A worker is already listening on %s' % (socket_path,))
+            sys.exit(1)
+    try:
+        # left behind by a worker that did not exit cleanly
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+    old_umask = os.umask(0o077)
+    try:
+        server = WorkerServer(socket_path, jobs)
+    finally:
+        os.umask(old_umask)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print('Running up to %s calls at once, listening on %s' % (jobs, socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
@@ -0,0 +1,214 @@
+"""
+Generating the wrappers that take the place of intercepted binaries.
+
+There are two backends, selected by the wrapper_backend key of the configuration:
+
+* python - the default, a Python script that calls interceptor.runtime
+* sh - a shell script with the rules inlined, see interceptor.shell. If the configuration
+  can't be expressed by it, or the generated script fails verification, the Python backend
+  is used instead.
+"""
+import os
+import re
+import shutil
+import sys
+import typing as tp
+
+import pkg_resources
+from satella.coding import silence_excs
+from satella.files import read_in_file
+
+from interceptor import registry, shell
+from interceptor.config import config_sources
+from interceptor.paths import config_path, INTERCEPTED
+from interceptor.runtime import INTERCEPTOR_WRAPPER_STRING, TEMPLATE_VERSION
+from interceptor.whereis import filter_whereis
+
+# directory that contains the interceptor package, added to sys.path by the wrappers
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BACKENDS = ('python', 'sh')
+
+# how wrappers of either backend record the TEMPLATE_VERSION they were generated with
+TEMPLATE_VERSION_REGEX = re.compile(r'run_wrapper\(.*, (\d+)\)|_ic_template_version=(\d+)')
+
+
+def is_wrapper(path_name: str) -> bool:
+    """
+    Is given file a wrapper generated by interceptor?
+    """
+    with silence_excs(OSError, UnicodeDecodeError), open(path_name, 'rb') as f_in:
+        return INTERCEPTOR_WRAPPER_STRING in f_in.read(512).decode('utf-8')
+    return False
+
+
+def is_sh_wrapper(path_name: str) -> bool:
+    """
+    Is given file a wrapper generated by the sh backend?
+    """
+    with silence_excs(OSError, UnicodeDecodeError), open(path_name, 'rb') as f_in:
+        return shell.SH_BACKEND_STRING in f_in.read(512).decode('utf-8')
+    return False
+
+
+def inspect_wrapper(path_name: str) -> tp.Optional[dict]:
+    """
+    Read the header of given file, and if it's a wrapper return a dictionary of it's backend
+    and the TEMPLATE_VERSION that it was generated with. Otherwise return None.
+
+    Wrappers generated before TEMPLATE_VERSION was introduced are version 1.
+    """
+    with silence_excs(OSError), open(path_name, 'rb') as f_in:
+        header = f_in.read(4096).decode('utf-8', errors='replace')
+        if INTERCEPTOR_WRAPPER_STRING not in header[:512]:
+            return None
+        match = TEMPLATE_VERSION_REGEX.search(header)
+        return {'backend': 'sh' if shell.SH_BACKEND_STRING in header[:512] else 'python',
+                'template_version': int(match.group(1) or match.group(2)) if match else 1}
+    return None
+
+
+def wrapper_template_version(path_name: str) -> int:
+    """
+    Return the TEMPLATE_VERSION that given wrapper was generated with.
+    """
+    info = inspect_wrapper(path_name)
+    return info['template_version'] if info is not None else 1
+
+
+def python_fallback_command(tool_name: str, location: str) -> tp.List[str]:
+    """
+    Return a command that runs the Python runtime for given tool, to which argv[0] and
+    the arguments have to be appended.
+    """
+    code = 'import sys; sys.argv.pop(0); sys.path.insert(0, %r); ' \
+           'from interceptor.runtime import run_wrapper; run_wrapper(%r, %r, %s)' % (
+               PACKAGE_PATH, tool_name, location, TEMPLATE_VERSION)
+    return [sys.executable, '-IS', '-c', code]
+
+
+def render_python_wrapper(tool_name: str, location: str) -> str:
+    source_file = pkg_resources.resource_filename(__name__, 'templates/cmdline.py')
+    source_content = read_in_file(source_file, 'utf-8')
+    return source_content.format(EXECUTABLE=sys.executable,
+                                 PACKAGE_PATH=PACKAGE_PATH,
+                                 TOOLNAME=tool_name,
+                                 LOCATION=location,
+                                 TEMPLATE_VERSION=TEMPLATE_VERSION)
+
+
+def render_dispatcher() -> str:
+    """
+    Render the dispatcher of the shim directory, see interceptor.shims.
+    """
+    source_file = pkg_resources.resource_filename(__name__, 'templates/shim.py')
+    source_content = read_in_file(source_file, 'utf-8')
+    return source_content.format(EXECUTABLE=sys.executable,
+                                 PACKAGE_PATH=PACKAGE_PATH,
+                                 TEMPLATE_VERSION=TEMPLATE_VERSION)
+
+
+def render_wrapper(tool_name: str, location: str, cfg: dict,
+                   current_content: tp.Optional[str] = None) -> str:
+    """
+    Render the wrapper for given tool, using the backend that it's configuration asks for.
+
+    :param tool_name: name of the intercepted tool
+    :param location: path to the intercepted binary
+    :param cfg: configuration dictionary of the tool
+    :param current_content: current content of the wrapper. If the sh backend renders exactly
+        that, the verification is skipped.
+    """
+    if cfg.get('wrapper_backend', 'python') == 'sh' and shell.can_express(cfg):
+        content = shell.render(cfg, tool_name, location,
+                               [config_path(name) for name in config_sources(tool_name)],
+                               python_fallback_command(tool_name, location))
+        if content == current_content or shell.verify(cfg, tool_name):
+            return content
+    return render_python_wrapper(tool_name, location)
+
+
+def _tmp_name(file_name: str) -> str:
+    return os.path.join(os.path.dirname(file_name),
+                        '.%s.%s.tmp' % (os.path.basename(file_name), os.getpid()))
+
+
+def copy_xattrs(source: str, target: str) -> None:
+    """
+    Copy the extended attributes, eg. the SELinux label, that can be copied.
+    """
+    if not hasattr(os, 'listxattr'):
+        return
+    with silence_excs(OSError):
+        for name in os.listxattr(source):
+            with silence_excs(OSError):
+                os.setxattr(target, name, os.getxattr(source, name))
+
+
+def write_wrapper(file_name: str, content: str, mode: int) -> None:
+    """
+    Write a wrapper via a rename, so that there's no moment at which it does not exist.
+
+    If file_name exists, the wrapper takes over it's ownership and extended attributes.
+    """
+    tmp_name = _tmp_name(file_name)
+    try:
+        with open(tmp_name, 'w', encoding='utf-8') as f_out:
+            f_out.write(content)
+        os.chmod(tmp_name, mode)
+        with silence_excs(OSError):
+            st = os.stat(file_name)
+            os.chown(tmp_name, st.st_uid, st.st_gid)
+            copy_xattrs(file_name, tmp_name)
+        os.rename(tmp_name, file_name)
+    except BaseException:
+        with silence_excs(OSError):
+            os.unlink(tmp_name)
+        raise
+
+
+def link_or_copy(source: str, target: str) -> None:
+    """
+    Make target a hard link to the binary at source, following symlinks, or a copy of it if
+    the binary is on another filesystem or can't be linked. An existing target is replaced
+    atomically.
+    """
+    tmp_name = _tmp_name(target)
+    try:
+        try:
+            os.link(os.path.realpath(source), tmp_name)
+        except OSError:
+            shutil.copy2(source, tmp_name)
+        os.rename(tmp_name, target)
+    except BaseException:
+        with silence_excs(OSError):
+            os.unlink(tmp_name)
+        raise
+
+
+def refresh_wrappers(configurations: tp.Dict[str, dict]) -> None:
+    """
+    Regenerate the wrappers of given tools, if their content would change.
+
+    :param configurations: tool name to it's configuration dictionary
+    """
+    for tool_name, cfg in configurations.items():
+        wrappers = registry.registered_wrappers(tool_name)
+        if wrappers is not None:
+            paths = list(wrappers)
+        else:
+            paths = [path for path in filter_whereis(tool_name, abort_on_failure=False)
+                     if is_wrapper(path)]
+        for path in paths:
+            if not os.path.exists(path + INTERCEPTED):
+                continue
+            current_content = read_in_file(path, 'utf-8')
+            content = render_wrapper(tool_name, path + INTERCEPTED, cfg, current_content)
+            if content != current_content:
+                write_wrapper(path, content, os.stat(path).st_mode & 0o777)
+                print('Regenerated the wrapper at %s' % (path,))
+            else:
+                # the sh backend falls back to Python if the configuration is newer than it
+                os.utime(path)
+            with silence_excs(OSError):
+                registry.register(tool_name, path, path + INTERCEPTED)
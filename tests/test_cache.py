@@ -0,0 +1,53 @@
+"""
+Tests of what the compile cache takes for a compilation it can handle.
+"""
+import sys
+
+import pytest
+
+from interceptor import cache
+
+
+@pytest.fixture(autouse=True)
+def sources(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ('a.c', 'b.c', 'a.src'):
+        (tmp_path / name).write_text('int a;\n')
+
+
+@pytest.mark.parametrize('arguments, output, dependency_file', [
+    (['-c', 'a.c'], 'a.o', None),
+    (['-c', 'a.c', '-o', 'obj/x.o'], 'obj/x.o', None),
+    (['-c', '-oobj/x.o', 'a.c'], 'obj/x.o', None),
+    (['-c', 'a.c', '-o', 'x.o', '-MD'], 'x.o', 'x.d'),
+    (['-c', 'a.c', '-o', 'x.o', '-MMD', '-MP', '-MF', 'deps/x.d', '-MT', 'x.o'], 'x.o',
+     'deps/x.d'),
+    (['-c', 'a.c', '-MFdeps/x.d'], 'a.o', None),
+    (['-c', 'a.src', '-x', 'c'], 'a.o', None),
+    (['-c', '-I', 'b.c', 'a.c'], 'a.o', None)])
+def test_cacheable(arguments, output, dependency_file):
+    compilation = cache.analyze(arguments)
+    assert compilation is not None
+    assert compilation.source == ('a.c' if 'a.c' in arguments else 'a.src')
+    assert (compilation.output, compilation.dependency_file) == (output, dependency_file)
+    assert compilation.preprocess_arguments[-1] == '-E'
+    assert '-c' not in compilation.preprocess_arguments
+    assert output not in compilation.preprocess_arguments
+
+
+@pytest.mark.parametrize('arguments', [
+    ['a.c'], ['-c', 'a.c', 'b.c'], ['-c', 'missing.c'], ['-c', 'a.src'], ['-c', '-'],
+    ['-c', 'a.c', '-E'], ['-c', 'a.c', '-S'], ['-c', 'a.c', '-M'], ['-c', 'a.c', '-MM'],
+    ['-c', 'a.c', '-Wp,-MMD,x.d'], ['-c', 'a.c', '-Xpreprocessor', '-MD'],
+    ['-c', 'a.c', '--coverage'], ['-c', 'a.c', '-gsplit-dwarf'], ['-c', '@args.rsp'],
+    ['-c', 'a.c', '-o'], ['-c', 'a.c', '-MF'], ['-c', 'a.c', '-I']])
+def test_uncacheable(arguments):
+    assert cache.analyze(arguments) is None
+
+
+def test_key_depends_on_the_command_line_and_the_preprocessed_source():
+    key = cache.compute_key(sys.executable, ['cc', '-c', 'a.c'], b'int a;')
+    assert key == cache.compute_key(sys.executable, ['cc', '-c', 'a.c'], b'int a;')
+    assert key != cache.compute_key(sys.executable, ['cc', '-c', 'a.c', '-O2'], b'int a;')
+    assert key != cache.compute_key(sys.executable, ['c++', '-c', 'a.c'], b'int a;')
+    assert key != cache.compute_key(sys.executable, ['cc', '-c', 'a.c'], b'int b;')
@@ -0,0 +1,97 @@
+"""
+Tests of the compiled pattern matcher against matching every pattern one by one.
+"""
+import fnmatch
+import marshal
+import random
+import re
+
+import pytest
+
+from interceptor import patterns
+
+CONFIGURATIONS = 40
+ARGUMENTS = 200
+
+# (spec, replacement) to build the rules from, sharing prefixes with each other
+RULES = [('prefix:-march=', '-mtune='), ('prefix:-m', '-M'), ('prefix:', 'all'),
+         ('glob:-march=*', '-march=x86-64'), ('glob:-march=native', 'native'),
+         ('glob:-W*', r'\0!'), ('glob:-Wno-*', 'no'), ('glob:*.o', r'obj:\0'),
+         ('glob:-O?', '-O2'), ('glob:-f[a-z]*', r'\g<0>'), ('glob:[!-]*', 'file'),
+         ('regex:-O([0-3])', r'-O\1'), ('regex:-O(1|2)', r'\\\1'), ('regex:-O1|-g', 'debug'),
+         ('regex:-Wno-(.*)', r'-W\1'), ('regex:-f(no-)?pic', r'\1PIC'),
+         ('regex:(?i:-O[sz])', 'small'), ('regex:-march=\\w+', 'word'), ('regex:-o+', 'o'),
+         ('regex:-f\\.x', 'dot'), ('regex:.*', 'any'), ('regex:a{2}b', 'aab')]
+
+ARGUMENT_PARTS = ['-march=', '-m', '-W', '-Wno-', '-O', '-f', '-o', '-g', 'no-', 'pic', '1',
+                  '3', 's', 'Z', 'native', 'x86', '.o', '.x', 'a', 'b', '', 'é', '*', '\\']
+
+
+def naive_match(spec: str, arg: str):
+    kind, pattern = patterns.parse_pattern(spec)
+    if kind == 'prefix':
+        return arg.startswith(pattern)
+    if kind == 'glob':
+        return fnmatch.fnmatchcase(arg, pattern)
+    return re.fullmatch(pattern, arg)
+
+
+def naive_replacement(rules: list, arg: str):
+    for index, (spec, replacement) in enumerate(rules):
+        match = naive_match(spec, arg)
+        if not match:
+            continue
+        kind, pattern = patterns.parse_pattern(spec)
+        if kind == 'prefix':
+            return index, replacement + arg[len(pattern):]
+        if kind == 'glob':
+            match = re.match(fnmatch.translate(pattern), arg)
+        return index, re.sub(r'\\(?:(\d{1,2})|g<(\d+)>|(\\))',
+                             lambda part: '\\' if part.group(3) else
+                             match.group(int(part.group(1) or part.group(2))) or '',
+                             replacement)
+    return None
+
+
+@pytest.mark.parametrize('seed', range(CONFIGURATIONS))
+def test_matcher_agrees_with_matching_one_by_one(seed):
+    rng = random.Random(seed)
+    disable_rules = rng.sample(RULES, rng.randint(0, len(RULES)))
+    replace_rules = rng.sample(RULES, rng.randint(1, len(RULES)))
+    matcher = patterns.compile_patterns([spec for spec, _ in disable_rules], replace_rules)
+    matcher = patterns.PatternMatcher.from_tables(
+        marshal.loads(marshal.dumps(matcher.to_tables())))
+    for _ in range(ARGUMENTS):
+        arg = ''.join(rng.choice(ARGUMENT_PARTS) for _ in range(rng.randint(0, 3)))
+        expected = next((index for index, (spec, _) in enumerate(disable_rules)
+                         if naive_match(spec, arg)), None)
+        assert matcher.disabling_rule(arg) == expected, (disable_rules, arg)
+        assert matcher.replacement(arg) == naive_replacement(replace_rules, arg), (
+            replace_rules, arg)
+
+
+@pytest.mark.parametrize('kind, pattern, prefix', [
+    ('glob', '-march=*', '-march='), ('glob', '-W[a-z]', '-W'), ('glob', '*.o', ''),
+    ('regex', '-O[0-3]', '-O'), ('regex', '-fo+', '-f'), ('regex', '-f\\.x\\d', '-f.x'),
+    ('regex', '-O(1|2)', '-O'), ('regex', '-O1|-g', ''), ('regex', '(?i)-o', ''),
+    ('regex', '[-]O', ''), ('regex', 'ab{2}', 'a')])
+def test_literal_prefix(kind, pattern, prefix):
+    assert patterns._literal_prefix(kind, pattern) == prefix
+
+
+def test_only_patterns_sharing_the_prefix_are_tried():
+    matcher = patterns.compile_patterns(['glob:-march=*.%s' % (i,) for i in range(100)]
+                                        + ['regex:-O[0-3]'], [])
+    assert len(matcher.disable_buckets) == 2
+    assert matcher.disabling_rule('-c') is None
+    assert matcher.disable_regexes == [None, None]
+    assert matcher.disabling_rule('-O2') == 100
+    assert matcher.disabling_rule('-march=native.42') == 42
+
+
+def test_invalid_patterns():
+    for spec in ('regex:(?P<name>x)', 'regex:(x)\\1', 'regex:(', 'fuzzy:x'):
+        with pytest.raises(ValueError):
+            patterns.compile_patterns([spec], [])
+    with pytest.raises(ValueError):
+        patterns.compile_patterns([], [('regex:-O(1)', '\\2')])
@@ -0,0 +1,72 @@
+"""
+Tests of the expansion and rewrite of @response files.
+"""
+import os
+import random
+
+import pytest
+
+from interceptor import response_files
+from interceptor.rules import compile_rules
+
+ARGUMENTS = ['-c', '', 'a b', "it's", '"quoted"', 'back\\slash', 'tab\there', 'new\nline',
+             '\\', "'", '"', 'é', '@not-a-file', '--']
+
+
+@pytest.mark.parametrize('text, arguments', [
+    ('', []),
+    ('  -c\t-o  a.o\n', ['-c', '-o', 'a.o']),
+    ('"a b" \'c d\' e\\ f', ['a b', 'c d', 'e f']),
+    ('"it\'s" \'say "hi"\'', ["it's", 'say "hi"']),
+    ("'' \"\"", ['', '']),
+    ('a"b"c \\\\', ['abc', '\\']),
+    ('-c\n', ['-c'])])
+def test_tokenize(text, arguments):
+    assert list(response_files.tokenize([text])) == arguments
+    assert list(response_files.tokenize(['', text, ''])) == arguments
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_quoted_arguments_survive_any_chunking(seed):
+    rng = random.Random(seed)
+    arguments = [rng.choice(ARGUMENTS) for _ in range(rng.randint(0, 20))]
+    text = ''.join(response_files.quote_argument(arg) + rng.choice(' \n\t') for arg in arguments)
+    cuts = sorted(rng.randint(0, len(text)) for _ in range(rng.randint(0, 5)))
+    chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+    assert list(response_files.tokenize(chunks)) == arguments
+
+
+def test_expand(tmp_path):
+    inner = tmp_path / 'inner.rsp'
+    inner.write_text('-DINNER "x y"')
+    empty = tmp_path / 'empty.rsp'
+    empty.write_text('')
+    outer = tmp_path / 'outer.rsp'
+    outer.write_text('-c @%s @%s @%s @%s' % (inner, empty, outer, tmp_path / 'missing'))
+    arguments = ['-O2', '@%s' % (outer,), '@%s' % (tmp_path,)]
+    assert response_files.has_response_files(arguments)
+    assert not response_files.has_response_files(arguments[2:])
+    assert list(response_files.expand(arguments)) == [
+        '-O2', '-c', '-DINNER', 'x y', '@%s' % (outer,), '@%s' % (tmp_path / 'missing',),
+        '@%s' % (tmp_path,)]
+
+
+def test_rewrite(tmp_path):
+    rsp = tmp_path / 'args.rsp'
+    rsp.write_text('-g -O0 "a b.c"\n')
+    rules = compile_rules({'args_to_disable': ['-g'], 'args_to_replace': [['-O0', '-O2']],
+                           'args_to_append': ['-Wall'], 'args_to_prepend': ['-pipe']})
+    events = []
+    arguments = response_files.rewrite(rules, ['-c', '@%s' % (rsp,)], str(tmp_path), events)
+    assert arguments[0] == '-pipe' and arguments[2:] == ['-Wall']
+    assert len(events) == 4
+    path = arguments[1][1:]
+    try:
+        if os.path.isdir('/proc/self/fd'):
+            assert path.startswith('/proc/self/fd/')
+            assert sorted(os.listdir(str(tmp_path))) == ['args.rsp']
+        with open(path) as f_in:
+            assert list(response_files.tokenize([f_in.read()])) == ['-c', '-O2', 'a b.c']
+    finally:
+        if path.startswith('/proc/self/fd/'):
+            os.close(int(path.rsplit('/', 1)[1]))
@@ -0,0 +1,104 @@
+"""
+Tests of the rewrite engine against applying every rule in turn to the whole command line.
+"""
+import fnmatch
+import marshal
+import random
+
+import pytest
+
+from interceptor.rules import APPEND, DISABLE, PREPEND, REPLACE, CompiledRules, compile_rules
+
+CONFIGURATIONS = 100
+COMMAND_LINES = 20
+
+VOCABULARY = ['-c', '-O0', '-O2', '-O3', '-g', '-Wall', '-Werror', '-o', 'a.o', 'b.o', '',
+              '-march=native', '-march=x86-64', '-fPIC']
+PATTERNS = ['prefix:-march=', 'prefix:-O', 'glob:*.o', 'glob:-W*', 'glob:-f???']
+
+
+def apply_one_by_one(cfg: dict, arguments: list) -> list:
+    arguments = [arg for arg in arguments if arg not in cfg['args_to_disable']]
+    arguments = [arg for arg in arguments
+                 if not any(matches(spec, arg) for spec in cfg['args_to_disable_matching'])]
+    for source, target in cfg['args_to_replace']:
+        arguments = [target if arg == source else arg for arg in arguments]
+    for i, arg in enumerate(arguments):
+        for spec, replacement in cfg['args_to_replace_matching']:
+            if matches(spec, arg):
+                kind, _, pattern = spec.partition(':')
+                arguments[i] = replacement + arg[len(pattern):] if kind == 'prefix' \
+                    else replacement
+                break
+    for arg in cfg['args_to_append']:
+        if arg not in arguments:
+            arguments.append(arg)
+    for arg in reversed(cfg['args_to_prepend']):
+        if arg not in arguments:
+            arguments.insert(0, arg)
+    if cfg['deduplication']:
+        arguments = list(dict.fromkeys(arguments))
+    return arguments
+
+
+def matches(spec: str, arg: str) -> bool:
+    kind, _, pattern = spec.partition(':')
+    return arg.startswith(pattern) if kind == 'prefix' else fnmatch.fnmatchcase(arg, pattern)
+
+
+def random_configuration(rng: random.Random) -> dict:
+    def sample(population, count):
+        return rng.sample(population, rng.randint(0, count))
+    return {'args_to_disable': sample(VOCABULARY, 3),
+            'args_to_replace': [[rng.choice(VOCABULARY), rng.choice(VOCABULARY)]
+                                for _ in range(rng.randint(0, 4))],
+            'args_to_append': [rng.choice(VOCABULARY) for _ in range(rng.randint(0, 3))],
+            'args_to_prepend': [rng.choice(VOCABULARY) for _ in range(rng.randint(0, 3))],
+            'args_to_disable_matching': sample(PATTERNS, 2),
+            'args_to_replace_matching': [[spec, rng.choice(VOCABULARY)]
+                                         for spec in sample(PATTERNS, 2)],
+            'deduplication': rng.random() < 0.5}
+
+
+@pytest.mark.parametrize('seed', range(CONFIGURATIONS))
+def test_compiled_rules_apply_as_rules_one_by_one(seed):
+    rng = random.Random(seed)
+    cfg = random_configuration(rng)
+    rules = CompiledRules.from_tables(marshal.loads(marshal.dumps(compile_rules(cfg).to_tables())))
+    for _ in range(COMMAND_LINES):
+        arguments = [rng.choice(VOCABULARY) for _ in range(rng.randint(0, 10))]
+        original = list(arguments)
+        assert rules.apply(arguments) == apply_one_by_one(cfg, arguments), (cfg, arguments)
+        assert arguments == original
+
+
+def test_events_are_ordered_as_rules_one_by_one():
+    rules = compile_rules({'args_to_disable': ['-g'],
+                           'args_to_replace': [['-O0', '-O1'], ['-O1', '-O2']],
+                           'args_to_append': ['-Wall'], 'args_to_prepend': ['-c', '-pipe'],
+                           'args_to_disable_matching': ['prefix:-march='],
+                           'args_to_replace_matching': [['glob:*.obj', 'x.o']]})
+    events = []
+    assert rules.apply(['-O0', '-g', '-march=native', 'a.obj', '-c'], events) == \
+        ['-pipe', '-O2', 'x.o', '-c', '-Wall']
+    assert events == [(DISABLE, 0, '-g', None), (DISABLE, 1, '-march=native', None),
+                      (REPLACE, 0, '-O0', '-O1'), (REPLACE, 1, '-O1', '-O2'),
+                      (REPLACE, 2, 'a.obj', 'x.o'), (APPEND, None, '-Wall', None),
+                      (PREPEND, None, '-pipe', None)]
+
+
+def test_stream_then_finish():
+    rules = compile_rules({'args_to_disable': ['-g'], 'args_to_append': ['-Wall'],
+                           'args_to_prepend': ['-pipe'], 'deduplication': True})
+    present = set()
+    assert list(rules.stream(iter(['-c', '-g', '-c', '-Wall']), present)) == ['-c', '-Wall']
+    assert rules.finish(present) == (['-pipe'], [])
+
+
+def test_probes():
+    rules = compile_rules({'memoize_probes': ['glob:--version', 'prefix:-print-']})
+    assert rules.is_probe(['--version'])
+    assert rules.is_probe(['-print-search-dirs', '--version'])
+    assert not rules.is_probe([])
+    assert not rules.is_probe(['--version', '-c'])
+    assert not compile_rules({}).is_probe(['--version'])
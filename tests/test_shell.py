@@ -0,0 +1,49 @@
+"""
+Differential tests of the sh backend against the Python one.
+"""
+import random
+
+import pytest
+
+from interceptor import shell
+
+CONFIGURATIONS = 40
+COMMAND_LINES = 16
+
+# arguments to build both the rules and the command lines from, including ones that need quoting
+VOCABULARY = ['-c', '-O0', '-O2', '-O3', '-g', '-Wall', '-Werror', '-o', 'a.o', 'a b', "it's",
+              '"', '*', '?', '[a]', '$HOME', '`x`', '\\', '-', '--', '', '=', '%s', 'é']
+
+pytestmark = pytest.mark.skipif(shell.find_shell() is None,
+                                reason='no shell that supports exec -a')
+
+
+def random_configuration(rng: random.Random) -> dict:
+    def sample(count):
+        return rng.sample(VOCABULARY, rng.randint(0, count))
+    return {'args_to_disable': sample(3),
+            'args_to_replace': [[source, rng.choice(VOCABULARY)] for source in sample(3)],
+            'args_to_append': sample(2),
+            'args_to_prepend': sample(2),
+            'deduplication': rng.random() < 0.5}
+
+
+@pytest.mark.parametrize('seed', range(CONFIGURATIONS))
+def test_sh_backend_rewrites_as_python_does(seed):
+    rng = random.Random(seed)
+    cfg = random_configuration(rng)
+    vocabulary = shell.known_arguments(cfg) + VOCABULARY
+    command_lines = [[rng.choice(vocabulary) for _ in range(rng.randint(0, 12))]
+                     for _ in range(COMMAND_LINES)]
+    assert shell.can_express(cfg)
+    for arguments in command_lines:
+        assert shell.verify(cfg, 'tool', [arguments]), (cfg, arguments)
+
+
+def test_default_check_is_a_single_command_line(monkeypatch):
+    calls = []
+    run = shell.subprocess.run
+    monkeypatch.setattr(shell.subprocess, 'run', lambda *args, **kwargs: calls.append(args)
+                        or run(*args, **kwargs))
+    assert shell.verify({'args_to_disable': ['-g'], 'deduplication': True}, 'tool')
+    assert len(calls) == 1
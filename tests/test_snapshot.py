@@ -0,0 +1,75 @@
+"""
+Tests of the snapshot, in a temporary directory.
+"""
+import os
+
+import pytest
+
+from interceptor import snapshot
+from interceptor.rules import CompiledRules, compile_rules
+
+CFG = {'args_to_disable': ['-g'], 'args_to_replace_matching': [['glob:-O?', '-O2']]}
+
+
+@pytest.fixture
+def snapshot_of(tmp_path):
+    """
+    Write a snapshot with an entry for tool, that depends on a configuration file.
+    """
+    config = tmp_path / 'tool'
+    config.write_text('{}')
+    path = str(tmp_path / '.snapshot')
+    snapshot.write_snapshot({'tool': ((CFG, compile_rules(CFG).to_tables()),
+                                      [snapshot.stat_dependency(str(config))])}, path)
+    return config, path
+
+
+def test_fresh_entry_is_read(snapshot_of):
+    _, path = snapshot_of
+    cfg, tables = snapshot.read_snapshot_entry('tool', path)
+    assert cfg == CFG
+    assert CompiledRules.from_tables(tables).apply(['-g', '-O3']) == ['-O2']
+    assert snapshot.read_snapshot_entry('other', path) is None
+
+
+def replace_file(config):
+    new = config.with_name('new')
+    new.write_text('{}')
+    os.replace(str(new), str(config))
+
+
+@pytest.mark.parametrize('change', [
+    lambda config: config.write_text('{"deduplication": true}'),
+    lambda config: os.utime(str(config), ns=(0, 0)),
+    replace_file,
+    lambda config: config.unlink()])
+def test_changed_dependency_makes_the_entry_stale(snapshot_of, change):
+    config, path = snapshot_of
+    change(config)
+    assert snapshot.read_snapshot_entry('tool', path) is None
+
+
+def test_missing_corrupt_or_other_format_is_ignored(snapshot_of, tmp_path):
+    _, path = snapshot_of
+    assert snapshot.read_snapshot_entry('tool', str(tmp_path / 'missing')) is None
+    with open(path, 'rb') as f_in:
+        data = f_in.read()
+    with open(path, 'wb') as f_out:
+        f_out.write(data[:4] + (snapshot.FORMAT_VERSION + 1).to_bytes(4, 'little') + data[8:])
+    assert snapshot.read_snapshot_entry('tool', path) is None
+    with open(path, 'wb') as f_out:
+        f_out.write(data[:snapshot.HEADER_SIZE + 5])
+    assert snapshot.read_snapshot_entry('tool', path) is None
+
+
+def test_many_entries(tmp_path):
+    config = tmp_path / 'tool'
+    config.write_text('{}')
+    dependencies = [snapshot.stat_dependency(str(config))]
+    path = str(tmp_path / '.snapshot')
+    snapshot.write_snapshot({'tool%s' % (i,): (({'i': i}, None), dependencies)
+                             for i in range(300)}, path)
+    for i in range(300):
+        assert snapshot.read_snapshot_entry('tool%s' % (i,), path) == ({'i': i}, None)
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    assert sorted(os.listdir(str(tmp_path))) == ['.snapshot', 'tool']